@@ -0,0 +1,100 @@
+"""
+Measure the CPU time a prediction endpoint spends decoding, validating and
+encoding a batch of loans in every body format.
+
+Run from the backend directory:
+
+    python -m benchmarks.body_formats --step step2 --rows 20000
+
+The formats are a JSON list of loans, a MessagePack list of loans and a
+MessagePack map of columns. Scoring is left out as it does not depend on the
+format, and the response is the same for all of them.
+"""
+import argparse
+import json
+import os
+import time
+
+import msgpack
+import pandas as pd
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from prediction.formats import decode_body
+from prediction.loan_batch import LoanBatch
+from prediction.steps import STEPS
+
+
+def make_records(records, rows):
+    loans = []
+    for i in range(rows):
+        loan = dict(records[i % len(records)])
+        if loan.get("loan_amnt") is not None:
+            loan["loan_amnt"] += i // len(records)
+        loans.append(loan)
+    return loans
+
+
+def time_format(loan_class, content_type, body, response, repeat):
+    """
+    Returns the lowest CPU time of decoding, validating and building the features
+    of `body`, and of encoding `response` in the same format, in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.process_time()
+        loans = decode_body(content_type, body)
+        if isinstance(loans, dict):
+            rows = len(next(iter(loans.values())))
+            batch = LoanBatch.from_columns(loan_class, loans, rows)[0]
+        else:
+            batch = LoanBatch.from_records(loan_class, loans)[0]
+        batch.to_frame()
+        decoded = time.process_time()
+
+        if content_type == "application/json":
+            JSONResponse(jsonable_encoder(response))
+        else:
+            msgpack.packb(response)
+        encoded = time.process_time()
+
+        times = (decoded - started, encoded - decoded)
+        best = times if best is None else tuple(map(min, best, times))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--step", choices=list(STEPS), default="step2")
+    parser.add_argument("--test-csvs", default="../test_csvs")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    loan_class = STEPS[args.step]["loan_class"]
+    path = os.path.join(args.test_csvs, f"{args.step}.csv")
+    loans = make_records(
+        json.loads(pd.read_csv(path).to_json(orient="records")), args.rows
+    )
+    columns = {name: [loan[name] for loan in loans] for name in loans[0]}
+    # A response of grades, the same for every format and step
+    response = {
+        i: {"grade_category": "B-C", "predicted_grade": "B"} for i in range(args.rows)
+    }
+
+    bodies = [
+        ("json rows", "application/json", json.dumps(loans).encode()),
+        ("msgpack rows", "application/msgpack", msgpack.packb(loans)),
+        ("msgpack columns", "application/msgpack", msgpack.packb(columns)),
+    ]
+    print(f"{args.step}, {args.rows} loans")
+    print(f"{'format':<16} {'body MB':>8} {'decode+validate s':>18} {'encode s':>9}")
+    for name, content_type, body in bodies:
+        decode, encode = time_format(
+            loan_class, content_type, body, response, args.repeat
+        )
+        print(f"{name:<16} {len(body) / 1e6:>8.2f} {decode:>18.3f} {encode:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
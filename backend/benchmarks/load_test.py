@@ -0,0 +1,376 @@
+"""
+Start the backend as the Procfile does and replay a mix of interactive and bulk
+requests against it at a target rate.
+
+Run from the backend directory:
+
+    python -m benchmarks.load_test --rps 20 --duration 60 --workers 4
+
+Reports the throughput, the latency percentiles and error rate of every kind of
+request, and the peak resident memory of the gunicorn master and each worker.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Endpoint receiving the loans of every step
+STEP_PATHS = {
+    "step1": "/step1_accepted_rejected_prediction/",
+    "step2": "/step2_grade_prediction/",
+    "step3": "/step3_subgrade_prediction/",
+    "step4": "/step4_int_rate_prediction/",
+}
+
+# Reported latency percentiles
+PERCENTILES = [50, 90, 95, 99]
+
+# Seconds between two samples of the memory of the server processes
+RSS_INTERVAL = 1.0
+
+
+def load_records(path):
+    # Missing values are sent as null, as the JSON encoder of pandas does
+    return json.loads(pd.read_csv(path).to_json(orient="records"))
+
+
+def cycle_loans(records, rows, start=0):
+    """
+    Returns `rows` loans cycled from `records`, from position `start`, with
+    distinct loan amounts so that no row of a bulk request is deduplicated away.
+    """
+    loans = []
+    for i in range(rows):
+        loan = dict(records[(start + i) % len(records)])
+        if loan.get("loan_amnt") is not None:
+            loan["loan_amnt"] += (start + i) // len(records)
+        loans.append(loan)
+    return loans
+
+
+def default_mix(test_csvs, bulk_rows, bulk_share):
+    """
+    Build a mix of single-loan requests for every step, plus bulk requests of
+    `bulk_rows` loans that make up `bulk_share` of all requests.
+    """
+    mix = []
+    for step, path in STEP_PATHS.items():
+        records = load_records(os.path.join(test_csvs, f"{step}.csv"))
+        mix.append(
+            {
+                "name": f"{step}-interactive",
+                "path": path,
+                "bodies": [[record] for record in records],
+                "weight": (1 - bulk_share) / len(STEP_PATHS),
+            }
+        )
+        mix.append(
+            {
+                "name": f"{step}-bulk",
+                "path": path,
+                "bodies": [cycle_loans(records, bulk_rows)],
+                "weight": bulk_share / len(STEP_PATHS),
+            }
+        )
+    return mix
+
+
+def read_mix(path, test_csvs):
+    """
+    Read a traffic mix from a JSONL file, one kind of request per line:
+
+        {"name": "step3-bulk", "path": "/step3_subgrade_prediction/",
+         "csv": "step3.csv", "rows": 2000, "weight": 0.02}
+
+    Each request posts `rows` loans (1 by default) cycled from `csv`, read from
+    the test CSV directory with distinct loan amounts, or the JSON list given as
+    "body" instead.
+    """
+    mix = []
+    with open(path) as mix_file:
+        for line in mix_file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "body" in entry:
+                bodies = [entry["body"]]
+            else:
+                records = load_records(os.path.join(test_csvs, entry["csv"]))
+                rows = entry.get("rows", 1)
+                bodies = [
+                    cycle_loans(records, rows, start) for start in range(len(records))
+                ]
+            mix.append(
+                {
+                    "name": entry.get("name", entry["path"]),
+                    "path": entry["path"],
+                    "bodies": bodies,
+                    "weight": entry.get("weight", 1.0),
+                }
+            )
+    return mix
+
+
+def start_server(workers, port):
+    """
+    Start gunicorn with uvicorn workers on localhost, as in the Procfile.
+    """
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers))
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "-w",
+            str(workers),
+            "-k",
+            "uvicorn.workers.UvicornWorker",
+            "-b",
+            f"127.0.0.1:{port}",
+            "prediction.main:app",
+        ],
+        env=env,
+    )
+    return server
+
+
+def wait_until_ready(host, port, workers, server, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError("the server exited before it was ready.")
+        try:
+            connection = http.client.HTTPConnection(host, port, timeout=5)
+            connection.request("GET", "/")
+            if connection.getresponse().status == 200 and (
+                server is None or len(child_pids(server.pid)) >= workers
+            ):
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"the server was not ready after {timeout} seconds.")
+
+
+def child_pids(pid):
+    """
+    Returns the ids of the child processes of `pid`, read from /proc.
+    """
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat_file:
+                # The parent id follows the parenthesised command name
+                parent = int(stat_file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if parent == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def rss_mb(pid):
+    """
+    Returns the resident memory of a process in megabytes, or None once it exited.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+class MemorySampler(threading.Thread):
+    """
+    Samples the resident memory of the gunicorn master and its workers.
+    """
+
+    def __init__(self, master_pid):
+        super().__init__(daemon=True)
+        self.master_pid = master_pid
+        self.peak = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            for pid in [self.master_pid] + child_pids(self.master_pid):
+                rss = rss_mb(pid)
+                if rss is not None:
+                    self.peak[pid] = max(self.peak.get(pid, 0.0), rss)
+            self.stopped.wait(RSS_INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+_connections = threading.local()
+
+
+def send(host, port, path, body, timeout):
+    connection = getattr(_connections, "connection", None)
+    if connection is None:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        _connections.connection = connection
+    try:
+        connection.request(
+            "POST", path, body=body, headers={"Content-Type": "application/json"}
+        )
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    except (OSError, http.client.HTTPException):
+        connection.close()
+        _connections.connection = None
+        return 0
+
+
+def run_load(host, port, mix, rps, duration, concurrency, timeout, seed):
+    """
+    Send requests at `rps` requests per second for `duration` seconds, picking
+    their kind by weight.
+
+    Requests are scheduled at fixed times whether or not the earlier ones have
+    completed, and latencies are measured from the scheduled time, so a slow
+    server shows up as latency rather than as a lower request rate.
+
+    Returns:
+    A list of (kind, rows, status, latency in seconds) tuples, and the elapsed time.
+    """
+    rng = random.Random(seed)
+    encoded = [[json.dumps(body).encode() for body in kind["bodies"]] for kind in mix]
+    weights = [kind["weight"] for kind in mix]
+    results = []
+
+    def task(kind, body, rows, scheduled):
+        status = send(host, port, mix[kind]["path"], body, timeout)
+        results.append((mix[kind]["name"], rows, status, time.monotonic() - scheduled))
+
+    total = int(rps * duration)
+    start = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for i in range(total):
+            scheduled = start + i / rps
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            kind = rng.choices(range(len(mix)), weights)[0]
+            body_index = rng.randrange(len(encoded[kind]))
+            rows = len(mix[kind]["bodies"][body_index])
+            executor.submit(task, kind, encoded[kind][body_index], rows, scheduled)
+    return results, time.monotonic() - start
+
+
+def report(results, elapsed, peak_rss, master_pid=None):
+    print(f"\n{len(results)} requests in {elapsed:.1f} s")
+    frame = pd.DataFrame(results, columns=["kind", "rows", "status", "latency"])
+    frame["error"] = (frame["status"] < 200) | (frame["status"] >= 300)
+    ok = frame[~frame["error"]]
+    print(
+        f"throughput: {len(ok) / elapsed:.1f} requests/s, "
+        f"{ok['rows'].sum() / elapsed:.1f} loans/s"
+    )
+
+    header = " ".join(f"{f'p{p} ms':>9}" for p in PERCENTILES)
+    print(f"\n{'kind':<20} {'requests':>8} {'errors':>7} {header} {'max ms':>9}")
+    for kind, group in frame.groupby("kind"):
+        latencies = group.loc[~group["error"], "latency"].to_numpy() * 1000
+        if len(latencies):
+            values = np.percentile(latencies, PERCENTILES).tolist() + [latencies.max()]
+        else:
+            values = [float("nan")] * (len(PERCENTILES) + 1)
+        print(
+            f"{kind:<20} {len(group):>8} {group['error'].mean():>7.1%} "
+            + " ".join(f"{value:>9.1f}" for value in values)
+        )
+
+    statuses = frame.loc[frame["error"], "status"].value_counts()
+    if len(statuses):
+        print("\nerror statuses (0 = connection error or timeout):")
+        for status, count in statuses.items():
+            print(f"  {status}: {count}")
+
+    if peak_rss:
+        print("\npeak RSS MB")
+        for pid, rss in sorted(peak_rss.items()):
+            role = "master" if pid == master_pid else "worker"
+            print(f"  {role:<7} {pid:>8} {rss:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--test-csvs", default="../test_csvs")
+    parser.add_argument("--mix", help="JSONL file describing the traffic mix")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--url-port",
+        type=int,
+        help="load an already running server on this localhost port instead",
+    )
+    parser.add_argument("--rps", type=float, default=20)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--bulk-rows", type=int, default=2000)
+    parser.add_argument("--bulk-share", type=float, default=0.02)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.mix:
+        mix = read_mix(args.mix, args.test_csvs)
+    else:
+        mix = default_mix(args.test_csvs, args.bulk_rows, args.bulk_share)
+
+    host = "127.0.0.1"
+    server = None
+    if args.url_port is None:
+        server = start_server(args.workers, args.port)
+    port = args.url_port or args.port
+
+    sampler = None
+    try:
+        wait_until_ready(host, port, args.workers, server)
+        if server is not None:
+            sampler = MemorySampler(server.pid)
+            sampler.start()
+        results, elapsed = run_load(
+            host,
+            port,
+            mix,
+            args.rps,
+            args.duration,
+            args.concurrency,
+            args.timeout,
+            args.seed,
+        )
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=60)
+
+    if server is None:
+        report(results, elapsed, {})
+    else:
+        report(results, elapsed, sampler.peak, server.pid)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Measure the memory allocated per loan by every stage of a prediction request,
+for a range of batch sizes.
+
+Run from the backend directory:
+
+    python -m benchmarks.memory_stages --step step3 --plot memory.png
+
+The stages are the decoding and validation of the JSON body, the feature
+building, the inference, the building of the result dicts and the encoding of
+the response. The net bytes of a stage are still allocated when it ends, so the
+net bytes of the earlier stages add up to what a batch holds while it is scored.
+"""
+import argparse
+import json
+import os
+import tracemalloc
+
+import pandas as pd
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from prediction import audit
+from prediction.loan_batch import LoanBatch
+from prediction.memory import (
+    MemoryStages,
+    get_memory_report,
+    reset_memory_report,
+    size_bucket,
+)
+from prediction.steps import STEPS, load_model
+
+BATCH_SIZES = [1, 10, 100, 1000, 10000, 100000]
+
+STAGES = ["validation", "features", "inference", "results", "encoding"]
+
+
+def make_body(records, rows):
+    """
+    Encode a JSON list of `rows` loans cycled from `records`, with distinct loan
+    amounts so that no row is deduplicated away.
+    """
+    loans = []
+    for i in range(rows):
+        loan = dict(records[i % len(records)])
+        if loan.get("loan_amnt") is not None:
+            loan["loan_amnt"] += i // len(records)
+        loans.append(loan)
+    return json.dumps(loans).encode()
+
+
+def profile_request(step, model, body, rows):
+    """
+    Run a request body through the stages of its endpoint, as FastAPI does.
+    """
+    config = STEPS[step]
+    with MemoryStages(step, rows) as stages:
+        loans, _, _ = LoanBatch.from_records(config["loan_class"], json.loads(body))
+        stages.mark("validation")
+
+    results = config["predict"](model, loans)
+
+    with MemoryStages(step, rows) as stages:
+        JSONResponse(jsonable_encoder(results))
+        stages.mark("encoding")
+
+
+def plot(report, step, path):
+    try:
+        import matplotlib
+
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed, skipping the plot.")
+        return
+
+    figure, axes = plt.subplots(figsize=(8, 5))
+    sizes = sorted(int(size) for size in report)
+    for color, stage in enumerate(STAGES):
+        for kind, style in (("net", "-"), ("peak", ":")):
+            axes.plot(
+                sizes,
+                [report[str(size)][stage][f"{kind}_bytes_per_loan"] for size in sizes],
+                style,
+                color=f"C{color}",
+                marker="o",
+                label=f"{stage} ({kind})",
+            )
+    axes.set_xscale("log")
+    axes.set_yscale("log")
+    axes.set_xlabel("loans per request")
+    axes.set_ylabel("bytes per loan")
+    axes.set_title(f"{step} allocations per stage")
+    axes.legend(fontsize="small", ncol=2)
+    figure.tight_layout()
+    figure.savefig(path)
+    print(f"Saved the plot to {path}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--step", choices=list(STEPS), default="step3")
+    parser.add_argument("--test-csvs", default="../test_csvs")
+    parser.add_argument("--sizes", type=int, nargs="*", default=BATCH_SIZES)
+    parser.add_argument("--plot", help="save a plot of the bytes per loan here")
+    args = parser.parse_args()
+
+    # The audit writer thread would allocate in the middle of the stages
+    audit.AUDIT_STEPS = set()
+
+    model = load_model(args.step)
+    records = json.loads(
+        pd.read_csv(os.path.join(args.test_csvs, f"{args.step}.csv")).to_json(
+            orient="records"
+        )
+    )
+
+    # Warm up the caches of the libraries before tracing
+    profile_request(args.step, model, make_body(records, 10), 10)
+    tracemalloc.start()
+    reset_memory_report()
+
+    for size in sorted(args.sizes):
+        profile_request(args.step, model, make_body(records, size), size)
+
+    report = get_memory_report()[args.step]
+    print(f"{args.step}: bytes per loan, net / peak")
+    print(f"{'loans':>8} " + " ".join(f"{stage:>21}" for stage in STAGES))
+    for size in sorted(args.sizes):
+        stages = report[str(size_bucket(size))]
+        print(
+            f"{size:>8} "
+            + " ".join(
+                f"{stages[stage]['net_bytes_per_loan']:>10.0f} "
+                f"{stages[stage]['peak_bytes_per_loan']:>10.0f}"
+                for stage in STAGES
+            )
+        )
+
+    if args.plot:
+        plot(report, args.step, args.plot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Compare the time of a similar loans lookup with the time of scoring the same
+batch, and the recall of the index against an exact search, for several
+numbers of probed lists.
+
+Run from the backend directory:
+
+    python -m benchmarks.similar_loans --step step3 --index-rows 200000 --rows 10000
+
+The loans of test_csvs/<step>.csv are cycled with random variations of their
+amounts and balances into a historical dataset of --index-rows loans, and into a batch
+of --rows loans to look up.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from prediction.loan_batch import LoanBatch
+from prediction.similar import (
+    SimilarLoanIndex,
+    build_similar_index,
+    feature_matrix,
+)
+from prediction.steps import STEPS
+
+
+# Amounts and balances varied across the generated loans
+VARIED_COLUMNS = [
+    "loan_amnt",
+    "annual_inc",
+    "annual_inc_joint",
+    "avg_cur_bal",
+    "bc_open_to_buy",
+    "max_bal_bc",
+    "revol_bal",
+    "revol_bal_joint",
+    "total_bc_limit",
+    "total_rev_hi_lim",
+]
+
+
+def make_loans(records, rows, rng):
+    """
+    Cycle `records` into `rows` loans, scaling each of their amounts and balances
+    by a random factor between 0.7 and 1.3.
+    """
+    loans = records.iloc[np.arange(rows) % len(records)].reset_index(drop=True)
+    for column in VARIED_COLUMNS:
+        if column in loans:
+            loans[column] = loans[column] * rng.uniform(0.7, 1.3, rows)
+    return loans
+
+
+def standardized(index, loans):
+    features = (feature_matrix(loans, index.columns) - index.mean) / index.scale
+    return np.nan_to_num(features)
+
+
+def exact_distances(features, historical):
+    """
+    Returns the squared distances between standardized loans and historical loans.
+    """
+    return (
+        (features * features).sum(axis=1)[:, None]
+        - 2 * features @ historical.T
+        + (historical * historical).sum(axis=1)
+    )
+
+
+def exact_neighbours(features, historical, k):
+    """
+    Returns the k nearest historical loans of every loan by brute force, in the
+    unquantized standardized space, and the sum of their distances.
+    """
+    distances = exact_distances(features, historical)
+    nearest = np.argsort(distances, axis=1)[:, :k]
+    total = np.sqrt(np.maximum(np.take_along_axis(distances, nearest, axis=1), 0))
+    return nearest, total.sum(axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--step", choices=["step2", "step3"], default="step3")
+    parser.add_argument("--test-csvs", default="../test_csvs")
+    parser.add_argument("--index-rows", type=int, default=200000)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--probes", type=int, nargs="*", default=[2, 4, 8, 16])
+    parser.add_argument("--lists", type=int)
+    parser.add_argument("--recall-rows", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = STEPS[args.step]
+    records = pd.read_csv(os.path.join(args.test_csvs, f"{args.step}.csv"))
+    rng = np.random.default_rng(args.seed)
+
+    historical = make_loans(records, args.index_rows, rng)
+    started = time.perf_counter()
+    codes, arrays = build_similar_index(args.step, historical, ["grade"], args.lists)
+    print(
+        f"built an index of {len(codes)} loans, {codes.shape[1]} features and "
+        f"{len(arrays['centroids'])} lists "
+        f"({codes.nbytes / 1e6:.1f} MB) in {time.perf_counter() - started:.2f} s"
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "index")
+        np.save(f"{path}.npy", codes)
+        np.savez(f"{path}.npz", **arrays)
+        index = SimilarLoanIndex.load(args.step, path)
+
+        batch = make_loans(records, args.rows, rng)
+        loans, _, _ = LoanBatch.from_columns(
+            config["loan_class"],
+            {name: batch[name].tolist() for name in batch.columns},
+            len(batch),
+        )
+        historical, _, _ = LoanBatch.from_columns(
+            config["loan_class"],
+            {name: historical[name].tolist() for name in historical.columns},
+            len(historical),
+        )
+        sample = np.arange(min(args.recall_rows, len(loans)))
+        features = standardized(index, loans.take(sample))
+        historical = standardized(index, historical)
+        exact, exact_total = exact_neighbours(features, historical, args.k)
+
+        model = joblib.load(config["model_path"])
+        started = time.perf_counter()
+        config["predict"](model, loans)
+        predict_time = time.perf_counter() - started
+
+        print(f"\n{args.step}, {args.rows} loans, k={args.k}")
+        print(f"predict: {predict_time:.3f} s")
+        print(
+            f"{'probes':>6} {'search s':>9} {'vs predict':>10} {'recall':>7} "
+            f"{'distance ratio':>14}"
+        )
+        for probes in args.probes:
+            index.probes = min(probes, len(index.centroids))
+            started = time.perf_counter()
+            positions, _ = index.search(loans, args.k)
+            search_time = time.perf_counter() - started
+            found = index.rows[positions[sample]]
+            recall = np.mean(
+                [
+                    len(set(row) & set(expected)) / args.k
+                    for row, expected in zip(found.tolist(), exact.tolist())
+                ]
+            )
+            # Near-ties make recall low for loans that are as similar, so the
+            # exact distances of the loans found are compared as well
+            distances = np.take_along_axis(
+                exact_distances(features, historical), found, axis=1
+            )
+            ratio = np.sqrt(np.maximum(distances, 0)).sum(axis=1) / exact_total
+            print(
+                f"{probes:>6} {search_time:>9.3f} "
+                f"{search_time / predict_time:>9.2f}x {recall:>7.1%} "
+                f"{np.mean(ratio):>14.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Compare the subgrade cascade with the full subgrade model: throughput, share of
+loans sent to the full model, and agreement of the predicted subgrades.
+
+Run from the backend directory:
+
+    python -m benchmarks.subgrade_cascade --thresholds 0.3 0.35 0.4
+
+The loans of test_csvs/step3.csv are scored as they are, then cycled into
+--rows loans with --missing-rate of their imputed fields blanked at random, as
+in applications with incomplete credit files.
+"""
+import argparse
+import json
+import os
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from prediction.cascade import ModelCascade, build_first_stage
+from prediction.loan_batch import LoanBatch
+from prediction.steps import STEPS
+
+
+def load_frame(test_csvs):
+    path = os.path.join(test_csvs, "step3.csv")
+    records = json.loads(pd.read_csv(path).to_json(orient="records"))
+    loans, _, _ = LoanBatch.from_records(STEPS["step3"]["loan_class"], records)
+    return loans.to_frame()
+
+
+def with_missing_values(frame, columns, rows, missing_rate, seed):
+    """
+    Cycle the loans of `frame` into `rows` loans with slightly different amounts,
+    and blank each of `columns` with probability `missing_rate`.
+    """
+    rng = np.random.default_rng(seed)
+    frame = frame.iloc[np.arange(rows) % len(frame)].reset_index(drop=True)
+    for column in ("loan_amnt", "annual_inc", "avg_cur_bal", "total_rev_hi_lim"):
+        if column in frame:
+            frame[column] = frame[column] * rng.uniform(0.7, 1.3, rows)
+    values = frame[columns].to_numpy(dtype=np.float64)
+    values[rng.random(values.shape) < missing_rate] = np.nan
+    frame[columns] = values
+    return frame
+
+
+def score(model, frame):
+    """
+    Returns the predicted subgrades of `frame`, the five most probable subgrades
+    of every loan, which span its subgrade category, and the time taken in seconds.
+    """
+    start = time.perf_counter()
+    predicted_proba = model.predict_proba(frame)
+    elapsed = time.perf_counter() - start
+    ranked = np.argsort(-predicted_proba, axis=1, kind="stable")[:, :5]
+    return predicted_proba.argmax(axis=1), ranked, elapsed
+
+
+def compare(name, model, first_stage, columns, frame, thresholds):
+    full_classes, full_ranked, full_time = score(model, frame)
+    missing = frame[columns].isna().to_numpy().any(axis=1).mean()
+    print(f"\n{name}: {len(frame)} loans, {missing:.1%} with missing values")
+    print(f"full model: {len(frame) / full_time:,.0f} loans/s")
+    print(
+        f"{'threshold':>9} {'loans/s':>10} {'speedup':>8} {'escalated':>10} "
+        f"{'subgrade agreement':>19} {'category agreement':>19}"
+    )
+    for threshold in thresholds:
+        cascade = ModelCascade("step3", model, first_stage, columns, threshold)
+        first_stage_proba = first_stage.predict_proba(frame)
+        escalated = frame[columns].isna().to_numpy().any(axis=1) & (
+            first_stage_proba.max(axis=1) < threshold
+        )
+        classes, ranked, elapsed = score(cascade, frame)
+        print(
+            f"{threshold:>9.2f} {len(frame) / elapsed:>10,.0f} "
+            f"{full_time / elapsed:>7.1f}x {escalated.mean():>10.1%} "
+            f"{(classes == full_classes).mean():>19.2%} "
+            f"{(ranked[:, [0, -1]] == full_ranked[:, [0, -1]]).all(axis=1).mean():>19.2%}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--test-csvs", default="../test_csvs")
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--missing-rate", type=float, default=0.02)
+    parser.add_argument("--thresholds", type=float, nargs="*", default=[0.3, 0.35, 0.4])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    model = joblib.load(STEPS["step3"]["model_path"])
+    first_stage = build_first_stage(model)
+    if first_stage is None:
+        print("The subgrade model has no nearest-neighbour imputation to skip.")
+        return
+    first_stage, columns = first_stage
+
+    frame = load_frame(args.test_csvs)
+    compare("test_csvs/step3.csv", model, first_stage, columns, frame, args.thresholds)
+    frame = with_missing_values(frame, columns, args.rows, args.missing_rate, args.seed)
+    compare(
+        f"missing rate {args.missing_rate:.0%}",
+        model,
+        first_stage,
+        columns,
+        frame,
+        args.thresholds,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Find the batch size above which scoring with several native threads beats
+scoring single-threaded, for every step model.
+
+Run from the backend directory:
+
+    python -m benchmarks.thread_crossover --threads 4
+
+The suggested crossover is the value to use for LOAN_SMALL_BATCH_ROWS.
+"""
+import argparse
+import os
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from threadpoolctl import ThreadpoolController
+
+from prediction.predictions import build_batch_frame
+from prediction.steps import STEPS
+from prediction.threads import available_cores, set_model_threads
+
+BATCH_SIZES = [1, 8, 32, 128, 512, 2048, 8192]
+
+
+def time_batch(model, frame, threads, controller, repeats):
+    """
+    Returns the median time, in milliseconds, to score `frame` with `threads` threads.
+    """
+    score = model.predict_proba if hasattr(model, "classes_") else model.predict
+    set_model_threads(model, threads)
+    timings = []
+    with controller.limit(limits=threads):
+        score(frame)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            score(frame)
+            timings.append(time.perf_counter() - start)
+    return float(np.median(timings) * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--test-csvs", default="../test_csvs")
+    parser.add_argument("--threads", type=int, default=available_cores())
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--batch-sizes", type=int, nargs="*", default=BATCH_SIZES)
+    args = parser.parse_args()
+
+    controller = ThreadpoolController()
+    crossovers = []
+    for step, config in STEPS.items():
+        if not os.path.exists(config["model_path"]):
+            print(f"{step}: {config['model_path']} not found, skipped.")
+            continue
+
+        model = joblib.load(config["model_path"])
+        records = pd.read_csv(os.path.join(args.test_csvs, f"{step}.csv")).to_dict(
+            orient="records"
+        )
+        rows = build_batch_frame([config["loan_class"](**record) for record in records])
+
+        print(f"\n{step}: milliseconds per batch")
+        print(f"{'rows':>8} {'1 thread':>12} {f'{args.threads} threads':>12}")
+        crossover = None
+        for size in sorted(args.batch_sizes):
+            frame = rows.iloc[np.arange(size) % len(rows)].reset_index(drop=True)
+            single = time_batch(model, frame, 1, controller, args.repeats)
+            multi = time_batch(model, frame, args.threads, controller, args.repeats)
+            print(f"{size:>8} {single:>12.3f} {multi:>12.3f}")
+
+            # The crossover is where threads start winning for every larger batch
+            if multi >= single:
+                crossover = None
+            elif crossover is None:
+                crossover = size
+
+        print(f"{step}: multi-threaded scoring wins from {crossover or 'no'} rows.")
+        if crossover is not None:
+            crossovers.append(crossover)
+
+    # A single threshold applies to every step, so use the most conservative one
+    if crossovers:
+        print(f"\nSuggested LOAN_SMALL_BATCH_ROWS: {max(crossovers)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import asyncio
+import os
+
+from fastapi import HTTPException
+from starlette.responses import JSONResponse
+
+from prediction.jobs import submit_job
+from prediction.tracing import span
+
+# Step of every endpoint subject to admission control
+ADMISSION_ROUTES = {
+    "/step1_accepted_rejected_prediction/": "step1",
+    "/step1_counterfactual/": "step1",
+    "/step2_grade_prediction/": "step2",
+    "/step2_grade_explanation/": "step2",
+    "/step2_similar_loans/": "step2",
+    "/step3_subgrade_prediction/": "step3",
+    "/step3_subgrade_explanation/": "step3",
+    "/step3_similar_loans/": "step3",
+    "/step4_int_rate_prediction/": "step4",
+    "/step4_int_rate_quote/": "step4",
+    "/what_if_prediction/": "step4",
+}
+# Typical size of one JSON loan of each step, used to estimate the rows of a
+# request from its Content-Length before the body is read
+BYTES_PER_ROW = {"step1": 80, "step2": 750, "step3": 900, "step4": 1000}
+
+# Relative scoring cost of one loan of each step; the subgrade pipeline imputes
+# missing values from their nearest neighbours
+ROW_COST = {"step1": 1.0, "step2": 1.0, "step3": 4.0, "step4": 1.0}
+
+# Endpoints that score their body a chunk at a time and only answer a summary.
+# They always run in the bulk lane. CSV bodies are read as they stream in, so
+# their memory does not grow with the body and they are never over the
+# admission budget; other bodies are read whole and are admitted by their size
+STREAMING_ROUTES = {f"/portfolio/{step}/": step for step in BYTES_PER_ROW}
+
+# Requests up to this cost run in the interactive lane, larger ones in the bulk lane
+INTERACTIVE_MAX_COST = float(os.environ.get("LOAN_INTERACTIVE_MAX_COST", 100))
+
+# Requests over this cost are rejected, or deferred to a batch job on request
+ADMISSION_MAX_COST = float(os.environ.get("LOAN_ADMISSION_MAX_COST", 50000))
+
+# Requests each lane of a worker runs at the same time, and may keep waiting
+INTERACTIVE_CONCURRENCY = int(os.environ.get("LOAN_INTERACTIVE_CONCURRENCY", 8))
+INTERACTIVE_QUEUE = int(os.environ.get("LOAN_INTERACTIVE_QUEUE", 32))
+BULK_CONCURRENCY = int(os.environ.get("LOAN_BULK_CONCURRENCY", 1))
+BULK_QUEUE = int(os.environ.get("LOAN_BULK_QUEUE", 8))
+
+# Seconds a client is asked to wait before retrying a request of a full lane
+RETRY_AFTER = 5
+
+
+def estimate_cost(step, content_length):
+    """
+    Estimate the scoring cost of a request from its size, in step 1 loans.
+
+    Args:
+    step: The name of the prediction step (e.g. "step3").
+    content_length: The size of the request body in bytes, or None if unknown.
+
+    Returns:
+    The estimated cost, or None when the size of the request is unknown.
+    """
+    if content_length is None:
+        return None
+    rows = max(content_length // BYTES_PER_ROW[step], 1)
+    return rows * ROW_COST[step]
+
+
+class Lane:
+    """
+    Limits the requests of a priority lane that run at the same time, and turns
+    requests away once too many are already waiting.
+    """
+
+    def __init__(self, name, concurrency, queue):
+        self.name = name
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.queue = queue
+        self.waiting = 0
+
+    async def acquire(self):
+        """
+        Waits for a slot of the lane, or returns False at once if its queue is full.
+        """
+        if self.semaphore.locked() and self.waiting >= self.queue:
+            return False
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        return True
+
+    def release(self):
+        self.semaphore.release()
+
+
+async def _body_chunks(receive):
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            return
+        yield message.get("body", b"")
+        if not message.get("more_body", False):
+            return
+
+
+class AdmissionControl:
+    """
+    ASGI middleware that estimates the cost of every prediction request from its
+    step and size before the body is read or validated.
+
+    Requests run in an interactive or a bulk lane depending on their cost, so
+    single loans from the form never queue behind large batches. Requests over
+    the admission budget are rejected with 413, or queued as a batch job when
+    they carry a "Prefer: respond-async" header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.interactive = Lane(
+            "interactive", INTERACTIVE_CONCURRENCY, INTERACTIVE_QUEUE
+        )
+        self.bulk = Lane("bulk", BULK_CONCURRENCY, BULK_QUEUE)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        streaming = scope["path"] in STREAMING_ROUTES
+        step = STREAMING_ROUTES.get(scope["path"]) or ADMISSION_ROUTES.get(
+            scope["path"]
+        )
+        if step is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = {name.lower(): value for name, value in scope["headers"]}
+        if streaming and headers.get(b"content-type", b"").startswith(b"text/csv"):
+            await self._run(self.bulk, scope, receive, send)
+            return
+
+        content_length = headers.get(b"content-length")
+        cost = estimate_cost(
+            step, int(content_length) if content_length is not None else None
+        )
+
+        if cost is not None and cost > ADMISSION_MAX_COST:
+            response = await self._over_budget(scope, receive, headers, step, cost)
+            await response(scope, receive, send)
+            return
+
+        # Requests of unknown size are treated as bulk
+        lane = (
+            self.interactive
+            if not streaming and cost is not None and cost <= INTERACTIVE_MAX_COST
+            else self.bulk
+        )
+        await self._run(lane, scope, receive, send)
+
+    async def _run(self, lane, scope, receive, send):
+        with span("admission.wait", lane=lane.name) as wait_span:
+            acquired = await lane.acquire()
+            if wait_span is not None:
+                wait_span.attributes["admitted"] = acquired
+        if not acquired:
+            response = JSONResponse(
+                {"detail": f"too many {lane.name} requests are waiting, retry later."},
+                status_code=429,
+                headers={"Retry-After": str(RETRY_AFTER)},
+            )
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            lane.release()
+
+    async def _over_budget(self, scope, receive, headers, step, cost):
+        jobs_path = f"/jobs/{step}/"
+        # Only the batch prediction endpoints of a step can be queued as its jobs
+        path = scope["path"]
+        batch_prediction = path.startswith(f"/{step}_") and path.endswith(
+            "_prediction/"
+        )
+        if batch_prediction and b"respond-async" in headers.get(b"prefer", b""):
+            content_type = headers.get(b"content-type", b"").decode()
+            try:
+                job = await submit_job(step, content_type, _body_chunks(receive))
+            except HTTPException as error:
+                return JSONResponse(
+                    {"detail": error.detail}, status_code=error.status_code
+                )
+            return JSONResponse(
+                job,
+                status_code=202,
+                headers={"Location": f"/jobs/{job['id']}/"},
+            )
+
+        detail = (
+            f"the estimated cost of this request ({cost:.0f}) is over the "
+            f"limit of {ADMISSION_MAX_COST:.0f}. "
+        )
+        if batch_prediction:
+            detail += (
+                f"Split it into smaller requests, submit it to {jobs_path} or send "
+                "it with a 'Prefer: respond-async' header to queue it as a batch job."
+            )
+        elif path in STREAMING_ROUTES:
+            detail += "Send it as CSV (Content-Type: text/csv), which is read as it streams in."
+        else:
+            detail += "Split it into smaller requests."
+        return JSONResponse({"detail": detail}, status_code=413)
@@ -0,0 +1,273 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+
+# Steps whose decisions are recorded in the audit log, comma separated
+AUDIT_STEPS = {
+    step.strip()
+    for step in os.environ.get("LOAN_AUDIT_STEPS", "step1,step2").split(",")
+    if step.strip()
+}
+
+# Directory holding the audit database
+AUDIT_DIR = os.environ.get("LOAN_AUDIT_DIR", "audit")
+
+# Loans a worker may hold in memory waiting to be written, across all requests
+AUDIT_MAX_PENDING_ROWS = int(os.environ.get("LOAN_AUDIT_MAX_PENDING_ROWS", 100000))
+
+# The writer commits once this many loans are waiting, or every AUDIT_FLUSH_SECONDS
+AUDIT_BATCH_ROWS = 1000
+AUDIT_FLUSH_SECONDS = 1.0
+
+# What to do with a request when the queue is full: "drop" its audit records at
+# once, or "block" the request for up to AUDIT_BLOCK_SECONDS before dropping them
+AUDIT_POLICY = os.environ.get("LOAN_AUDIT_POLICY", "drop")
+AUDIT_BLOCK_SECONDS = float(os.environ.get("LOAN_AUDIT_BLOCK_SECONDS", 0.05))
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS audit (
+            id INTEGER PRIMARY KEY,
+            created_at REAL NOT NULL,
+            request_id TEXT NOT NULL,
+            row INTEGER NOT NULL,
+            step TEXT NOT NULL,
+            model_version TEXT NOT NULL,
+            input_hash TEXT NOT NULL,
+            output TEXT NOT NULL,
+            latency_ms REAL NOT NULL
+        )
+        """
+    )
+    connection.commit()
+    return connection
+
+
+class AuditLog:
+    """
+    Bounded in-memory queue of scored batches, written to SQLite in bulk by a
+    background thread.
+
+    Requests only append a reference to their feature rows and results; hashing
+    the inputs, serialising the outputs and writing them all happen in the writer
+    thread, one transaction per flush. The queue holds at most `max_rows` loans,
+    counted until they are committed. A request that does not fit is dropped, or
+    first waits up to AUDIT_BLOCK_SECONDS with the "block" policy, and every
+    dropped loan is counted.
+    """
+
+    def __init__(
+        self,
+        path,
+        max_rows=AUDIT_MAX_PENDING_ROWS,
+        batch_rows=AUDIT_BATCH_ROWS,
+        flush_seconds=AUDIT_FLUSH_SECONDS,
+        policy=AUDIT_POLICY,
+        block_seconds=AUDIT_BLOCK_SECONDS,
+    ):
+        if policy not in ("drop", "block"):
+            raise ValueError(f"unknown audit policy {policy!r}, use drop or block.")
+        self.path = path
+        self.max_rows = max_rows
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.policy = policy
+        self.block_seconds = block_seconds
+        self.condition = threading.Condition()
+        self.pending = deque()
+        self.pending_rows = 0
+        self.written_rows = 0
+        self.dropped_rows = 0
+        self.failed_rows = 0
+        self.model_versions = {}
+        self.writer = None
+        self.writer_pid = None
+        self.closing = False
+
+    def submit(self, step, frame, inverse, results, latency_ms):
+        """
+        Queue the decisions of a scored batch.
+
+        Args:
+        step: The name of the prediction step (e.g. "step1").
+        frame: The DataFrame of the unique feature rows that were scored.
+        inverse: The position of every loan of the batch in `frame`.
+        results: The response of the batch, one result per loan.
+        latency_ms: The time taken to score the batch, in milliseconds.
+
+        Returns:
+        True if the batch was queued, False if its records were dropped.
+        """
+        rows = len(inverse)
+        with self.condition:
+            self._ensure_writer()
+            if self.policy == "block":
+                self.condition.wait_for(
+                    lambda: self.pending_rows + rows <= self.max_rows,
+                    timeout=self.block_seconds,
+                )
+            if self.pending_rows + rows > self.max_rows:
+                self.dropped_rows += rows
+                return False
+
+            self.pending.append(
+                (
+                    time.time(),
+                    uuid.uuid4().hex,
+                    step,
+                    frame,
+                    inverse,
+                    results,
+                    latency_ms,
+                )
+            )
+            self.pending_rows += rows
+            if self.pending_rows >= self.batch_rows:
+                self.condition.notify_all()
+        return True
+
+    def _ensure_writer(self):
+        # Worker processes forked after the first request need their own thread
+        if self.writer_pid == os.getpid() and self.writer.is_alive():
+            return
+        self.writer = threading.Thread(target=self._run, daemon=True)
+        self.writer_pid = os.getpid()
+        self.writer.start()
+
+    def _run(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        connection = _connect(self.path)
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.closing or self.pending_rows >= self.batch_rows,
+                    timeout=self.flush_seconds,
+                )
+                batches = list(self.pending)
+                self.pending.clear()
+                closing = self.closing
+
+            rows = sum(len(batch[4]) for batch in batches)
+            try:
+                if batches:
+                    self._write(connection, batches)
+            except Exception:
+                failed = True
+            else:
+                failed = False
+
+            # Written loans only leave the memory budget once committed
+            with self.condition:
+                self.pending_rows -= rows
+                if failed:
+                    self.failed_rows += rows
+                else:
+                    self.written_rows += rows
+                self.condition.notify_all()
+                done = closing and not self.pending
+            if done:
+                connection.close()
+                return
+
+    def _model_version(self, step):
+        if step not in self.model_versions:
+            from prediction.steps import STEPS, file_sha256
+
+            self.model_versions[step] = file_sha256(STEPS[step]["model_path"])
+        return self.model_versions[step]
+
+    def _write(self, connection, batches):
+        from prediction.predictions import hash_rows
+
+        records = []
+        for created_at, request_id, step, frame, inverse, results, latency in batches:
+            row_hashes = [f"{h:016x}" for h in hash_rows(frame).tolist()]
+            model_version = self._model_version(step)
+            for row, unique_row in enumerate(inverse.tolist()):
+                records.append(
+                    (
+                        created_at,
+                        request_id,
+                        row,
+                        step,
+                        model_version,
+                        row_hashes[unique_row],
+                        json.dumps(results[row]),
+                        latency,
+                    )
+                )
+        with connection:
+            connection.executemany(
+                "INSERT INTO audit (created_at, request_id, row, step, model_version, "
+                "input_hash, output, latency_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                records,
+            )
+
+    def close(self, timeout=10):
+        """
+        Write the queued batches and stop the writer thread.
+        """
+        with self.condition:
+            if self.writer is None or self.writer_pid != os.getpid():
+                return
+            self.closing = True
+            self.condition.notify_all()
+        self.writer.join(timeout)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "policy": self.policy,
+                "pending_rows": self.pending_rows,
+                "written_rows": self.written_rows,
+                "dropped_rows": self.dropped_rows,
+                "failed_rows": self.failed_rows,
+            }
+
+
+# Audit log of this worker process, created on the first audited request
+_audit_log = None
+_audit_lock = threading.Lock()
+
+
+def get_audit_log():
+    global _audit_log
+    with _audit_lock:
+        if _audit_log is None:
+            _audit_log = AuditLog(os.path.join(AUDIT_DIR, "audit.sqlite3"))
+            atexit.register(_audit_log.close)
+        return _audit_log
+
+
+def record_audit(step, frame, inverse, results, started):
+    """
+    Queue the decisions of a scored batch for the audit log, if its step is audited.
+
+    Args:
+    step: The name of the prediction step (e.g. "step1").
+    frame: The DataFrame of the unique feature rows that were scored.
+    inverse: The position of every loan of the batch in `frame`.
+    results: The response of the batch, one result per loan.
+    started: The time.perf_counter() value when scoring started.
+    """
+    if step not in AUDIT_STEPS:
+        return
+    latency_ms = (time.perf_counter() - started) * 1000
+    get_audit_log().submit(step, frame, inverse, results, latency_ms)
+
+
+def get_audit_stats():
+    """
+    Returns the queue and write counters of the audit log of this worker.
+    """
+    return get_audit_log().stats()
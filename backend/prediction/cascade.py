@@ -0,0 +1,100 @@
+import copy
+import os
+
+import numpy as np
+from sklearn.impute import KNNImputer, SimpleImputer
+
+from prediction.metrics import record_cascade
+
+# Serve the subgrade step with a cheap first stage, and score again with the full
+# model only the loans the first stage is unsure of
+SUBGRADE_CASCADE = os.environ.get("LOAN_SUBGRADE_CASCADE", "") == "1"
+
+# Loans with missing values whose most probable first-stage class is below this
+# probability go to the full model; see benchmarks/subgrade_cascade.py
+CASCADE_THRESHOLD = float(os.environ.get("LOAN_CASCADE_THRESHOLD", 0.35))
+
+
+def _knn_imputers(model):
+    """
+    Yields the column pipelines of the ColumnTransformer of a pipeline that start
+    with a KNNImputer, with the input columns of each of them.
+    """
+    preprocessor = model.steps[0][1]
+    for _, transformer, columns in getattr(preprocessor, "transformers_", []):
+        steps = getattr(transformer, "steps", None)
+        if steps and isinstance(steps[0][1], KNNImputer):
+            yield transformer, list(columns)
+
+
+def build_first_stage(model):
+    """
+    Build the first stage of a cascade from a fitted pipeline: a copy of it whose
+    KNNImputers fill missing values with the mean of the training rows they keep,
+    instead of the mean of their nearest neighbours among them.
+
+    Returns:
+    A tuple of the first-stage pipeline and the columns its imputers read, or
+    None when the pipeline has no KNNImputer to replace.
+    """
+    if not hasattr(model, "steps"):
+        return None
+    first_stage = copy.deepcopy(model)
+    columns = []
+    for transformer, transformer_columns in _knn_imputers(first_stage):
+        name, imputer = transformer.steps[0]
+        transformer.steps[0] = (
+            name,
+            SimpleImputer(strategy="mean").fit(imputer._fit_X),
+        )
+        columns.extend(transformer_columns)
+    if not columns:
+        return None
+    return first_stage, columns
+
+
+class ModelCascade:
+    """
+    Scores every loan with a cheap first stage and only the loans it is unsure of
+    with the full pipeline, behind the predict and predict_proba interface of the
+    joblib model.
+
+    Nearest-neighbour imputation dominates the cost of the pipeline, and it only
+    changes loans with missing values. The first stage imputes them with the
+    training mean instead, so it gives the same probabilities as the full model
+    for complete loans. Loans with a missing value go to the full model when the
+    most probable class of the first stage is below `threshold`. Both stages
+    score their loans in one batch.
+    """
+
+    def __init__(self, step, model, first_stage, columns, threshold=CASCADE_THRESHOLD):
+        self.step = step
+        self.pipeline = model
+        self.first_stage = first_stage
+        self.columns = columns
+        self.threshold = threshold
+        self.classes_ = model.classes_
+
+    def predict_proba(self, frame):
+        predicted_proba = self.first_stage.predict_proba(frame)
+        uncertain = frame[self.columns].isna().to_numpy().any(axis=1) & (
+            predicted_proba.max(axis=1) < self.threshold
+        )
+        if uncertain.any():
+            predicted_proba[uncertain] = self.pipeline.predict_proba(frame[uncertain])
+        record_cascade(self.step, len(frame), int(uncertain.sum()))
+        return predicted_proba
+
+    def predict(self, frame):
+        return np.asarray(self.classes_)[self.predict_proba(frame).argmax(axis=1)]
+
+
+def build_cascade(step, model, threshold=CASCADE_THRESHOLD):
+    """
+    Returns a ModelCascade serving a fitted pipeline, or the pipeline itself when
+    it has no nearest-neighbour imputation to skip.
+    """
+    first_stage = build_first_stage(model)
+    if first_stage is None:
+        return model
+    return ModelCascade(step, model, *first_stage, threshold=threshold)
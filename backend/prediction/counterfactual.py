@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+from prediction.mappings import ACCEPTED_REJECTED_MAPPING
+from prediction.threads import limit_threads
+
+# Largest number of model calls spent on a single counterfactual search
+COUNTERFACTUAL_CALL_BUDGET = 6
+
+# The search stops refining once the loan amount is known to within this many dollars
+COUNTERFACTUAL_RESOLUTION = 1.0
+
+
+def _score_candidates(model, base, loan_amnts, dtis):
+    """
+    Score many loan amount and debt-to-income candidates of one applicant in one call.
+
+    Returns:
+    A tuple of the accepted mask and the acceptance probability of every candidate.
+    """
+    frame = base.loc[base.index.repeat(len(loan_amnts))].reset_index(drop=True)
+    frame["loan_amnt"] = loan_amnts
+    frame["dti"] = dtis
+
+    with limit_threads(model, len(frame)):
+        predicted_proba = model.predict_proba(frame)
+    classes = list(model.classes_)
+    accepted = np.asarray(model.classes_)[predicted_proba.argmax(axis=1)] == 1
+    return accepted, predicted_proba[:, classes.index(1)]
+
+
+def search_counterfactual(model, query):
+    """
+    Search the loan amount closest to the requested one that the step 1 model
+    accepts, optionally for a range of lower debt-to-income ratios as well.
+
+    Every model call evaluates a grid of candidate amounts for all searched
+    debt-to-income ratios at once. The next call refines the grid between the
+    accepted candidate closest to the requested amount and its rejected neighbour,
+    until the call budget is spent or the boundary is found to the resolution.
+
+    Args:
+    model: The trained acceptance model.
+    query: A CounterfactualQuery object.
+
+    Returns:
+    A dictionary with the current decision, the counterfactual loan amount at the
+    current debt-to-income ratio and, when searched, the frontier of the smallest
+    amount changes for each lower debt-to-income ratio.
+    """
+    loan = query.loan
+    base = pd.DataFrame.from_dict(loan.get_entry_dict())
+    requested = loan.loan_amnt
+
+    if query.search_dti:
+        dtis = np.linspace(loan.dti, 0, query.dti_candidates)
+    else:
+        dtis = np.array([loan.dti])
+
+    candidates = query.candidates_per_call
+    rows = np.arange(len(dtis))
+    low = np.full(len(dtis), min(query.min_loan_amnt, requested))
+    high = np.full(len(dtis), max(query.max_loan_amnt, requested))
+    best = np.full(len(dtis), np.nan)
+    best_proba = np.full(len(dtis), np.nan)
+    resolution = high - low
+    searching = np.ones(len(dtis), dtype=bool)
+
+    calls = 0
+    current_accepted, current_proba = None, None
+    while calls < COUNTERFACTUAL_CALL_BUDGET and searching.any():
+        grid = low[:, None] + (high - low)[:, None] * np.linspace(0, 1, candidates)
+        loan_amnts = grid.ravel()
+        grid_dtis = dtis.repeat(candidates)
+
+        # The first call also scores the applicant as submitted
+        if calls == 0:
+            loan_amnts = np.append(loan_amnts, requested)
+            grid_dtis = np.append(grid_dtis, loan.dti)
+
+        accepted, proba = _score_candidates(model, base, loan_amnts, grid_dtis)
+        calls += 1
+
+        if calls == 1:
+            current_accepted, current_proba = accepted[-1], proba[-1]
+            accepted, proba = accepted[:-1], proba[:-1]
+
+            # An accepted application needs no change
+            if current_accepted:
+                best[0], best_proba[0], resolution[0] = requested, current_proba, 0.0
+                break
+        accepted = accepted.reshape(grid.shape)
+        proba = proba.reshape(grid.shape)
+
+        # Keep the accepted candidate closest to the requested amount
+        distance = np.where(accepted, np.abs(grid - requested), np.inf)
+        closest = distance.argmin(axis=1)
+        found = searching & np.isfinite(distance[rows, closest])
+        improved = found & ~(np.abs(best - requested) <= distance[rows, closest])
+        best[improved] = grid[rows, closest][improved]
+        best_proba[improved] = proba[rows, closest][improved]
+
+        # Refine between the closest accepted candidate and its neighbour towards the request
+        step = np.where(grid[rows, closest] > requested, -1, 1)
+        neighbour = np.clip(closest + step, 0, candidates - 1)
+        bracket = np.sort(
+            np.stack([grid[rows, closest], grid[rows, neighbour]], axis=1), axis=1
+        )
+        resolution[found] = (bracket[:, 1] - bracket[:, 0])[found]
+        low[found], high[found] = bracket[found, 0], bracket[found, 1]
+
+        searching = (
+            found & (resolution > COUNTERFACTUAL_RESOLUTION) & (best != requested)
+        )
+
+    def point(i):
+        if np.isnan(best[i]):
+            return None
+        return {
+            "loan_amnt": float(best[i]),
+            "dti": float(dtis[i]),
+            "loan_amnt_change": float(best[i] - requested),
+            "accepted_proba": float(best_proba[i]),
+            "resolution": float(resolution[i]),
+        }
+
+    result = {
+        "Loan_Acceptance": ACCEPTED_REJECTED_MAPPING[int(current_accepted)],
+        "accepted_proba": float(current_proba),
+        "counterfactual": point(0),
+        "model_calls": calls,
+    }
+    if query.search_dti:
+        result["dti_frontier"] = [point(i) for i in rows if point(i) is not None]
+    return result
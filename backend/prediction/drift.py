@@ -0,0 +1,423 @@
+import argparse
+import glob
+import json
+import os
+import socket
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+# Directory holding the summaries of every worker process
+DRIFT_DIR = os.environ.get("LOAN_DRIFT_DIR", "drift")
+
+# Seconds between two writes of the summaries of a worker to its state file
+DRIFT_FLUSH_SECONDS = 10
+
+# Relative accuracy of the quantiles of the numeric features
+DRIFT_RELATIVE_ACCURACY = 0.02
+
+# Number of logarithmic bins per sign, covering magnitudes from e^-41 to e^41
+DRIFT_BINS = 2048
+
+# Quantiles reported for every numeric feature
+DRIFT_QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+# Population stability index above which a feature is reported as drifted
+DRIFT_PSI_THRESHOLD = 0.2
+
+# Location of the training reference summary of every step
+DRIFT_REFERENCE_PATH = "prediction/models/{step}-drift_reference.json"
+
+_GAMMA = (1 + DRIFT_RELATIVE_ACCURACY) / (1 - DRIFT_RELATIVE_ACCURACY)
+_LOG_GAMMA = np.log(_GAMMA)
+_OFFSET = DRIFT_BINS // 2
+
+# Batches with fewer values than this update the sketches in place
+_SMALL_UPDATE = 4096
+
+
+def _bin_index(magnitudes):
+    index = np.ceil(np.log(magnitudes) / _LOG_GAMMA).astype(np.int64) + _OFFSET
+    return np.clip(index, 0, DRIFT_BINS - 1)
+
+
+def _bin_value(index):
+    return 2 * _GAMMA ** (np.asarray(index) - _OFFSET) / (_GAMMA + 1)
+
+
+class StepSummary:
+    """
+    Mergeable streaming summary of the features of one step.
+
+    Numeric features are kept in logarithmic histograms (as in DDSketch), whose
+    quantiles are accurate to DRIFT_RELATIVE_ACCURACY, and categorical features
+    as category counts. Every feature also counts its rows and missing values.
+    Merging two summaries adds their counts.
+    """
+
+    def __init__(self):
+        self.rows = Counter()
+        self.nulls = Counter()
+        self.sums = Counter()
+        self.numeric = {}
+        self.positive = np.zeros((0, DRIFT_BINS), dtype=np.int64)
+        self.negative = np.zeros((0, DRIFT_BINS), dtype=np.int64)
+        self.zeros = np.zeros(0, dtype=np.int64)
+        self.categories = {}
+        self.kinds = {}
+
+    def _feature_ids(self, columns):
+        new = [column for column in columns if column not in self.numeric]
+        if new:
+            for column in new:
+                self.numeric[column] = len(self.numeric)
+            grow = np.zeros((len(new), DRIFT_BINS), dtype=np.int64)
+            self.positive = np.vstack([self.positive, grow])
+            self.negative = np.vstack([self.negative, grow])
+            self.zeros = np.concatenate([self.zeros, np.zeros(len(new), np.int64)])
+        return np.array([self.numeric[column] for column in columns], dtype=np.int64)
+
+    def _add_bins(self, histogram, features, bins):
+        if len(bins) < _SMALL_UPDATE:
+            np.add.at(histogram, (features, bins), 1)
+        else:
+            histogram += np.bincount(
+                features * DRIFT_BINS + bins, minlength=histogram.size
+            ).reshape(histogram.shape)
+
+    def update(self, frame):
+        """
+        Add the rows of a batch, one vectorised pass for all numeric features.
+        """
+        columns = list(frame.columns)
+        if len(frame) < _SMALL_UPDATE:
+            # One object array avoids the per-column overhead of pandas on small batches
+            block = frame.to_numpy(dtype=object)
+            values = list(block.T)
+            missing = list(pd.isna(block).T)
+        else:
+            block = None
+            values = [frame[column].to_numpy() for column in columns]
+            missing = [pd.isna(array) for array in values]
+
+        null_counts = [int(mask.sum()) for mask in missing]
+        for column, nulls in zip(columns, null_counts):
+            self.rows[column] += len(frame)
+            self.nulls[column] += nulls
+
+        # Columns are classified from the first batch where they have values
+        for position, column in enumerate(columns):
+            if column not in self.kinds and null_counts[position] < len(frame):
+                dtype = frame[column].dtype
+                self.kinds[column] = (
+                    pd.api.types.is_numeric_dtype(dtype) and dtype != bool
+                )
+
+        numeric_positions = [i for i, c in enumerate(columns) if self.kinds.get(c)]
+        if numeric_positions:
+            numeric_columns = [columns[i] for i in numeric_positions]
+            if block is not None:
+                numeric = block[:, numeric_positions].astype(np.float64)
+            else:
+                numeric = np.column_stack([values[i] for i in numeric_positions])
+                numeric = numeric.astype(np.float64)
+            sums = np.nansum(numeric, axis=0)
+            for column, total in zip(numeric_columns, sums.tolist()):
+                self.sums[column] += total
+
+            ids = self._feature_ids(numeric_columns)
+            rows, positions = np.nonzero(numeric > 0)
+            self._add_bins(
+                self.positive, ids[positions], _bin_index(numeric[rows, positions])
+            )
+            rows, positions = np.nonzero(numeric < 0)
+            if len(rows):
+                self._add_bins(
+                    self.negative, ids[positions], _bin_index(-numeric[rows, positions])
+                )
+            self.zeros[ids] += (numeric == 0).sum(axis=0)
+
+        for position, column in enumerate(columns):
+            if self.kinds.get(column, True):
+                continue
+            present = values[position][~missing[position]]
+            counts = self.categories.setdefault(column, Counter())
+            if len(present) < _SMALL_UPDATE:
+                counts.update(map(str, present))
+            else:
+                keys, key_counts = np.unique(present.astype(str), return_counts=True)
+                counts.update(dict(zip(keys.tolist(), key_counts.tolist())))
+
+    def merge(self, other):
+        """
+        Add the counts of another summary to this one.
+        """
+        self.rows.update(other.rows)
+        self.nulls.update(other.nulls)
+        self.sums.update(other.sums)
+        if other.numeric:
+            columns = list(other.numeric)
+            ids = self._feature_ids(columns)
+            order = [other.numeric[column] for column in columns]
+            self.positive[ids] += other.positive[order]
+            self.negative[ids] += other.negative[order]
+            self.zeros[ids] += other.zeros[order]
+        for column, counts in other.categories.items():
+            self.categories.setdefault(column, Counter()).update(counts)
+        self.kinds.update(other.kinds)
+
+    def distribution(self, column):
+        """
+        Returns the sorted representative values of a numeric feature and their counts.
+        """
+        feature = self.numeric[column]
+        negative = np.nonzero(self.negative[feature])[0][::-1]
+        positive = np.nonzero(self.positive[feature])[0]
+        values = np.concatenate([-_bin_value(negative), [0.0], _bin_value(positive)])
+        counts = np.concatenate(
+            [
+                self.negative[feature, negative],
+                [self.zeros[feature]],
+                self.positive[feature, positive],
+            ]
+        )
+        return values, counts
+
+    def quantiles(self, column, quantiles=DRIFT_QUANTILES):
+        values, counts = self.distribution(column)
+        total = counts.sum()
+        if total == 0:
+            return {str(q): None for q in quantiles}
+        cumulative = np.cumsum(counts)
+        positions = np.searchsorted(cumulative, np.asarray(quantiles) * total, "left")
+        return {
+            str(q): float(values[min(i, len(values) - 1)])
+            for q, i in zip(quantiles, positions)
+        }
+
+    def cdf(self, column, points):
+        """
+        Returns the share of the non-missing values of a feature at or below each point.
+        """
+        values, counts = self.distribution(column)
+        cumulative = np.concatenate([[0], np.cumsum(counts)])
+        total = max(cumulative[-1], 1)
+        return cumulative[np.searchsorted(values, points, side="right")] / total
+
+    def to_dict(self):
+        numeric = {}
+        for column, feature in self.numeric.items():
+            positive = np.nonzero(self.positive[feature])[0]
+            negative = np.nonzero(self.negative[feature])[0]
+            numeric[column] = {
+                "positive": [
+                    positive.tolist(),
+                    self.positive[feature, positive].tolist(),
+                ],
+                "negative": [
+                    negative.tolist(),
+                    self.negative[feature, negative].tolist(),
+                ],
+                "zeros": int(self.zeros[feature]),
+            }
+        return {
+            "rows": dict(self.rows),
+            "nulls": dict(self.nulls),
+            "sums": dict(self.sums),
+            "numeric": numeric,
+            "categories": {
+                column: dict(counts) for column, counts in self.categories.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls()
+        summary.rows.update(data["rows"])
+        summary.nulls.update(data["nulls"])
+        summary.sums.update(data["sums"])
+        ids = summary._feature_ids(list(data["numeric"]))
+        for feature, histograms in zip(ids, data["numeric"].values()):
+            bins, counts = histograms["positive"]
+            summary.positive[feature, bins] = counts
+            bins, counts = histograms["negative"]
+            summary.negative[feature, bins] = counts
+            summary.zeros[feature] = histograms["zeros"]
+        for column, counts in data["categories"].items():
+            summary.categories[column] = Counter(counts)
+        summary.kinds.update({column: True for column in summary.numeric})
+        summary.kinds.update({column: False for column in summary.categories})
+        return summary
+
+
+def population_stability(expected, actual):
+    """
+    Returns the population stability index of two distributions given as shares.
+    """
+    expected = np.clip(np.asarray(expected, dtype=float), 1e-4, None)
+    actual = np.clip(np.asarray(actual, dtype=float), 1e-4, None)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def feature_psi(reference, summary, column):
+    """
+    Compare a feature of the live summary with the training reference, on the
+    deciles of the reference for numeric features and on the categories otherwise.
+    """
+    if column in reference.numeric and column in summary.numeric:
+        edges = np.unique(
+            list(reference.quantiles(column, np.linspace(0.1, 0.9, 9)).values())
+        )
+        expected = np.diff(np.concatenate([[0], reference.cdf(column, edges), [1]]))
+        actual = np.diff(np.concatenate([[0], summary.cdf(column, edges), [1]]))
+        return population_stability(expected, actual)
+
+    if column in reference.categories and column in summary.categories:
+        categories = sorted(
+            set(reference.categories[column]) | set(summary.categories[column])
+        )
+        shares = []
+        for counts in (reference.categories[column], summary.categories[column]):
+            total = max(sum(counts.values()), 1)
+            shares.append([counts.get(category, 0) / total for category in categories])
+        return population_stability(*shares)
+    return None
+
+
+# Summaries of the batches scored by this worker process, keyed by step
+DRIFT_SUMMARIES = {}
+
+_drift_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def _state_path():
+    return os.path.join(DRIFT_DIR, f"{socket.gethostname()}-{os.getpid()}.json")
+
+
+def flush_drift():
+    """
+    Write the summaries of this worker to its state file for the other workers.
+    """
+    global _last_flush
+    with _drift_lock:
+        state = {step: summary.to_dict() for step, summary in DRIFT_SUMMARIES.items()}
+        _last_flush = time.monotonic()
+    if not state:
+        return
+    os.makedirs(DRIFT_DIR, exist_ok=True)
+    path = _state_path()
+    with open(f"{path}.tmp", "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(f"{path}.tmp", path)
+
+
+def record_drift(step, frame):
+    """
+    Add a scored batch to the feature summaries of its step.
+
+    Args:
+    step: The name of the prediction step (e.g. "step1").
+    frame: The model-ready DataFrame of the batch, duplicates included.
+    """
+    with _drift_lock:
+        DRIFT_SUMMARIES.setdefault(step, StepSummary()).update(frame)
+        due = time.monotonic() - _last_flush > DRIFT_FLUSH_SECONDS
+    if due:
+        flush_drift()
+
+
+def merged_summaries():
+    """
+    Returns the summaries of all worker processes merged per step.
+    """
+    flush_drift()
+    merged = {}
+    for path in glob.glob(os.path.join(DRIFT_DIR, "*.json")):
+        with open(path) as state_file:
+            state = json.load(state_file)
+        for step, data in state.items():
+            merged.setdefault(step, StepSummary()).merge(StepSummary.from_dict(data))
+    return merged
+
+
+def load_reference(step):
+    """
+    Returns the training reference summary of a step, or None if there is none.
+    """
+    path = DRIFT_REFERENCE_PATH.format(step=step)
+    if not os.path.exists(path):
+        return None
+    with open(path) as reference_file:
+        return StepSummary.from_dict(json.load(reference_file))
+
+
+def get_drift_report():
+    """
+    Returns, for every step and feature, the row count, the null rate and either
+    the quantiles or the category shares, with the population stability index
+    against the training reference when there is one.
+    """
+    report = {}
+    for step, summary in sorted(merged_summaries().items()):
+        reference = load_reference(step)
+        features = {}
+        for column, rows in summary.rows.items():
+            feature = {
+                "rows": rows,
+                "null_rate": summary.nulls[column] / rows if rows else 0.0,
+            }
+            present = rows - summary.nulls[column]
+            if column in summary.numeric:
+                feature["mean"] = summary.sums[column] / present if present else None
+                feature["quantiles"] = summary.quantiles(column)
+            if column in summary.categories:
+                counts = summary.categories[column]
+                total = max(sum(counts.values()), 1)
+                feature["categories"] = {
+                    category: count / total for category, count in counts.most_common()
+                }
+
+            if reference is not None:
+                psi = feature_psi(reference, summary, column)
+                feature["psi"] = psi
+                feature["drifted"] = psi is not None and psi > DRIFT_PSI_THRESHOLD
+            features[column] = feature
+
+        report[step] = {
+            "rows": max(summary.rows.values(), default=0),
+            "reference": reference is not None,
+            "features": features,
+        }
+    return report
+
+
+if __name__ == "__main__":
+    from prediction.predictions import build_batch_frame
+    from prediction.steps import STEPS
+
+    parser = argparse.ArgumentParser(
+        description="Build the training reference summary of a step from a CSV file."
+    )
+    parser.add_argument("step", choices=list(STEPS))
+    parser.add_argument("training_csv")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    loan_class = STEPS[args.step]["loan_class"]
+    reference = StepSummary()
+    for chunk in pd.read_csv(args.training_csv, chunksize=args.chunk_size):
+        records = chunk.to_dict(orient="records")
+        reference.update(
+            build_batch_frame([loan_class(**record) for record in records])
+        )
+
+    path = DRIFT_REFERENCE_PATH.format(step=args.step)
+    with open(path, "w") as reference_file:
+        json.dump(reference.to_dict(), reference_file)
+    print(
+        f"Saved the reference summary of {max(reference.rows.values())} rows to {path}."
+    )
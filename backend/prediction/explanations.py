@@ -0,0 +1,291 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from prediction.mappings import GRADES_MAPPING, SUB_GRADE_MAPPING
+from prediction.predictions import build_batch_frame, deduplicate_batch, hash_rows
+
+# Number of explained feature rows kept per model
+EXPLANATION_CACHE_SIZE = 10000
+
+# Explainers built so far, keyed by the id of the model they explain
+_explainers = {}
+
+_explainers_lock = threading.Lock()
+
+
+def _source_columns(preprocessor):
+    """
+    Map every output feature of a fitted ColumnTransformer back to its input column.
+
+    Args:
+    preprocessor: A fitted ColumnTransformer.
+
+    Returns:
+    A tuple of the list of input columns and a (n_output_features, n_input_columns)
+    matrix that sums the output features of each input column.
+    """
+    sources = []
+    for _, transformer, columns in preprocessor.transformers_:
+        if isinstance(transformer, str):
+            if transformer == "drop":
+                continue
+            columns = [
+                preprocessor.feature_names_in_[column]
+                if isinstance(column, (int, np.integer))
+                else column
+                for column in columns
+            ]
+            sources.extend(columns)
+            continue
+
+        names = transformer.get_feature_names_out(columns)
+        if len(names) == len(columns):
+            sources.extend(columns)
+            continue
+
+        # Encoders that expand a column name their features "<column>_<category>"
+        for name in names:
+            sources.append(
+                max(
+                    (column for column in columns if name.startswith(f"{column}_")),
+                    key=len,
+                )
+            )
+
+    input_columns = list(dict.fromkeys(sources))
+    aggregation = np.zeros((len(sources), len(input_columns)))
+    for i, column in enumerate(sources):
+        aggregation[i, input_columns.index(column)] = 1.0
+    return input_columns, aggregation
+
+
+class UnsupportedModelError(ValueError):
+    """
+    Raised when a model is of a kind its predictions cannot be explained for.
+    """
+
+
+class ModelExplainer:
+    """
+    Computes per-feature contributions to the predicted class of a fitted pipeline.
+
+    Contributions are expressed in the raw score (log-odds) space of the estimator,
+    so that the base value plus the contributions of a row give its raw score.
+    Tree estimators use the native LightGBM/XGBoost contribution computation,
+    linear estimators are explained exactly against the training mean.
+    """
+
+    def __init__(self, model):
+        # Models served with ONNX Runtime are explained from their joblib pipeline
+        model = getattr(model, "pipeline", model)
+        if not hasattr(model, "steps"):
+            raise UnsupportedModelError(
+                "explanations require the estimator in the web worker, not in a shared inference process."
+            )
+
+        # Samplers only run while fitting, so they are skipped as in predict
+        transforms = [
+            step for _, step in model.steps[:-1] if not hasattr(step, "fit_resample")
+        ]
+        estimator = model.steps[-1][1]
+
+        if not transforms or not hasattr(transforms[0], "transformers_"):
+            raise UnsupportedModelError(
+                "expected the pipeline to start with a ColumnTransformer."
+            )
+
+        self.preprocessor = transforms[0]
+        self.columns, self.aggregation = _source_columns(self.preprocessor)
+        self.classes = estimator.classes_
+        self.estimator = estimator
+        projections = transforms[1:]
+
+        if hasattr(estimator, "booster_") or hasattr(estimator, "get_booster"):
+            if projections:
+                raise UnsupportedModelError(
+                    "tree explanations require the estimator to use the preprocessed features."
+                )
+            self.kind = "tree"
+        elif hasattr(estimator, "coef_"):
+            # Fold a linear projection (PCA) into the weights of the estimator and
+            # use its mean, the training mean of the features, as the background
+            weights = np.atleast_2d(estimator.coef_)
+            intercept = np.atleast_1d(estimator.intercept_)
+            background = np.zeros(self.aggregation.shape[0])
+            if len(projections) > 1:
+                raise UnsupportedModelError(
+                    "expected at most one projection before the model."
+                )
+            for projection in projections:
+                if not hasattr(projection, "components_") or getattr(
+                    projection, "whiten", False
+                ):
+                    raise UnsupportedModelError(
+                        f"cannot explain through {type(projection).__name__}."
+                    )
+                weights = weights @ projection.components_
+                background = projection.mean_
+
+            # Binary models score the positive class only
+            if weights.shape[0] == 1:
+                weights = np.vstack([-weights / 2, weights / 2])
+                intercept = np.concatenate([-intercept / 2, intercept / 2])
+
+            self.weights = weights
+            self.intercept = intercept
+            self.background = background
+            self.kind = "linear"
+        else:
+            raise UnsupportedModelError(
+                f"cannot explain {type(estimator).__name__} models."
+            )
+
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _tree_contributions(self, features):
+        if hasattr(self.estimator, "booster_"):
+            raw = self.estimator.booster_.predict(features, pred_contrib=True)
+        else:
+            import xgboost
+
+            raw = self.estimator.get_booster().predict(
+                xgboost.DMatrix(features), pred_contribs=True
+            )
+
+        # Both libraries return (rows, classes, features + bias) in class-major order
+        raw = np.asarray(raw).reshape(len(features), -1, features.shape[1] + 1)
+        if raw.shape[1] == 1:
+            raw = np.concatenate([-raw / 2, raw / 2], axis=1)
+
+        predicted = raw.sum(axis=2).argmax(axis=1)
+        chosen = raw[np.arange(len(features)), predicted]
+        return predicted, chosen[:, -1], chosen[:, :-1]
+
+    def _linear_contributions(self, features):
+        centered = features - self.background
+        predicted = (centered @ self.weights.T + self.intercept).argmax(axis=1)
+        return predicted, self.intercept[predicted], centered * self.weights[predicted]
+
+    def explain(self, frame):
+        """
+        Explain the rows of a DataFrame of unique loans, reusing cached explanations.
+
+        Args:
+        frame: A DataFrame with one model-ready row per loan.
+
+        Returns:
+        A tuple of the predicted class indices, the base values and the
+        (rows, input columns) matrix of contributions.
+        """
+        row_hashes = hash_rows(frame).tolist()
+        predicted = np.zeros(len(frame), dtype=int)
+        base_values = np.zeros(len(frame))
+        contributions = np.zeros((len(frame), len(self.columns)))
+
+        with self._cache_lock:
+            missing = []
+            for i, row_hash in enumerate(row_hashes):
+                cached = self._cache.get(row_hash)
+                if cached is None:
+                    missing.append(i)
+                    continue
+                self._cache.move_to_end(row_hash)
+                predicted[i], base_values[i], contributions[i] = cached
+
+        # Compute every missing explanation in a single batch
+        if missing:
+            features = self.preprocessor.transform(frame.iloc[missing])
+            if hasattr(features, "toarray"):
+                features = features.toarray()
+            features = np.asarray(features, dtype=float)
+
+            if self.kind == "tree":
+                batch = self._tree_contributions(features)
+            else:
+                batch = self._linear_contributions(features)
+            batch_predicted, batch_base, batch_contributions = batch
+            batch_contributions = batch_contributions @ self.aggregation
+
+            predicted[missing] = batch_predicted
+            base_values[missing] = batch_base
+            contributions[missing] = batch_contributions
+
+            with self._cache_lock:
+                for i in missing:
+                    self._cache[row_hashes[i]] = (
+                        predicted[i],
+                        base_values[i],
+                        contributions[i],
+                    )
+                while len(self._cache) > EXPLANATION_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+
+        return predicted, base_values, contributions
+
+
+def get_explainer(model):
+    """
+    Returns the explainer of a model, building its background statistics on first use.
+    """
+    with _explainers_lock:
+        explainer = _explainers.get(id(model))
+        if explainer is None:
+            explainer = ModelExplainer(model)
+            _explainers[id(model)] = explainer
+        return explainer
+
+
+def explain_predictions(model, loans, mapping, label):
+    """
+    Explain the predicted class of every loan in a batch.
+
+    Args:
+    model: A trained machine learning pipeline.
+    loans: A list of Loan objects.
+    mapping: A dictionary mapping the model classes to their labels.
+    label: The name of the predicted label in the results.
+
+    Returns:
+    A dictionary containing the predicted label, the base value and the
+    contribution of every input feature, largest first, for each loan.
+    """
+    if not loans:
+        return {}
+
+    explainer = get_explainer(model)
+    unique_entries, inverse = deduplicate_batch(build_batch_frame(loans))
+    predicted, base_values, contributions = explainer.explain(unique_entries)
+
+    # Format every unique row once and share it between its duplicates
+    explanations = []
+    for row_predicted, row_base, row_contributions in zip(
+        predicted.tolist(), base_values.tolist(), contributions
+    ):
+        order = np.argsort(-np.abs(row_contributions), kind="stable")
+        explanations.append(
+            {
+                label: mapping[explainer.classes[row_predicted]],
+                "base_value": row_base,
+                "contributions": {
+                    explainer.columns[j]: float(row_contributions[j]) for j in order
+                },
+            }
+        )
+
+    return {i: explanations[unique_i] for i, unique_i in enumerate(inverse.tolist())}
+
+
+def explain_grade(model, loans):
+    """
+    Explain the predicted grade of every loan in a batch.
+    """
+    return explain_predictions(model, loans, GRADES_MAPPING, "predicted_grade")
+
+
+def explain_subgrade(model, loans):
+    """
+    Explain the predicted subgrade of every loan in a batch.
+    """
+    return explain_predictions(model, loans, SUB_GRADE_MAPPING, "predicted_subgrade")
@@ -0,0 +1,101 @@
+import numpy as np
+
+# Bins and labels of the loan size categories used by the models
+LOAN_SIZE_BINS = [0, 5000, 10000, 20000, 30000, 40000, float("inf")]
+LOAN_SIZE_LABELS = ["< 5K", "5K - 10K", "10K - 20K", "20K - 30K", "30K - 40K", ">= 40K"]
+
+# Bins and labels of the debt-to-income categories used by the models
+DTI_BINS = [0, 15, 25, float("inf")]
+DTI_LABELS = ["DTI < 15%", "15% <= DTI <= 25%", "DTI > 25%"]
+
+
+def _categorize(values, bins, labels):
+    # Same right-closed bins as pd.cut, without building a Categorical
+    values = np.asarray(values, dtype=float)
+    index = np.searchsorted(bins, values, side="left") - 1
+    inside = (index >= 0) & (index < len(labels)) & ~np.isnan(values)
+    categories = np.array(labels, dtype=object)[np.clip(index, 0, len(labels) - 1)]
+    categories[~inside] = None
+    return categories
+
+
+def loan_size_category(loan_amnt):
+    """
+    Vectorized version of the `loan_size_category` property of the Loan classes.
+
+    Args:
+    loan_amnt: An array-like of loan amounts.
+
+    Returns:
+    An object array of loan size labels.
+    """
+    return _categorize(loan_amnt, LOAN_SIZE_BINS, LOAN_SIZE_LABELS)
+
+
+def dti_category(dti):
+    """
+    Vectorized version of the `DTI_Category` property of the Loan classes.
+
+    Args:
+    dti: An array-like of debt-to-income ratios.
+
+    Returns:
+    An object array of debt-to-income labels.
+    """
+    return _categorize(dti, DTI_BINS, DTI_LABELS)
+
+
+def loan_to_income(loan_amnt, annual_inc_joint):
+    """
+    Vectorized version of the `LTI` property of the Loan classes.
+
+    Args:
+    loan_amnt: An array-like of loan amounts.
+    annual_inc_joint: An array-like of joint annual incomes.
+
+    Returns:
+    A float array of loan-to-income ratios.
+    """
+    loan_amnt = np.asarray(loan_amnt, dtype=float)
+    annual_inc_joint = np.asarray(annual_inc_joint, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return loan_amnt / annual_inc_joint
+
+
+def fico_average(fico_range_low, fico_range_high, zero_is_missing=False):
+    """
+    Vectorized version of the `fico_avg` and `sec_app_fico_avg` properties of the
+    Loan classes.
+
+    Args:
+    fico_range_low: An array-like of the lower bounds of the FICO range.
+    fico_range_high: An array-like of the upper bounds of the FICO range.
+    zero_is_missing: Whether a bound of 0 makes the average missing, as in the
+    properties that test the bounds for truthiness.
+
+    Returns:
+    A float array of FICO averages, NaN where they are missing.
+    """
+    fico_range_low = np.asarray(fico_range_low, dtype=float)
+    fico_range_high = np.asarray(fico_range_high, dtype=float)
+    average = (fico_range_high + fico_range_low) / 2
+    if zero_is_missing:
+        average[(fico_range_low == 0) | (fico_range_high == 0)] = np.nan
+    return average
+
+
+def fico_difference(fico_range_low, fico_range_high):
+    """
+    Vectorized version of the `fico_diff` and `sec_app_fico_diff` properties of the
+    Loan classes.
+
+    Args:
+    fico_range_low: An array-like of the lower bounds of the FICO range.
+    fico_range_high: An array-like of the upper bounds of the FICO range.
+
+    Returns:
+    A float array of FICO range widths, NaN where a bound is missing.
+    """
+    return np.asarray(fico_range_high, dtype=float) - np.asarray(
+        fico_range_low, dtype=float
+    )
@@ -0,0 +1,122 @@
+import contextlib
+import json
+
+import numpy as np
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+from pydantic.error_wrappers import ErrorWrapper
+
+from prediction.memory import MemoryStages
+from prediction.tracing import span
+
+# Media types of MessagePack request and response bodies
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+
+# Media types after which an Accept header no longer asks for MessagePack
+JSON_TYPES = ("application/json", "application/*", "*/*")
+
+
+def _media_type(header):
+    return header.split(";", 1)[0].strip().lower()
+
+
+def _msgpack():
+    # MessagePack is optional, JSON clients do not need it installed
+    try:
+        import msgpack
+    except ImportError:
+        return None
+    return msgpack
+
+
+def is_msgpack(content_type):
+    """
+    Returns whether a Content-Type header names a MessagePack body.
+    """
+    return _media_type(content_type) in MSGPACK_TYPES
+
+
+def accepts_msgpack(accept):
+    """
+    Returns whether an Accept header asks for a MessagePack response, that is,
+    lists a MessagePack media type before any JSON one, and msgpack is installed.
+    """
+    for media_type in accept.split(","):
+        media_type = _media_type(media_type)
+        if media_type in MSGPACK_TYPES:
+            return _msgpack() is not None
+        if media_type in JSON_TYPES:
+            return False
+    return False
+
+
+def decode_body(content_type, body):
+    """
+    Decode a JSON or MessagePack request body.
+
+    Args:
+    content_type: The Content-Type header of the request. Bodies are read as JSON
+    unless it names MessagePack.
+    body: The bytes of the request body.
+
+    Returns:
+    The decoded body.
+    """
+    if not is_msgpack(content_type):
+        try:
+            return json.loads(body)
+        except json.JSONDecodeError as error:
+            raise RequestValidationError(
+                [ErrorWrapper(error, ("body", error.pos))], body=error.doc
+            )
+
+    msgpack = _msgpack()
+    if msgpack is None:
+        raise HTTPException(
+            status_code=415, detail="MessagePack bodies need msgpack installed."
+        )
+    try:
+        return msgpack.unpackb(body)
+    except (ValueError, TypeError) as error:
+        # msgpack raises ValueError subclasses for malformed data, and TypeError
+        # for maps keyed by arrays or maps
+        raise RequestValidationError(
+            [ErrorWrapper(ValueError(f"invalid MessagePack - {error!r}"), ("body",))]
+        )
+
+
+def _msgpack_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    # Such as the context of validation errors, as the job results encode it
+    return str(value)
+
+
+def negotiate_response(request, content):
+    """
+    Returns the response of a prediction endpoint in the format the client asked
+    for: a MessagePack response if the Accept header of the request prefers it,
+    or a JSON response otherwise, encoded as FastAPI would encode `content`.
+    """
+    # The response is encoded here rather than by FastAPI so that its span, and
+    # the memory accounting of requests whose body was read into a LoanBatch,
+    # cover the encoding
+    step, rows = getattr(request.state, "memory_stage", (None, 0))
+    stages = MemoryStages(step, rows) if step else contextlib.nullcontext()
+    with span("response.encode") as encode_span, stages:
+        if accepts_msgpack(request.headers.get("accept", "")):
+            response = Response(
+                _msgpack().packb(content, default=_msgpack_default),
+                media_type=MSGPACK_TYPES[0],
+            )
+        else:
+            response = JSONResponse(jsonable_encoder(content))
+        if encode_span is not None:
+            encode_span.attributes["bytes"] = len(response.body)
+        if step:
+            stages.mark("encoding")
+    return response
@@ -0,0 +1,406 @@
+import argparse
+import atexit
+import json
+import os
+import selectors
+import socket
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from prediction.threads import configure_model, limit_threads
+
+# Unix sockets of the shared inference processes, comma separated. When set, the
+# web workers only build features and the estimators run in those processes.
+INFERENCE_SOCKETS = [
+    path.strip()
+    for path in os.environ.get("LOAN_INFERENCE_SOCKET", "").split(",")
+    if path.strip()
+]
+
+# Milliseconds an inference process waits for other workers' requests to batch with
+INFERENCE_BATCH_WINDOW_MS = float(os.environ.get("LOAN_INFERENCE_BATCH_WINDOW_MS", 0.5))
+
+# Initial size of the shared-memory buffer of every client, grown on demand
+INFERENCE_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def split_pipeline(model):
+    """
+    Split a fitted pipeline into the transforms run by the web workers and the
+    final estimator run by the inference process.
+
+    Args:
+    model: A trained machine learning pipeline.
+
+    Returns:
+    A tuple of the list of fitted transforms and the fitted estimator.
+    """
+    # Samplers only run while fitting, so they are skipped as in predict
+    transforms = [
+        step for _, step in model.steps[:-1] if not hasattr(step, "fit_resample")
+    ]
+    return transforms, model.steps[-1][1]
+
+
+def _attach(name):
+    segment = shared_memory.SharedMemory(name=name)
+    # The client owns the buffer; keep this process from unlinking it on exit
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+def run_estimator(estimator, method, features):
+    """
+    Score a feature matrix with an estimator.
+
+    Predicted classes are returned as their position in `classes_` so that every
+    output can be written to shared memory as floats.
+
+    Returns:
+    A (rows, outputs) array of floats.
+    """
+    if method == "predict_proba":
+        return estimator.predict_proba(features)
+
+    predicted = estimator.predict(features)
+    if hasattr(estimator, "classes_"):
+        predicted = np.searchsorted(estimator.classes_, predicted)
+    return np.asarray(predicted, dtype=np.float64).reshape(len(features), -1)
+
+
+class InferenceServer:
+    """
+    Holds the estimators of every step and scores the feature matrices that the
+    web workers place in shared memory.
+
+    Each request is a JSON line on a Unix socket naming the step, the method and
+    the shape of the features in the shared buffer of its client. Requests from
+    all clients that arrive within the batching window are scored together, one
+    estimator call per step and method, and the outputs are written back after
+    the features in each client's buffer.
+    """
+
+    def __init__(self, estimators, path, batch_window_ms=INFERENCE_BATCH_WINDOW_MS):
+        self.estimators = estimators
+        self.path = path
+        self.batch_window = batch_window_ms / 1000
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+        self.segments = {}
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen()
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ)
+
+        while True:
+            requests = self._poll(None)
+
+            # Give the other workers a moment to join the batch
+            if len(self.buffers) > 1:
+                deadline = time.monotonic() + self.batch_window
+                while (remaining := deadline - time.monotonic()) > 0:
+                    requests.extend(self._poll(remaining))
+
+            if requests:
+                self._run_batch(requests)
+
+    def _poll(self, timeout):
+        requests = []
+        for key, _ in self.selector.select(timeout):
+            if key.data is None:
+                connection, _ = key.fileobj.accept()
+                connection.setblocking(False)
+                self.selector.register(connection, selectors.EVENT_READ, data=True)
+                self.buffers[connection] = b""
+                continue
+
+            connection = key.fileobj
+            try:
+                data = connection.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                self._close(connection)
+                continue
+
+            lines = (self.buffers[connection] + data).split(b"\n")
+            self.buffers[connection] = lines.pop()
+            for line in lines:
+                try:
+                    requests.append((connection, self._parse_request(line)))
+                except ValueError as error:
+                    self._reply(connection, {"error": f"invalid request: {error}"})
+        return requests
+
+    def _parse_request(self, line):
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError("not a JSON object")
+        if request.get("step") not in self.estimators:
+            raise ValueError(f"unknown step {request.get('step')!r}")
+        if request.get("method") not in ("predict", "predict_proba"):
+            raise ValueError(f"unknown method {request.get('method')!r}")
+        if not isinstance(request.get("segment"), str):
+            raise ValueError("missing segment")
+        for name in ("rows", "cols"):
+            if not isinstance(request.get(name), int) or request[name] < 0:
+                raise ValueError(f"invalid {name}")
+        return request
+
+    def _close(self, connection):
+        if connection not in self.buffers:
+            return
+        self.selector.unregister(connection)
+        self.buffers.pop(connection, None)
+        for segment in self.segments.pop(connection, {}).values():
+            segment.close()
+        connection.close()
+
+    def _segment(self, connection, name):
+        segments = self.segments.setdefault(connection, {})
+        if name not in segments:
+            # Clients replace their buffer when it grows, release the old one
+            for old in segments.values():
+                old.close()
+            segments.clear()
+            segments[name] = _attach(name)
+        return segments[name]
+
+    def _run_batch(self, requests):
+        groups = {}
+        for connection, request in requests:
+            groups.setdefault((request["step"], request["method"]), []).append(
+                (connection, request)
+            )
+
+        for (step, method), group in groups.items():
+            attached, segments, features = [], [], []
+            for connection, request in group:
+                # Requests of a connection closed since they were read are dropped
+                if connection not in self.buffers:
+                    continue
+                try:
+                    segment = self._segment(connection, request["segment"])
+                    request_features = np.ndarray(
+                        (request["rows"], request["cols"]),
+                        dtype=np.float64,
+                        buffer=segment.buf,
+                    )
+                except (OSError, TypeError, ValueError) as error:
+                    self._reply(connection, {"error": f"invalid buffer: {error}"})
+                    continue
+                attached.append((connection, request))
+                segments.append(segment)
+                features.append(request_features)
+            if not attached:
+                continue
+
+            try:
+                batch = np.concatenate(features)
+                with limit_threads(self.estimators[step], len(batch)):
+                    outputs = run_estimator(self.estimators[step], method, batch)
+            except Exception as error:
+                for connection, _ in attached:
+                    self._reply(connection, {"error": str(error)})
+                continue
+
+            # Scatter the outputs back into the buffer of every request
+            start = 0
+            for (connection, request), segment, request_features in zip(
+                attached, segments, features
+            ):
+                output = outputs[start : start + request["rows"]]
+                start += request["rows"]
+                try:
+                    np.ndarray(
+                        output.shape,
+                        dtype=np.float64,
+                        buffer=segment.buf,
+                        offset=request_features.nbytes,
+                    )[:] = output
+                except (TypeError, ValueError) as error:
+                    self._reply(connection, {"error": f"invalid buffer: {error}"})
+                    continue
+                self._reply(connection, {"shape": list(output.shape)})
+
+    def _reply(self, connection, message):
+        if connection not in self.buffers:
+            return
+        try:
+            connection.setblocking(True)
+            connection.sendall(json.dumps(message).encode() + b"\n")
+        except OSError:
+            self._close(connection)
+        else:
+            connection.setblocking(False)
+
+
+class InferenceClient:
+    """
+    Sends feature matrices to an inference process through a shared-memory buffer
+    owned by the client, and reads the outputs back from the same buffer.
+    """
+
+    def __init__(self, path):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(path)
+        self.reader = self.connection.makefile("rb")
+        self.segment = None
+        atexit.register(self.close)
+
+    def _ensure_buffer(self, size):
+        if self.segment is not None and self.segment.size >= size:
+            return
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
+        self.segment = shared_memory.SharedMemory(
+            create=True, size=max(size, INFERENCE_BUFFER_SIZE)
+        )
+
+    def call(self, step, method, features, outputs):
+        """
+        Score a feature matrix in the inference process.
+
+        Args:
+        step: The name of the prediction step (e.g. "step3").
+        method: "predict" or "predict_proba".
+        features: A (rows, cols) feature matrix.
+        outputs: The number of outputs per row, to size the shared buffer.
+
+        Returns:
+        A (rows, outputs) array of floats.
+        """
+        features = np.ascontiguousarray(features, dtype=np.float64)
+        rows, cols = features.shape
+        self._ensure_buffer(features.nbytes + rows * outputs * 8)
+        np.ndarray(features.shape, dtype=np.float64, buffer=self.segment.buf)[
+            :
+        ] = features
+
+        request = {
+            "step": step,
+            "method": method,
+            "segment": self.segment.name,
+            "rows": rows,
+            "cols": cols,
+        }
+        self.connection.sendall(json.dumps(request).encode() + b"\n")
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("the inference process closed the connection")
+        reply = json.loads(line)
+        if "error" in reply:
+            raise RuntimeError(f"inference process failed: {reply['error']}")
+
+        return np.ndarray(
+            tuple(reply["shape"]),
+            dtype=np.float64,
+            buffer=self.segment.buf,
+            offset=features.nbytes,
+        ).copy()
+
+    def close(self):
+        atexit.unregister(self.close)
+        self.reader.close()
+        self.connection.close()
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
+            self.segment = None
+
+
+_clients = threading.local()
+
+
+def get_client():
+    """
+    Returns the inference client of the current thread, spreading the worker
+    processes over the configured inference processes.
+    """
+    client = getattr(_clients, "client", None)
+    if client is None:
+        path = INFERENCE_SOCKETS[os.getpid() % len(INFERENCE_SOCKETS)]
+        client = InferenceClient(path)
+        _clients.client = client
+    return client
+
+
+def call_inference(step, method, features, outputs):
+    """
+    Score a feature matrix with the inference client of the current thread, as
+    `InferenceClient.call` does. When the connection fails, e.g. because the
+    inference process was restarted, the client is replaced and the call is
+    retried once.
+    """
+    for attempt in range(2):
+        try:
+            return get_client().call(step, method, features, outputs)
+        except OSError:
+            client = getattr(_clients, "client", None)
+            _clients.client = None
+            if client is not None:
+                client.close()
+            if attempt:
+                raise
+
+
+class RemoteModel:
+    """
+    Runs the preprocessing of a pipeline in the web worker and its estimator in
+    the shared inference process, behind the predict and predict_proba
+    interface of the joblib model. The estimator itself is not kept.
+    """
+
+    def __init__(self, step, model):
+        transforms, estimator = split_pipeline(model)
+        self.step = step
+        self.transforms = transforms
+        self.classes_ = getattr(estimator, "classes_", None)
+
+    def _features(self, frame):
+        features = frame
+        for transform in self.transforms:
+            features = transform.transform(features)
+        if hasattr(features, "toarray"):
+            features = features.toarray()
+        return features
+
+    def predict(self, frame):
+        outputs = call_inference(self.step, "predict", self._features(frame), 1)
+        if self.classes_ is None:
+            return outputs[:, 0]
+        return np.asarray(self.classes_)[outputs[:, 0].astype(int)]
+
+    def predict_proba(self, frame):
+        return call_inference(
+            self.step, "predict_proba", self._features(frame), len(self.classes_)
+        )
+
+
+if __name__ == "__main__":
+    import joblib
+
+    from prediction.steps import STEPS
+
+    parser = argparse.ArgumentParser(
+        description="Run a shared inference process holding the step estimators."
+    )
+    parser.add_argument(
+        "--socket",
+        default=INFERENCE_SOCKETS[0] if INFERENCE_SOCKETS else "inference.sock",
+    )
+    args = parser.parse_args()
+
+    estimators = {
+        step: configure_model(split_pipeline(joblib.load(config["model_path"]))[1])
+        for step, config in STEPS.items()
+    }
+    InferenceServer(estimators, args.socket).serve_forever()
@@ -0,0 +1,391 @@
+import gzip
+import json
+import os
+import re
+import socket
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+import pandas as pd
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.errors import ListError
+
+from prediction.formats import is_msgpack
+from prediction.loan_batch import LoanBatch, _column_rows
+from prediction.steps import STEPS, load_models
+
+# Directory holding the job database, the uploaded inputs and the results
+JOBS_DIR = os.environ.get("LOAN_JOBS_DIR", "jobs")
+
+# Number of loans validated and scored at a time by the job worker
+JOB_CHUNK_SIZE = int(os.environ.get("LOAN_JOB_CHUNK_SIZE", 5000))
+
+# Columnar MessagePack inputs are read whole by the job worker, unlike lists of
+# loans which are read a loan at a time, so they are limited to this many bytes
+JOB_MAX_COLUMNAR_BYTES = int(
+    os.environ.get("LOAN_JOB_MAX_COLUMNAR_BYTES", 256 * 1024 * 1024)
+)
+
+# Characters of a JSON input read at a time
+JOB_READ_SIZE = 1024 * 1024
+
+# Seconds between two polls of the queue when it is empty
+JOB_POLL_INTERVAL = 1.0
+
+# Running jobs whose worker has not reported progress for this long are re-queued
+JOB_STALE_SECONDS = 600
+
+
+@contextmanager
+def _connect():
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    connection = sqlite3.connect(
+        os.path.join(JOBS_DIR, "jobs.sqlite3"), timeout=30, isolation_level=None
+    )
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            step TEXT NOT NULL,
+            status TEXT NOT NULL,
+            input_path TEXT NOT NULL,
+            result_path TEXT,
+            total_rows INTEGER,
+            done_rows INTEGER NOT NULL DEFAULT 0,
+            failed_rows INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            worker TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+    try:
+        yield connection
+    finally:
+        connection.close()
+
+
+def _job_dict(row):
+    job = dict(row)
+    job["progress"] = job["done_rows"] / job["total_rows"] if job["total_rows"] else 0.0
+    return job
+
+
+async def submit_job(step, content_type, body_chunks):
+    """
+    Store an uploaded payload on disk and queue a scoring job for it.
+
+    Args:
+    step: The name of the prediction step (e.g. "step3").
+    content_type: "text/csv" for CSV uploads, a MessagePack type for MessagePack
+    uploads (a list of loans or a map of columns), anything else is read as a
+    JSON list.
+    body_chunks: An async iterator over the bytes of the request body.
+
+    Returns:
+    A dictionary describing the queued job.
+    """
+    job_id = uuid.uuid4().hex
+    if content_type.startswith("text/csv"):
+        extension = "csv"
+    elif is_msgpack(content_type):
+        extension = "msgpack"
+    else:
+        extension = "json"
+    input_path = os.path.join(JOBS_DIR, f"{job_id}.input.{extension}")
+    os.makedirs(JOBS_DIR, exist_ok=True)
+
+    # Stream the body to disk so that large uploads are never held in memory
+    newlines = 0
+    size = 0
+    first, last = b"", b"\n"
+    with open(input_path, "wb") as input_file:
+        async for chunk in body_chunks:
+            if not chunk:
+                continue
+            input_file.write(chunk)
+            newlines += chunk.count(b"\n")
+            size += len(chunk)
+            first, last = first or chunk[:1], chunk[-1:]
+
+    if (
+        extension == "msgpack"
+        and _is_msgpack_map(first)
+        and size > JOB_MAX_COLUMNAR_BYTES
+    ):
+        os.remove(input_path)
+        raise HTTPException(
+            status_code=413,
+            detail=f"columnar MessagePack jobs are limited to {JOB_MAX_COLUMNAR_BYTES} "
+            "bytes. Send a list of loans or a CSV file instead.",
+        )
+
+    # The header line is not a loan, and the last one may not end with a newline
+    total_rows = max(newlines - 1 + (last != b"\n"), 0) if extension == "csv" else None
+    now = time.time()
+    with _connect() as connection:
+        connection.execute(
+            "INSERT INTO jobs (id, step, status, input_path, total_rows, created_at, updated_at) "
+            "VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+            (job_id, step, input_path, total_rows, now, now),
+        )
+    return get_job(job_id)
+
+
+def get_job(job_id):
+    """
+    Returns the status and progress of a job, or None if it does not exist.
+    """
+    with _connect() as connection:
+        row = connection.execute(
+            "SELECT * FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+    if row is None:
+        return None
+    return _job_dict(row)
+
+
+def _claim_next_job(worker):
+    with _connect() as connection:
+        # Re-queue the jobs of workers that stopped reporting progress
+        connection.execute(
+            "UPDATE jobs SET status = 'queued', done_rows = 0, failed_rows = 0, worker = NULL "
+            "WHERE status = 'running' AND updated_at < ?",
+            (time.time() - JOB_STALE_SECONDS,),
+        )
+        cursor = connection.execute(
+            "UPDATE jobs SET status = 'running', worker = ?, updated_at = ? "
+            "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1) "
+            "AND status = 'queued'",
+            (worker, time.time()),
+        )
+        if cursor.rowcount == 0:
+            return None
+        row = connection.execute(
+            "SELECT * FROM jobs WHERE worker = ? AND status = 'running' "
+            "ORDER BY updated_at DESC LIMIT 1",
+            (worker,),
+        ).fetchone()
+    return dict(row) if row is not None else None
+
+
+def _update_job(job_id, **fields):
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with _connect() as connection:
+        connection.execute(
+            f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id)
+        )
+
+
+def _is_msgpack_map(first_byte):
+    # fixmap, map 16 and map 32
+    return bool(first_byte) and (
+        0x80 <= first_byte[0] <= 0x8F or first_byte[0] in (0xDE, 0xDF)
+    )
+
+
+_JSON_WHITESPACE = re.compile(r"\s*")
+
+
+def _json_list_items(input_file, read_size=JOB_READ_SIZE):
+    """
+    Yields the items of the JSON list in a text file one at a time, reading the
+    file in blocks of `read_size` characters rather than whole.
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, eof = "", 0, False
+    # "start" before the list, "first" or "item" before an item, "next" after one
+    state = "start"
+
+    def read_more():
+        nonlocal buffer, position, eof
+        data = input_file.read(read_size)
+        eof = not data
+        buffer = buffer[position:] + data
+        position = 0
+
+    while True:
+        position = _JSON_WHITESPACE.match(buffer, position).end()
+        if position == len(buffer):
+            if eof:
+                raise ValueError("the JSON input ends before its list does.")
+            read_more()
+            continue
+
+        char = buffer[position]
+        if state == "start":
+            if char != "[":
+                raise RequestValidationError([ErrorWrapper(ListError(), ("body",))])
+            position += 1
+            state = "first"
+        elif state in ("first", "next") and char == "]":
+            return
+        elif state == "next":
+            if char != ",":
+                raise ValueError(f"expected ',' or ']' in the JSON list, got {char!r}.")
+            position += 1
+            state = "item"
+        else:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                read_more()
+                continue
+            # A value that reaches the end of the block may go on in the next one
+            if end == len(buffer) and not eof:
+                read_more()
+                continue
+            position = end
+            state = "next"
+            yield item
+
+
+def _chunks(items, rows):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _read_records(input_path):
+    """
+    Yields the records of a job input in chunks of JOB_CHUNK_SIZE rows, as a list
+    of records or, for columnar uploads, a dictionary of columns.
+
+    CSV files and lists of loans are read a chunk at a time. Columnar MessagePack
+    uploads are read whole, which JOB_MAX_COLUMNAR_BYTES bounds.
+    """
+    if input_path.endswith(".csv"):
+        for chunk in pd.read_csv(input_path, chunksize=JOB_CHUNK_SIZE):
+            yield chunk.to_dict(orient="records")
+        return
+
+    if input_path.endswith(".json"):
+        with open(input_path, encoding="utf-8") as input_file:
+            yield from _chunks(_json_list_items(input_file), JOB_CHUNK_SIZE)
+        return
+
+    import msgpack
+
+    with open(input_path, "rb") as input_file:
+        if not _is_msgpack_map(input_file.read(1)):
+            input_file.seek(0)
+            unpacker = msgpack.Unpacker(input_file)
+            try:
+                rows = unpacker.read_array_header()
+            except ValueError:
+                raise RequestValidationError(
+                    [ErrorWrapper(ListError(), ("body",))]
+                ) from None
+            loans = (unpacker.unpack() for _ in range(rows))
+            yield from _chunks(loans, JOB_CHUNK_SIZE)
+            return
+
+        input_file.seek(0)
+        records = msgpack.unpack(input_file)
+
+    # Columnar MessagePack uploads are chunked column by column, once their
+    # columns are known to be lists of the same length
+    rows = _column_rows(records)
+    for start in range(0, rows, JOB_CHUNK_SIZE):
+        yield {
+            name: values[start : start + JOB_CHUNK_SIZE]
+            for name, values in records.items()
+        }
+
+
+def run_job(job, models):
+    """
+    Score the input of a job chunk by chunk and write the results as gzipped JSON lines.
+
+    Each line holds the row index and either its prediction or its validation errors.
+
+    Args:
+    job: A dictionary describing a claimed job.
+    models: A dictionary mapping each step name to its loaded model.
+    """
+    step = STEPS[job["step"]]
+    model = models[job["step"]]
+    result_path = os.path.join(JOBS_DIR, f"{job['id']}.result.jsonl.gz")
+
+    offset = 0
+    failed_rows = 0
+    with gzip.open(result_path, "wt") as result_file:
+        for records in _read_records(job["input_path"]):
+            # Invalid rows are reported on their own so that they do not fail the job
+            if isinstance(records, dict):
+                rows = len(next(iter(records.values()), []))
+                loans, indices, errors = LoanBatch.from_columns(
+                    step["loan_class"], records, rows
+                )
+            else:
+                rows = len(records)
+                loans, indices, errors = LoanBatch.from_records(
+                    step["loan_class"], records
+                )
+            for i, error in errors.items():
+                failed_rows += 1
+                result_file.write(
+                    json.dumps(
+                        {"index": offset + i, "error": error.errors()}, default=str
+                    )
+                    + "\n"
+                )
+
+            predictions = step["predict"](model, loans)
+            for i, index in enumerate(indices.tolist()):
+                result_file.write(
+                    json.dumps({"index": offset + index, "prediction": predictions[i]})
+                    + "\n"
+                )
+
+            offset += rows
+            _update_job(job["id"], done_rows=offset, failed_rows=failed_rows)
+
+    _update_job(
+        job["id"],
+        status="done",
+        result_path=result_path,
+        total_rows=offset,
+        done_rows=offset,
+    )
+
+
+def run_worker(models=None):
+    """
+    Process queued jobs forever, loading the models once for all of them.
+
+    Args:
+    models: An optional dictionary of already loaded models.
+    """
+    models = models if models is not None else load_models()
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    while True:
+        job = _claim_next_job(worker)
+        if job is None:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        try:
+            run_job(job, models)
+        except Exception as error:
+            _update_job(job["id"], status="failed", error=str(error))
+
+
+if __name__ == "__main__":
+    run_worker()
@@ -0,0 +1,479 @@
+import numpy as np
+import pandas as pd
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.errors import DictError, ListError
+
+from prediction.features import (
+    dti_category,
+    fico_average,
+    fico_difference,
+    loan_size_category,
+    loan_to_income,
+)
+from prediction.formats import MSGPACK_TYPES, decode_body, is_msgpack
+from prediction.memory import MemoryStages
+from prediction.loan_classes import (
+    EMP_LENGTH_MAPPING,
+    PURPOSE_MAPPING,
+    TERM_MAPPING,
+    LoanStep1,
+    LoanStep2,
+    LoanStep3,
+    LoanStep4,
+)
+from prediction.tracing import span
+
+
+# Step of the loans of every Loan class, under which their memory is accounted
+LOAN_CLASS_STEPS = {
+    LoanStep1: "step1",
+    LoanStep2: "step2",
+    LoanStep3: "step3",
+    LoanStep4: "step4",
+}
+
+
+def _map_term(term):
+    # Not every Loan class validates the term, keep the months it was given as
+    return TERM_MAPPING.get(term, term)
+
+
+def _map_emp_length(emp_length):
+    if emp_length in EMP_LENGTH_MAPPING.values():
+        return emp_length
+    return EMP_LENGTH_MAPPING[emp_length]
+
+
+def _map_purpose(purpose):
+    if purpose in PURPOSE_MAPPING.values():
+        return purpose
+    return PURPOSE_MAPPING[purpose]
+
+
+# Conversions that get_entry_dict applies to the validated value of a field
+ENTRY_MAPPINGS = {
+    LoanStep1: {"emp_length": _map_emp_length, "purpose": _map_purpose},
+    LoanStep2: {"term": _map_term},
+    LoanStep3: {"term": _map_term},
+    LoanStep4: {"term": _map_term},
+}
+
+# Features derived from the fields of every Loan class, in the column order of
+# get_entry_dict, computed on whole columns
+DERIVED_FEATURES = {
+    LoanStep1: {},
+    LoanStep2: {
+        "sec_app_fico_avg": lambda c: fico_average(
+            c["sec_app_fico_range_low"], c["sec_app_fico_range_high"], True
+        ),
+        "fico_avg": lambda c: fico_average(
+            c["fico_range_low"], c["fico_range_high"], True
+        ),
+        "fico_diff": lambda c: fico_difference(
+            c["fico_range_low"], c["fico_range_high"]
+        ),
+        "loan_size_category": lambda c: loan_size_category(c["loan_amnt"]),
+        "sec_app_fico_diff": lambda c: fico_difference(
+            c["sec_app_fico_range_low"], c["sec_app_fico_range_high"]
+        ),
+    },
+    LoanStep3: {
+        "sec_app_fico_avg": lambda c: fico_average(
+            c["sec_app_fico_range_low"], c["sec_app_fico_range_high"]
+        ),
+        "fico_avg": lambda c: fico_average(
+            c["fico_range_low"], c["fico_range_high"], True
+        ),
+        "fico_diff": lambda c: fico_difference(
+            c["fico_range_low"], c["fico_range_high"]
+        ),
+        "DTI_Category": lambda c: dti_category(c["dti"]),
+        "loan_size_category": lambda c: loan_size_category(c["loan_amnt"]),
+        "sec_app_fico_diff": lambda c: fico_difference(
+            c["sec_app_fico_range_low"], c["sec_app_fico_range_high"]
+        ),
+    },
+    LoanStep4: {
+        "sec_app_fico_avg": lambda c: fico_average(
+            c["sec_app_fico_range_low"], c["sec_app_fico_range_high"]
+        ),
+        "fico_avg": lambda c: fico_average(c["fico_range_low"], c["fico_range_high"]),
+        "LTI": lambda c: loan_to_income(c["loan_amnt"], c["annual_inc_joint"]),
+        "fico_diff": lambda c: fico_difference(
+            c["fico_range_low"], c["fico_range_high"]
+        ),
+        "DTI_Category": lambda c: dti_category(c["dti"]),
+        "loan_size_category": lambda c: loan_size_category(c["loan_amnt"]),
+        "sec_app_fico_diff": lambda c: fico_difference(
+            c["sec_app_fico_range_low"], c["sec_app_fico_range_high"]
+        ),
+    },
+}
+
+_NAN_KEY = object()
+
+
+def _factorize(values):
+    """
+    Returns the code of every value and the list of distinct values, telling apart
+    values of different types (1, 1.0 and "1") and treating every NaN as the same.
+    """
+    index = {}
+    uniques = []
+    codes = np.empty(len(values), dtype=np.intp)
+    for row, value in enumerate(values):
+        try:
+            key = (value.__class__, value) if value == value else _NAN_KEY
+            code = index.get(key)
+        except TypeError:
+            # Unhashable values such as lists are validated one by one
+            key, code = None, None
+        if code is None:
+            code = len(uniques)
+            uniques.append(value)
+            if key is not None:
+                index[key] = code
+        codes[row] = code
+    return codes, uniques
+
+
+def _validate_values(loan_class, name, values, errors, rows):
+    """
+    Validate the distinct values of a column with the pydantic field of the Loan
+    class, and record the errors of every row holding an invalid value.
+
+    Returns:
+    A tuple of the code of every value, the list of validated distinct values and
+    the list of whether each of them is valid.
+    """
+    field = loan_class.__fields__[name]
+    mapping = ENTRY_MAPPINGS[loan_class].get(name)
+    codes, uniques = _factorize(values)
+    validated, valid = [], []
+    for code, value in enumerate(uniques):
+        value, error = field.validate(value, {}, loc=name, cls=loan_class)
+        if error:
+            for row in rows[codes == code].tolist():
+                errors.setdefault(row, []).append(error)
+        elif mapping is not None:
+            value = mapping(value)
+        validated.append(None if error else value)
+        valid.append(not error)
+    return codes, validated, valid
+
+
+def _float_column(loan_class, name, values, errors):
+    field = loan_class.__fields__[name]
+    try:
+        column = np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        column = np.array(
+            [v if v.__class__ in (int, float) else np.nan for v in values],
+            dtype=np.float64,
+        )
+
+    # The float fields of the Loan classes accept every finite number at or above
+    # their lower bound, and their validators only reject negative numbers. Any
+    # other value (None, NaN, strings, negative numbers) is validated by pydantic.
+    lower = max(field.field_info.ge or 0, 0)
+    with np.errstate(invalid="ignore"):
+        checked = np.isfinite(column) & (column >= lower)
+    checked &= np.array([v.__class__ in (int, float) for v in values], dtype=bool)
+
+    rows = np.flatnonzero(~checked)
+    if len(rows):
+        codes, validated, _ = _validate_values(
+            loan_class, name, [values[row] for row in rows.tolist()], errors, rows
+        )
+        column[rows] = np.array(
+            [np.nan if v is None else v for v in validated], dtype=np.float64
+        )[codes]
+    return column
+
+
+def _object_column(loan_class, name, values, errors):
+    codes, validated, valid = _validate_values(
+        loan_class, name, values, errors, np.arange(len(values))
+    )
+    # Infer the dtype from the valid distinct values, as a DataFrame of the loans
+    # would; the rows of invalid values are dropped from the batch
+    placeholder = next((v for v, ok in zip(validated, valid) if ok), None)
+    validated = [v if ok else placeholder for v, ok in zip(validated, valid)]
+    if all(v.__class__ is str for v in validated):
+        return np.array(validated, dtype=object)[codes]
+    return pd.Series(validated, dtype=None).to_numpy()[codes]
+
+
+class LoanRow:
+    """
+    Read-only view of one loan of a LoanBatch, with the fields of its Loan class
+    as attributes.
+    """
+
+    __slots__ = ("batch", "index")
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def __getattr__(self, name):
+        try:
+            return self.batch.columns[name][self.index]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def get_entry_dict(self):
+        return self.batch.take([self.index]).to_frame().to_dict(orient="list")
+
+
+class LoanBatch:
+    """
+    Validated loans of one step held as one NumPy array per field.
+
+    Large batches are validated column by column instead of building one
+    pydantic object per loan: the distinct values of every column are validated
+    with the pydantic field of the Loan class, and float columns only send the
+    values that are not plain numbers within their bounds to pydantic. The
+    columns hold the values as get_entry_dict returns them, and the derived
+    features are computed on whole columns by `to_frame`.
+    """
+
+    def __init__(self, loan_class, columns, rows):
+        self.loan_class = loan_class
+        self.columns = columns
+        self.rows = rows
+
+    @classmethod
+    def from_records(cls, loan_class, records):
+        """
+        Validate a list of loan records.
+
+        Args:
+        loan_class: The Loan class of the step (e.g. LoanStep3).
+        records: A list of dicts, as decoded from a JSON request body.
+
+        Returns:
+        A tuple of the LoanBatch of the valid records, the positions of those
+        records in `records`, and a dictionary mapping the position of every
+        invalid record to its pydantic ValidationError.
+        """
+        errors = {}
+        for row, record in enumerate(records):
+            if not isinstance(record, dict):
+                errors[row] = [ErrorWrapper(DictError(), ())]
+        if errors:
+            records = [r if isinstance(r, dict) else {} for r in records]
+
+        values = {
+            name: [record.get(name, field.get_default()) for record in records]
+            for name, field in loan_class.__fields__.items()
+        }
+        return cls._validate(loan_class, values, len(records), errors)
+
+    @classmethod
+    def from_columns(cls, loan_class, columns, rows):
+        """
+        Validate loans given as one list of values per field.
+
+        Args:
+        loan_class: The Loan class of the step (e.g. LoanStep3).
+        columns: A dictionary mapping field names to lists of `rows` values. Fields
+        that are not given take their default value for every loan.
+        rows: The number of loans.
+
+        Returns:
+        The same tuple as `from_records`.
+        """
+        values = {}
+        for name, field in loan_class.__fields__.items():
+            if name in columns:
+                values[name] = list(columns[name])
+            else:
+                values[name] = [field.get_default()] * rows
+        return cls._validate(loan_class, values, rows, {})
+
+    @classmethod
+    def _validate(cls, loan_class, values, rows, errors):
+        columns = {}
+        for name, field in loan_class.__fields__.items():
+            if issubclass(field.type_, float):
+                columns[name] = _float_column(loan_class, name, values[name], errors)
+            else:
+                columns[name] = _object_column(loan_class, name, values[name], errors)
+
+        batch = cls(loan_class, columns, rows)
+        valid = np.setdiff1d(np.arange(rows), list(errors))
+        if errors:
+            batch = batch.take(valid)
+        return (
+            batch,
+            valid,
+            {
+                row: ValidationError(row_errors, loan_class)
+                for row, row_errors in sorted(errors.items())
+            },
+        )
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, index):
+        if not -self.rows <= index < self.rows:
+            raise IndexError(index)
+        return LoanRow(self, index % self.rows)
+
+    def __iter__(self):
+        return (LoanRow(self, index) for index in range(self.rows))
+
+    def take(self, indices):
+        """
+        Returns a LoanBatch of the loans at the given positions.
+        """
+        indices = np.asarray(indices, dtype=np.intp)
+        return LoanBatch(
+            self.loan_class,
+            {name: column[indices] for name, column in self.columns.items()},
+            len(indices),
+        )
+
+    def to_frame(self):
+        """
+        Returns the model-ready DataFrame of the batch, with the same columns as
+        stacking the get_entry_dict of every loan.
+        """
+        columns = dict(self.columns)
+        for name, derive in DERIVED_FEATURES[self.loan_class].items():
+            columns[name] = derive(self.columns)
+        return pd.DataFrame(columns, copy=False)
+
+
+class PartialLoanBatch(LoanBatch):
+    """
+    The valid loans of a partial-success request, with the position of every one
+    of them in the request and the validation errors of the invalid loans.
+    """
+
+    def __init__(self, batch, positions, errors):
+        super().__init__(batch.loan_class, batch.columns, batch.rows)
+        self.positions = positions
+        self.errors = errors
+
+
+def batch_response(loans, results):
+    """
+    Returns the response of a prediction endpoint: `results` itself, or for a
+    partial-success request, the results keyed by the position of their loan in
+    the request, with the errors of every rejected loan under the same positions.
+    """
+    if not isinstance(loans, PartialLoanBatch):
+        return results
+    positions = loans.positions.tolist()
+    return {
+        "predictions": {positions[i]: result for i, result in results.items()},
+        "errors": {row: error.errors() for row, error in loans.errors.items()},
+    }
+
+
+def _column_rows(columns):
+    # Every column of a columnar body must hold one value per loan
+    rows = None
+    for name, values in columns.items():
+        if not isinstance(values, list):
+            raise RequestValidationError([ErrorWrapper(ListError(), ("body", name))])
+        if rows is None:
+            rows = len(values)
+        elif len(values) != rows:
+            raise RequestValidationError(
+                [
+                    ErrorWrapper(
+                        ValueError(f"expected {rows} values, got {len(values)}"),
+                        ("body", name),
+                    )
+                ]
+            )
+    return rows or 0
+
+
+def _columns_batch(loan_class, columns):
+    return LoanBatch.from_columns(loan_class, columns, _column_rows(columns))
+
+
+def loan_batch_body(loan_class):
+    """
+    Returns a FastAPI dependency that reads a list of loans from the request body
+    into a LoanBatch, answering 422 with the errors of every invalid field as
+    FastAPI does for a `list[loan_class]` body.
+
+    Bodies are JSON unless the Content-Type names MessagePack. A MessagePack body
+    may also hold the loans as a map of columns, one array of values per field,
+    which are validated without building a record per loan.
+
+    With the `partial` query parameter, invalid loans do not fail the request:
+    the dependency returns a PartialLoanBatch of the valid loans, to be scored
+    and answered with `batch_response`.
+    """
+
+    async def parse_loans(request: Request, partial: bool = False):
+        content_type = request.headers.get("content-type", "")
+        with span("body.read"):
+            body = await request.body()
+        step = LOAN_CLASS_STEPS[loan_class]
+        with MemoryStages(step, 0) as stages:
+            with span("body.decode", content_type=content_type, bytes=len(body)):
+                loans = decode_body(content_type, body)
+            with span("body.validate", loan_class=loan_class.__name__) as validate_span:
+                if isinstance(loans, dict) and is_msgpack(content_type):
+                    batch, positions, errors = _columns_batch(loan_class, loans)
+                elif isinstance(loans, list):
+                    batch, positions, errors = LoanBatch.from_records(loan_class, loans)
+                else:
+                    raise RequestValidationError([ErrorWrapper(ListError(), ("body",))])
+                if validate_span is not None:
+                    validate_span.attributes.update(
+                        rows=len(batch), invalid=len(errors)
+                    )
+            stages.rows = len(batch) + len(errors)
+            stages.mark("validation")
+        # The response of the request is accounted to the same step and rows
+        request.state.memory_stage = (step, stages.rows)
+
+        if partial:
+            return PartialLoanBatch(batch, positions, errors)
+        if errors:
+            raise RequestValidationError(
+                [ErrorWrapper(error, ("body", row)) for row, error in errors.items()]
+            )
+        return batch
+
+    return parse_loans
+
+
+def loan_list_openapi(loan_class):
+    """
+    Returns the OpenAPI request body of an endpoint reading a list of loans with
+    `loan_batch_body`, which FastAPI cannot infer from the dependency.
+    """
+    schema = {"title": "Loans", "type": "array", "items": loan_class.schema()}
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {"schema": schema},
+                MSGPACK_TYPES[0]: {
+                    "schema": {
+                        "anyOf": [
+                            schema,
+                            {
+                                "title": "Loan columns",
+                                "type": "object",
+                                "additionalProperties": {"type": "array"},
+                            },
+                        ]
+                    }
+                },
+            },
+        }
+    }
@@ -4,6 +4,7 @@ from typing import Optional
 import pandas as pd
 from pydantic import BaseModel, Field, validator
 
+from prediction.features import DTI_BINS, DTI_LABELS, LOAN_SIZE_BINS, LOAN_SIZE_LABELS
 from prediction.mappings import GRADES_MAPPING, SUB_GRADE_MAPPING
 
 # Dictionary for mapping employment length values to integers
@@ -149,8 +150,8 @@ class LoanStep2(BaseModel):
 
     @property
     def loan_size_category(self):
-        bins = [0, 5000, 10000, 20000, 30000, 40000, float("inf")]
-        labels = ["< 5K", "5K - 10K", "10K - 20K", "20K - 30K", "30K - 40K", ">= 40K"]
+        bins = LOAN_SIZE_BINS
+        labels = LOAN_SIZE_LABELS
         if self.loan_amnt is not None:
             return pd.cut([self.loan_amnt], bins=bins, labels=labels)[0]
         return None
@@ -395,16 +396,16 @@ class LoanStep3(BaseModel):
 
     @property
     def loan_size_category(self):
-        bins = [0, 5000, 10000, 20000, 30000, 40000, float("inf")]
-        labels = ["< 5K", "5K - 10K", "10K - 20K", "20K - 30K", "30K - 40K", ">= 40K"]
+        bins = LOAN_SIZE_BINS
+        labels = LOAN_SIZE_LABELS
         if self.loan_amnt is not None:
             return pd.cut([self.loan_amnt], bins=bins, labels=labels)[0]
         return None
 
     @property
     def DTI_Category(self):
-        bins = [0, 15, 25, float("inf")]
-        labels = ["DTI < 15%", "15% <= DTI <= 25%", "DTI > 25%"]
+        bins = DTI_BINS
+        labels = DTI_LABELS
         if self.dti is not None:
             return pd.cut([self.dti], bins=bins, labels=labels)[0]
         return None
@@ -636,16 +637,16 @@ class LoanStep4(BaseModel):
 
     @property
     def DTI_Category(self):
-        bins = [0, 15, 25, float("inf")]
-        labels = ["DTI < 15%", "15% <= DTI <= 25%", "DTI > 25%"]
+        bins = DTI_BINS
+        labels = DTI_LABELS
         if self.dti is not None:
             return pd.cut([self.dti], bins=bins, labels=labels)[0]
         return None
 
     @property
     def loan_size_category(self):
-        bins = [0, 5000, 10000, 20000, 30000, 40000, float("inf")]
-        labels = ["< 5K", "5K - 10K", "10K - 20K", "20K - 30K", "30K - 40K", ">= 40K"]
+        bins = LOAN_SIZE_BINS
+        labels = LOAN_SIZE_LABELS
         if self.loan_amnt is not None:
             return pd.cut([self.loan_amnt], bins=bins, labels=labels)[0]
         return None
@@ -857,3 +858,89 @@ class LoanStep4(BaseModel):
             data["sec_app_fico_diff"] = [self.sec_app_fico_diff]
 
         return data
+
+
+class WhatIfGrid(BaseModel):
+    """
+    Represents a what-if query: one applicant and the loan amounts and terms to try.
+    """
+
+    # The applicant for the acceptance prediction.
+    step1: Optional[LoanStep1] = None
+
+    # The applicant for the interest rate prediction.
+    step4: Optional[LoanStep4] = None
+
+    # The loan amounts to evaluate.
+    loan_amnt: list[float] = Field(..., min_items=1, max_items=1000)
+
+    # The loan terms to evaluate.
+    term: list[int] = Field([36, 60], min_items=1, max_items=2)
+
+    @validator("loan_amnt", each_item=True)
+    def loan_amnt_must_be_positive(cls, value):
+        if value < 1:
+            raise ValueError(
+                f"expected loan_amnt values must be at least 1. Received value - {value}"
+            )
+        return value
+
+    @validator("term", each_item=True)
+    def term_must_have_value(cls, value):
+        if value not in TERM_MAPPING.values():
+            raise ValueError(
+                f"expected term values are {list(TERM_MAPPING.values())}. Received value - {value}"
+            )
+        return value
+
+    @validator("term")
+    def terms_must_be_distinct(cls, value):
+        if len(set(value)) != len(value):
+            raise ValueError(f"expected distinct term values. Received value - {value}")
+        return value
+
+    @validator("step4", always=True)
+    def step_must_be_given(cls, value, values):
+        # An invalid step1 is missing from values and already reported
+        if value is None and "step1" in values and values["step1"] is None:
+            raise ValueError("expected a step1 or a step4 applicant.")
+        return value
+
+
+class CounterfactualQuery(BaseModel):
+    """
+    Represents a search for the smallest change that gets a loan application accepted.
+    """
+
+    # The applicant to search a counterfactual for.
+    loan: LoanStep1
+
+    # Whether to also search lower debt-to-income ratios.
+    search_dti: bool = False
+
+    # The range of loan amounts to search.
+    min_loan_amnt: float = Field(1000.0, ge=1)
+    max_loan_amnt: float = Field(40000.0, ge=1)
+
+    # The number of candidates evaluated in each model call.
+    candidates_per_call: int = Field(64, ge=3, le=256)
+
+    # The number of debt-to-income ratios searched when search_dti is set.
+    dti_candidates: int = Field(8, ge=2, le=32)
+
+    @validator("loan")
+    def loan_amnt_must_be_set(cls, value):
+        # The search starts from the requested loan amount
+        if value.loan_amnt is None:
+            raise ValueError(
+                "expected loan.loan_amnt to be set, the search starts from the requested loan amount"
+            )
+        return value
+
+    @validator("max_loan_amnt")
+    def loan_amnt_range_must_be_valid(cls, value, values):
+        if "min_loan_amnt" in values and value <= values["min_loan_amnt"]:
+            raise ValueError(
+                f"expected max_loan_amnt to be greater than min_loan_amnt. Received value - {value}"
+            )
+        return value
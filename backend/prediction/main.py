@@ -1,6 +1,38 @@
-import joblib
-from fastapi import FastAPI
-from prediction.loan_classes import LoanStep1, LoanStep2, LoanStep3, LoanStep4
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.responses import FileResponse
+from prediction.admission import AdmissionControl
+from prediction.explanations import (
+    UnsupportedModelError,
+    explain_grade,
+    explain_subgrade,
+)
+from prediction.counterfactual import search_counterfactual
+from prediction.formats import negotiate_response
+from prediction.loan_batch import (
+    LoanBatch,
+    batch_response,
+    loan_batch_body,
+    loan_list_openapi,
+)
+from prediction.loan_classes import (
+    CounterfactualQuery,
+    LoanStep1,
+    LoanStep2,
+    LoanStep3,
+    LoanStep4,
+    WhatIfGrid,
+)
+from prediction.audit import get_audit_stats
+from prediction.drift import get_drift_report
+from prediction.memory import get_memory_report, start_memory_profile
+from prediction.metrics import get_metrics
+from prediction.portfolio import summarize_portfolio
+from prediction.jobs import get_job, submit_job
+from prediction.rate_surface import RateSurface, quote_int_rate
+from prediction.similar import SimilarLoanIndex, find_similar_loans
+from prediction.steps import STEPS, load_models
+from prediction.tracing import TracingMiddleware
+from prediction.what_if import predict_what_if
 from prediction.predictions import (
     predict_accepted_rejected,
     predict_grade,
@@ -10,11 +42,28 @@ from prediction.predictions import (
 
 app = FastAPI()
 
+# Trace allocations per stage when LOAN_MEMORY_PROFILE=1
+start_memory_profile()
+
+# Estimate the cost of prediction requests and run them in priority lanes
+app.add_middleware(AdmissionControl)
+
+# Record a span per request, around the admission wait and the handler stages,
+# when LOAN_TRACE_FILE or LOAN_TRACE_OTLP_ENDPOINT is set
+app.add_middleware(TracingMiddleware)
+
 # Load pre-trained models
-model_step1 = joblib.load("prediction/models/step1-status_classifier.joblib")
-model_step2 = joblib.load("prediction/models/step2-grade_classifier.joblib")
-model_step3 = joblib.load("prediction/models/step3-subgrade_classifier.joblib")
-model_step4 = joblib.load("prediction/models/step4-int_rate_pred.joblib")
+models = load_models()
+model_step1 = models["step1"]
+model_step2 = models["step2"]
+model_step3 = models["step3"]
+model_step4 = models["step4"]
+
+# Load the optional precomputed interest rate surface of the step 4 model
+rate_surface = RateSurface.load(STEPS["step4"]["model_path"])
+
+# Load the optional similar historical loans indexes of the grade and subgrade steps
+similar_indexes = {step: SimilarLoanIndex.load(step) for step in ("step2", "step3")}
 
 
 @app.get("/")
@@ -25,57 +74,314 @@ def home():
     return {"message": "Hello. This is loan acceptance prediction!"}
 
 
-@app.post("/step1_accepted_rejected_prediction/")
-async def predict_accepted_rejected_query(loans: list[LoanStep1]):
+@app.get("/metrics/")
+def metrics():
+    """
+    Returns the batch metrics of this worker, including the share of duplicate rows
+    that were skipped when scoring each step.
+    """
+    return get_metrics()
+
+
+@app.get("/drift/")
+def drift():
+    """
+    Returns the streaming summaries of the features scored by all workers for every
+    step, compared with the training reference of the steps that have one.
+    """
+    return get_drift_report()
+
+
+@app.get("/audit/")
+def audit():
+    """
+    Returns the counts of audited loans of this worker that are waiting, written,
+    dropped because the audit queue was full, or lost to a failed write.
+    """
+    return get_audit_stats()
+
+
+@app.get("/memory/")
+def memory():
+    """
+    Returns the allocations per loan of every stage of the scored batches, by step
+    and batch size, when the memory profiling mode is enabled.
+    """
+    return get_memory_report()
+
+
+@app.post(
+    "/step1_accepted_rejected_prediction/", openapi_extra=loan_list_openapi(LoanStep1)
+)
+def predict_accepted_rejected_query(
+    request: Request, loans: LoanBatch = Depends(loan_batch_body(LoanStep1))
+):
     """
     Predicts whether a loan application will be accepted or rejected based on step 1 data.
 
     Parameters:
     loans (list[LoanStep1]): A list of LoanStep1 objects containing borrower's personal information.
+    partial (bool): Score the valid loans and return the errors of the invalid ones, instead of rejecting the whole request.
+
+    Returns:
+    dict: A dictionary containing predicted loan status (0 or 1) for each loan in the input list. With partial, the predictions and the errors keyed by the position of each loan in the input list.
+    """
+    results = predict_accepted_rejected(model_step1, loans)
+    return negotiate_response(request, batch_response(loans, results))
+
+
+@app.post("/step1_counterfactual/")
+def search_counterfactual_query(query: CounterfactualQuery):
+    """
+    Searches the smallest loan amount change (and optionally debt-to-income ratio) for
+    which a loan application would be accepted, within a fixed budget of model calls.
+
+    Parameters:
+    query (CounterfactualQuery): A LoanStep1 applicant and the range of loan amounts to search.
 
     Returns:
-    dict: A dictionary containing predicted loan status (0 or 1) for each loan in the input list.
+    dict: The current decision and the closest accepted loan amount, with the accepted loan amounts for lower debt-to-income ratios when requested.
     """
-    return predict_accepted_rejected(model_step1, loans)
+    return search_counterfactual(model_step1, query)
 
 
-@app.post("/step2_grade_prediction/")
-async def predict_grade_query(loans: list[LoanStep2]):
+@app.post("/step2_grade_prediction/", openapi_extra=loan_list_openapi(LoanStep2))
+def predict_grade_query(
+    request: Request, loans: LoanBatch = Depends(loan_batch_body(LoanStep2))
+):
     """
     Predicts the grade of a loan application based on step 2 data.
 
+    Parameters:
+    loans (list[LoanStep2]): A list of LoanStep2 objects containing borrower's financial information.
+    partial (bool): Score the valid loans and return the errors of the invalid ones, instead of rejecting the whole request.
+
+    Returns:
+    dict: A dictionary containing predicted loan grades (A, B, C, D, E, F or G) for each loan in the input list. With partial, the predictions and the errors keyed by the position of each loan in the input list.
+    """
+    results = predict_grade(model_step2, loans)
+    return negotiate_response(request, batch_response(loans, results))
+
+
+@app.post("/step2_grade_explanation/")
+def explain_grade_query(loans: list[LoanStep2]):
+    """
+    Explains the predicted grade of a loan application based on step 2 data.
+
     Parameters:
     loans (list[LoanStep2]): A list of LoanStep2 objects containing borrower's financial information.
 
     Returns:
-    dict: A dictionary containing predicted loan grades (A, B, C, D, E, F or G) for each loan in the input list.
+    dict: A dictionary containing the predicted grade, the base value and the contribution of each feature for each loan in the input list.
     """
-    return predict_grade(model_step2, loans)
+    try:
+        return explain_grade(model_step2, loans)
+    except UnsupportedModelError as error:
+        raise HTTPException(status_code=501, detail=str(error))
 
 
-@app.post("/step3_subgrade_prediction/")
-async def predict_subgrade_query(loans: list[LoanStep3]):
+@app.post("/step2_similar_loans/", openapi_extra=loan_list_openapi(LoanStep2))
+def similar_loans_step2_query(
+    request: Request,
+    k: int = Query(5, ge=1, le=100),
+    loans: LoanBatch = Depends(loan_batch_body(LoanStep2)),
+):
+    """
+    Finds the historical loans most similar to a loan application based on step 2 data.
+
+    Parameters:
+    loans (list[LoanStep2]): A list of LoanStep2 objects containing borrower's financial information.
+    k (int): The number of similar loans to return for each loan.
+    partial (bool): Search the valid loans and return the errors of the invalid ones, instead of rejecting the whole request.
+
+    Returns:
+    dict: A dictionary containing, for each loan in the input list, its k most similar historical loans with their distance, grade, subgrade and interest rate. With partial, the results and the errors keyed by the position of each loan in the input list.
+    """
+    return _similar_loans("step2", request, loans, k)
+
+
+@app.post("/step3_subgrade_prediction/", openapi_extra=loan_list_openapi(LoanStep3))
+def predict_subgrade_query(
+    request: Request, loans: LoanBatch = Depends(loan_batch_body(LoanStep3))
+):
     """
     Predicts the subgrade of a loan application based on step 3 data.
 
     Parameters:
     loans (list[LoanStep3]): A list of LoanStep3 objects containing borrower's credit information.
+    partial (bool): Score the valid loans and return the errors of the invalid ones, instead of rejecting the whole request.
+
+    Returns:
+    dict: A dictionary containing predicted loan subgrades (A, B, C, D, E, F or G) x (1 to 5) for each loan in the input list. With partial, the predictions and the errors keyed by the position of each loan in the input list.
+    """
+    results = predict_subgrade(model_step3, loans)
+    return negotiate_response(request, batch_response(loans, results))
+
+
+@app.post("/step3_subgrade_explanation/")
+def explain_subgrade_query(loans: list[LoanStep3]):
+    """
+    Explains the predicted subgrade of a loan application based on step 3 data.
+
+    Parameters:
+    loans (list[LoanStep3]): A list of LoanStep3 objects containing borrower's credit information.
+
+    Returns:
+    dict: A dictionary containing the predicted subgrade, the base value and the contribution of each feature for each loan in the input list.
+    """
+    try:
+        return explain_subgrade(model_step3, loans)
+    except UnsupportedModelError as error:
+        raise HTTPException(status_code=501, detail=str(error))
+
+
+@app.post("/step3_similar_loans/", openapi_extra=loan_list_openapi(LoanStep3))
+def similar_loans_step3_query(
+    request: Request,
+    k: int = Query(5, ge=1, le=100),
+    loans: LoanBatch = Depends(loan_batch_body(LoanStep3)),
+):
+    """
+    Finds the historical loans most similar to a loan application based on step 3 data.
+
+    Parameters:
+    loans (list[LoanStep3]): A list of LoanStep3 objects containing borrower's credit information.
+    k (int): The number of similar loans to return for each loan.
+    partial (bool): Search the valid loans and return the errors of the invalid ones, instead of rejecting the whole request.
 
     Returns:
-    dict: A dictionary containing predicted loan subgrades (A, B, C, D, E, F or G) x (1 to 5) for each loan in the input list.
+    dict: A dictionary containing, for each loan in the input list, its k most similar historical loans with their distance, grade, subgrade and interest rate. With partial, the results and the errors keyed by the position of each loan in the input list.
     """
-    return predict_subgrade(model_step3, loans)
+    return _similar_loans("step3", request, loans, k)
+
 
+def _similar_loans(step, request, loans, k):
+    index = similar_indexes[step]
+    if index is None:
+        raise HTTPException(
+            status_code=501,
+            detail=f"no similar loans index - build it with python -m prediction.similar {step}",
+        )
+    results = find_similar_loans(index, loans, k)
+    return negotiate_response(request, batch_response(loans, results))
 
-@app.post("/step4_int_rate_prediction/")
-async def predict_int_rate_query(loans: list[LoanStep4]):
+
+@app.post("/step4_int_rate_prediction/", openapi_extra=loan_list_openapi(LoanStep4))
+def predict_int_rate_query(
+    request: Request, loans: LoanBatch = Depends(loan_batch_body(LoanStep4))
+):
     """
     Predicts the interest rate of a loan application based on step 4 data.
 
     Parameters:
     loans (list[LoanStep4]): A list of LoanStep4 objects containing borrower's loan information.
+    partial (bool): Score the valid loans and return the errors of the invalid ones, instead of rejecting the whole request.
+
+    Returns:
+    dict: A dictionary containing predicted loan interest rates for each loan in the input list. With partial, the predictions and the errors keyed by the position of each loan in the input list.
+    """
+    results = predict_int_rate(model_step4, loans)
+    return negotiate_response(request, batch_response(loans, results))
+
+
+@app.post("/step4_int_rate_quote/", openapi_extra=loan_list_openapi(LoanStep4))
+def quote_int_rate_query(
+    request: Request, loans: LoanBatch = Depends(loan_batch_body(LoanStep4))
+):
+    """
+    Quotes the interest rate of a loan application from the precomputed rate surface,
+    falling back to the model when the surface does not cover it accurately enough.
+
+    Parameters:
+    loans (list[LoanStep4]): A list of LoanStep4 objects containing borrower's loan information.
+    partial (bool): Score the valid loans and return the errors of the invalid ones, instead of rejecting the whole request.
+
+    Returns:
+    dict: A dictionary containing the interest rate, its source (surface or model) and the error bound of the surface for each loan in the input list. With partial, the predictions and the errors keyed by the position of each loan in the input list.
+    """
+    results = quote_int_rate(model_step4, rate_surface, loans)
+    return negotiate_response(request, batch_response(loans, results))
+
+
+@app.post("/what_if_prediction/")
+def predict_what_if_query(query: WhatIfGrid):
+    """
+    Predicts how the loan acceptance and the interest rate of one applicant change
+    across a grid of loan amounts and terms.
+
+    Parameters:
+    query (WhatIfGrid): A LoanStep1 and/or LoanStep4 applicant with the loan amounts and terms to evaluate.
+
+    Returns:
+    dict: The loan amount and term of every grid point with its acceptance probability and/or predicted interest rate.
+    """
+    return predict_what_if(model_step1, model_step4, query)
+
+
+@app.post("/jobs/{step}/")
+async def submit_job_query(step: str, request: Request):
+    """
+    Queues a large batch of loans for asynchronous scoring by the job worker.
+
+    Parameters:
+    step (str): The prediction step to run (step1, step2, step3 or step4).
+    request (Request): A CSV file (Content-Type: text/csv) or a JSON list of loans.
+
+    Returns:
+    dict: The job id, its status and its progress.
+    """
+    if step not in STEPS:
+        raise HTTPException(status_code=404, detail=f"unknown step - {step}")
+    return await submit_job(
+        step, request.headers.get("content-type", ""), request.stream()
+    )
+
+
+@app.get("/jobs/{job_id}/")
+def job_status_query(job_id: str):
+    """
+    Returns the status and progress of a scoring job.
+    """
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"unknown job - {job_id}")
+    return job
+
+
+@app.get("/jobs/{job_id}/result/")
+def job_result_query(job_id: str):
+    """
+    Downloads the results of a finished scoring job as gzipped JSON lines.
+    """
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"unknown job - {job_id}")
+    if job["status"] != "done":
+        raise HTTPException(
+            status_code=409, detail=f"job is not finished - {job['status']}"
+        )
+    return FileResponse(
+        job["result_path"],
+        media_type="application/gzip",
+        filename=f"{job_id}.jsonl.gz",
+    )
+
+
+@app.post("/portfolio/{step}/")
+async def portfolio_summary_query(step: str, request: Request):
+    """
+    Scores a portfolio of loans a chunk at a time and returns only its summary.
+
+    Parameters:
+    step (str): The prediction step to run (step1, step2, step3 or step4).
+    request (Request): A CSV file (Content-Type: text/csv), read as it streams in, or a JSON or MessagePack list of loans.
 
     Returns:
-    dict: A dictionary containing predicted loan interest rates for each loan in the input list.
+    dict: The number of loans scored and rejected, and the distribution of their predictions.
     """
-    return predict_int_rate(model_step4, loans)
+    if step not in STEPS:
+        raise HTTPException(status_code=404, detail=f"unknown step - {step}")
+    summary = await summarize_portfolio(
+        step, models[step], request.headers.get("content-type", ""), request.stream()
+    )
+    return negotiate_response(request, summary)
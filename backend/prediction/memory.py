@@ -0,0 +1,105 @@
+import math
+import os
+import threading
+import tracemalloc
+
+# Trace the allocations of the worker and account them to the stages of every
+# batch. Tracing slows Python allocations down, so this is for profiling only.
+MEMORY_PROFILE = os.environ.get("LOAN_MEMORY_PROFILE", "") == "1"
+
+# Allocation accounting per (step, batch size bucket, stage)
+MEMORY_STAGES = {}
+
+_memory_lock = threading.Lock()
+
+# Held by the batch being profiled, as the peak of tracemalloc is process-wide
+_profile_lock = threading.Lock()
+
+
+def start_memory_profile():
+    """
+    Start tracing allocations if the memory profiling mode is enabled.
+    """
+    if MEMORY_PROFILE and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def size_bucket(rows):
+    """
+    Returns the power of ten a batch of `rows` rows is accounted under.
+    """
+    return 10 ** math.ceil(math.log10(max(rows, 1)))
+
+
+class MemoryStages:
+    """
+    Accounts the allocations of the consecutive stages of a batch.
+
+    Every call to `mark` closes the stage that started at the previous mark, and
+    records its peak (the most memory allocated at any point of the stage,
+    above what was allocated when it started) and its net allocations (what the
+    stage left allocated when it ended). Stages are only accounted inside a
+    `with` block, which holds a process-wide lock while allocations are traced:
+    the peak of tracemalloc is shared by the whole process, so batches are
+    profiled one at a time.
+    """
+
+    def __init__(self, step, rows):
+        self.step = step
+        self.rows = rows
+        self.profiling = False
+
+    def __enter__(self):
+        if tracemalloc.is_tracing():
+            _profile_lock.acquire()
+            self.profiling = True
+            self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiling:
+            self.profiling = False
+            _profile_lock.release()
+
+    def start(self):
+        if self.profiling:
+            tracemalloc.reset_peak()
+            self.baseline = tracemalloc.get_traced_memory()[0]
+
+    def mark(self, stage):
+        if not self.profiling:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        key = (self.step, size_bucket(self.rows), stage)
+        with _memory_lock:
+            stats = MEMORY_STAGES.setdefault(
+                key, {"batches": 0, "rows": 0, "peak_bytes": 0, "net_bytes": 0}
+            )
+            stats["batches"] += 1
+            stats["rows"] += self.rows
+            stats["peak_bytes"] += peak - self.baseline
+            stats["net_bytes"] += current - self.baseline
+        self.start()
+
+
+def get_memory_report():
+    """
+    Returns the mean peak and net allocations per loan of every stage, by step
+    and batch size bucket.
+    """
+    with _memory_lock:
+        report = {}
+        for (step, bucket, stage), stats in sorted(MEMORY_STAGES.items()):
+            rows = max(stats["rows"], 1)
+            report.setdefault(step, {}).setdefault(str(bucket), {})[stage] = {
+                "batches": stats["batches"],
+                "rows": stats["rows"],
+                "peak_bytes_per_loan": stats["peak_bytes"] / rows,
+                "net_bytes_per_loan": stats["net_bytes"] / rows,
+            }
+        return report
+
+
+def reset_memory_report():
+    with _memory_lock:
+        MEMORY_STAGES.clear()
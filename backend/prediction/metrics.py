@@ -0,0 +1,73 @@
+import threading
+
+# Running counters for the batches scored by this worker process, keyed by step
+BATCH_METRICS = {}
+
+_metrics_lock = threading.Lock()
+
+
+def record_batch(step, total_rows, unique_rows):
+    """
+    Record the size of a scored batch and how many of its rows were unique.
+
+    Args:
+    step: The name of the prediction step (e.g. "step1").
+    total_rows: The number of loans received in the batch.
+    unique_rows: The number of distinct feature vectors actually scored.
+    """
+    with _metrics_lock:
+        step_metrics = BATCH_METRICS.setdefault(
+            step, {"batches": 0, "rows": 0, "unique_rows": 0}
+        )
+        step_metrics["batches"] += 1
+        step_metrics["rows"] += total_rows
+        step_metrics["unique_rows"] += unique_rows
+        step_metrics["last_batch_dedup_ratio"] = dedup_ratio(total_rows, unique_rows)
+
+
+def record_cascade(step, rows, escalated_rows):
+    """
+    Record how many of the rows scored by a model cascade went to the full model.
+
+    Args:
+    step: The name of the prediction step (e.g. "step3").
+    rows: The number of rows scored by the first stage.
+    escalated_rows: The number of them scored again by the full model.
+    """
+    with _metrics_lock:
+        step_metrics = BATCH_METRICS.setdefault(
+            step, {"batches": 0, "rows": 0, "unique_rows": 0}
+        )
+        step_metrics["cascade_rows"] = step_metrics.get("cascade_rows", 0) + rows
+        step_metrics["cascade_escalated_rows"] = (
+            step_metrics.get("cascade_escalated_rows", 0) + escalated_rows
+        )
+
+
+def dedup_ratio(total_rows, unique_rows):
+    """
+    Returns the share of rows that were skipped because they duplicated another row.
+    """
+    if total_rows == 0:
+        return 0.0
+    return 1 - unique_rows / total_rows
+
+
+def get_metrics():
+    """
+    Returns a snapshot of the batch metrics with the cumulative dedup ratio per step,
+    and the share of rows a model cascade sent to the full model.
+    """
+    with _metrics_lock:
+        snapshot = {}
+        for step, step_metrics in BATCH_METRICS.items():
+            snapshot[step] = dict(step_metrics)
+            snapshot[step]["dedup_ratio"] = dedup_ratio(
+                step_metrics["rows"], step_metrics["unique_rows"]
+            )
+            if step_metrics.get("cascade_rows"):
+                snapshot[step]["cascade_escalation_ratio"] = (
+                    step_metrics["cascade_escalated_rows"]
+                    / step_metrics["cascade_rows"]
+                )
+        return snapshot
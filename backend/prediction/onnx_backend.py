@@ -0,0 +1,323 @@
+import argparse
+import copy
+import importlib.util
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from prediction.threads import THREADS_PER_WORKER
+
+# Steps served with ONNX Runtime instead of joblib, e.g. "step1,step4" or "all"
+ONNX_STEPS = os.environ.get("LOAN_ONNX_STEPS", "")
+
+# Largest difference to the joblib model accepted when verifying an export
+ONNX_TOLERANCE = 1e-3
+
+# ONNX input element types of the DataFrame columns
+ONNX_DTYPES = {
+    "tensor(string)": object,
+    "tensor(float)": np.float32,
+    "tensor(double)": np.float64,
+    "tensor(int64)": np.int64,
+}
+
+
+def onnx_path(model_path):
+    """
+    Returns the path of the ONNX export of a joblib model.
+    """
+    return os.path.splitext(model_path)[0] + ".onnx"
+
+
+def onnx_enabled(step):
+    """
+    Returns whether `step` is configured to use the ONNX Runtime backend.
+    """
+    steps = {name.strip() for name in ONNX_STEPS.split(",") if name.strip()}
+    return "all" in steps or step in steps
+
+
+def _register_converters():
+    # LightGBM and XGBoost estimators are converted with onnxmltools when installed
+    from skl2onnx import update_registered_converter
+    from skl2onnx.common.shape_calculator import (
+        calculate_linear_classifier_output_shapes,
+        calculate_linear_regressor_output_shapes,
+    )
+
+    classifier_options = {"nocl": [True, False], "zipmap": [True, False, "columns"]}
+    try:
+        from lightgbm import LGBMClassifier, LGBMRegressor
+        from onnxmltools.convert.lightgbm.operator_converters.LightGbm import (
+            convert_lightgbm,
+        )
+
+        update_registered_converter(
+            LGBMClassifier,
+            "LightGbmLGBMClassifier",
+            calculate_linear_classifier_output_shapes,
+            convert_lightgbm,
+            options=classifier_options,
+        )
+        update_registered_converter(
+            LGBMRegressor,
+            "LightGbmLGBMRegressor",
+            calculate_linear_regressor_output_shapes,
+            convert_lightgbm,
+            options={"split": None},
+        )
+    except ImportError:
+        pass
+
+    try:
+        from onnxmltools.convert.xgboost.operator_converters.XGBoost import (
+            convert_xgboost,
+        )
+        from xgboost import XGBClassifier, XGBRegressor
+
+        update_registered_converter(
+            XGBClassifier,
+            "XGBoostXGBClassifier",
+            calculate_linear_classifier_output_shapes,
+            convert_xgboost,
+            options=classifier_options,
+        )
+        update_registered_converter(
+            XGBRegressor,
+            "XGBoostXGBRegressor",
+            calculate_linear_regressor_output_shapes,
+            convert_xgboost,
+        )
+    except ImportError:
+        pass
+
+
+def _initial_types(frame):
+    from skl2onnx.common.data_types import (
+        FloatTensorType,
+        Int64TensorType,
+        StringTensorType,
+    )
+
+    types = []
+    for column, dtype in frame.dtypes.items():
+        if pd.api.types.is_integer_dtype(dtype):
+            types.append((column, Int64TensorType([None, 1])))
+        elif pd.api.types.is_numeric_dtype(dtype):
+            types.append((column, FloatTensorType([None, 1])))
+        else:
+            types.append((column, StringTensorType([None, 1])))
+    return types
+
+
+def _string_missing_values(estimator):
+    """
+    Make the imputers of string columns treat empty strings as missing, which is how
+    missing strings are fed to ONNX Runtime.
+    """
+    if hasattr(estimator, "transformers_"):
+        for _, transformer, _ in estimator.transformers_:
+            _string_missing_values(transformer)
+    elif hasattr(estimator, "steps"):
+        for _, step in estimator.steps:
+            _string_missing_values(step)
+    elif hasattr(estimator, "statistics_") and estimator.statistics_.dtype == object:
+        # Constant fills are already stored in statistics_ like the learned ones
+        estimator.missing_values = ""
+        estimator.fill_value = None
+
+
+def convert_model(model, frame, model_sha256):
+    """
+    Convert a fitted pipeline, preprocessing included, to an ONNX model.
+
+    Args:
+    model: A trained machine learning pipeline.
+    frame: A DataFrame of model-ready rows defining the input columns and types.
+    model_sha256: The hash of the joblib model, recorded to detect stale exports.
+
+    Returns:
+    The ONNX model proto.
+    """
+    from skl2onnx import convert_sklearn
+    from sklearn.pipeline import Pipeline
+
+    _register_converters()
+
+    # Samplers only run while fitting, so they are left out of the export
+    steps = [
+        step
+        for step in copy.deepcopy(model.steps)
+        if not hasattr(step[1], "fit_resample")
+    ]
+    for _, step in steps:
+        _string_missing_values(step)
+    pipeline = Pipeline(steps)
+    estimator = steps[-1][1]
+
+    options = {}
+    if hasattr(estimator, "classes_"):
+        options[id(estimator)] = {"zipmap": False}
+
+    onnx_model = convert_sklearn(
+        pipeline,
+        initial_types=_initial_types(frame),
+        options=options,
+        target_opset={"": 15, "ai.onnx.ml": 3},
+    )
+    metadata = onnx_model.metadata_props.add()
+    metadata.key, metadata.value = "model_sha256", model_sha256
+    return onnx_model
+
+
+class OnnxModel:
+    """
+    Runs a pipeline exported to ONNX with ONNX Runtime behind the predict and
+    predict_proba interface of the joblib model.
+
+    The joblib pipeline is kept for the features that need its internals,
+    such as the explanations.
+    """
+
+    def __init__(self, content, pipeline):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = THREADS_PER_WORKER
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(
+            content, options, providers=["CPUExecutionProvider"]
+        )
+        self.inputs = {
+            node.name: ONNX_DTYPES[node.type] for node in self.session.get_inputs()
+        }
+        self.pipeline = pipeline
+        self.classes_ = getattr(pipeline, "classes_", None)
+
+    def _run(self, frame):
+        feed = {}
+        for column, dtype in self.inputs.items():
+            values = frame[column]
+            if dtype is object:
+                values = values.where(values.notna(), "").astype(str)
+            feed[column] = values.to_numpy().astype(dtype).reshape(-1, 1)
+        return self.session.run(None, feed)
+
+    def predict(self, frame):
+        return np.asarray(self._run(frame)[0]).reshape(-1)
+
+    def predict_proba(self, frame):
+        return np.asarray(self._run(frame)[1])
+
+
+def verify_model(model, onnx_model, frame):
+    """
+    Compare the predictions of an ONNX model with those of the joblib model.
+
+    Args:
+    model: A trained machine learning pipeline.
+    onnx_model: An OnnxModel wrapping its export.
+    frame: A DataFrame of model-ready rows to compare the predictions on.
+
+    Returns:
+    The largest absolute difference between the predictions, or infinity when
+    the predicted classes differ.
+    """
+    if onnx_model.classes_ is None:
+        return float(np.abs(onnx_model.predict(frame) - model.predict(frame)).max())
+
+    if not np.array_equal(onnx_model.predict(frame), model.predict(frame)):
+        return float("inf")
+    return float(
+        np.abs(onnx_model.predict_proba(frame) - model.predict_proba(frame)).max()
+    )
+
+
+def single_row_latency(model, frame, repeats=200):
+    """
+    Returns the median time, in milliseconds, the model takes to score one row.
+    """
+    row = frame.iloc[:1]
+    if getattr(model, "classes_", None) is not None:
+        score = model.predict_proba
+    else:
+        score = model.predict
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        score(row)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings) * 1000)
+
+
+def load_onnx_model(model_path, pipeline, model_sha256):
+    """
+    Returns the ONNX Runtime model of a joblib model, or None when ONNX Runtime is
+    not installed or there is no export of this version of the model.
+    """
+    path = onnx_path(model_path)
+    if not os.path.exists(path):
+        return None
+    # Reading the export needs onnx, and running it onnxruntime
+    if importlib.util.find_spec("onnxruntime") is None:
+        return None
+    try:
+        import onnx
+    except ImportError:
+        return None
+
+    content = onnx.load(path)
+    metadata = {prop.key: prop.value for prop in content.metadata_props}
+    if metadata.get("model_sha256") != model_sha256:
+        return None
+    return OnnxModel(content.SerializeToString(), pipeline)
+
+
+if __name__ == "__main__":
+    import joblib
+    import onnx
+
+    from prediction.predictions import build_batch_frame
+    from prediction.steps import STEPS, file_sha256
+
+    parser = argparse.ArgumentParser(
+        description="Export the step models to ONNX and verify them on the test CSV files."
+    )
+    parser.add_argument("--test-csvs", default="../test_csvs")
+    parser.add_argument("--steps", nargs="*", default=list(STEPS))
+    args = parser.parse_args()
+
+    for step in args.steps:
+        config = STEPS[step]
+        path = onnx_path(config["model_path"])
+        model = joblib.load(config["model_path"])
+        records = pd.read_csv(os.path.join(args.test_csvs, f"{step}.csv")).to_dict(
+            orient="records"
+        )
+        frame = build_batch_frame(
+            [config["loan_class"](**record) for record in records]
+        )
+
+        try:
+            content = convert_model(model, frame, file_sha256(config["model_path"]))
+            onnx_model = OnnxModel(content.SerializeToString(), model)
+            difference = verify_model(model, onnx_model, frame)
+        except Exception as error:
+            difference, reason = float("inf"), f"conversion failed ({error})"
+        else:
+            reason = f"predictions differ by {difference:.2e}"
+
+        # Steps that cannot be exported faithfully keep being served from joblib
+        if difference > ONNX_TOLERANCE:
+            if os.path.exists(path):
+                os.remove(path)
+            print(f"{step}: {reason}, falling back to joblib.")
+            continue
+
+        onnx.save(content, path)
+        print(
+            f"{step}: saved {path}, predictions differ by {difference:.2e}. "
+            f"Single-row latency: {single_row_latency(onnx_model, frame):.3f} ms "
+            f"with ONNX Runtime, {single_row_latency(model, frame):.3f} ms with joblib."
+        )
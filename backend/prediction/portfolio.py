@@ -0,0 +1,229 @@
+import io
+import math
+import os
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from starlette.concurrency import run_in_threadpool
+
+from fastapi.exceptions import RequestValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.errors import ListError
+
+from prediction.formats import decode_body, is_msgpack
+from prediction.loan_batch import LoanBatch, _columns_batch
+from prediction.steps import STEPS
+
+# Loans scored at a time by the portfolio endpoints, which bounds their memory
+PORTFOLIO_CHUNK_ROWS = int(os.environ.get("LOAN_PORTFOLIO_CHUNK_ROWS", 5000))
+
+# Fields of the results of every step whose values are counted in the summary
+COUNTED_FIELDS = {
+    "step1": ["Loan_Acceptance"],
+    "step2": ["predicted_grade", "grade_category"],
+    "step3": ["predicted_subgrade", "subgrade_category"],
+    "step4": [],
+}
+
+
+class PortfolioSummary:
+    """
+    Running aggregates of the predictions of a portfolio, updated one scored
+    batch at a time. Only counts and sums are kept, so its size does not depend
+    on the number of loans.
+    """
+
+    def __init__(self, step):
+        self.step = step
+        self.rows = 0
+        self.invalid_rows = 0
+        self.invalid_fields = Counter()
+        self.loan_amount = 0.0
+        self.counts = {field: Counter() for field in COUNTED_FIELDS[step]}
+        self.accepted_proba = 0.0
+        self.rates = 0
+        self.rate_sum = 0.0
+        self.rate_min = math.inf
+        self.rate_max = -math.inf
+        self.weighted_rate_sum = 0.0
+        self.rate_loan_amount = 0.0
+
+    def add_errors(self, errors):
+        """
+        Count the loans that failed validation, and the fields they failed on.
+        """
+        self.invalid_rows += len(errors)
+        for error in errors.values():
+            for detail in error.errors():
+                self.invalid_fields[".".join(map(str, detail["loc"])) or "loan"] += 1
+
+    def update(self, loans, results):
+        """
+        Add the results of a scored batch.
+
+        Args:
+        loans: The LoanBatch that was scored.
+        results: The results of the predict function of the step, one per loan.
+        """
+        self.rows += len(loans)
+        amounts = np.asarray(loans.columns["loan_amnt"], dtype=np.float64)
+        self.loan_amount += float(np.nansum(amounts))
+        if not results:
+            return
+
+        values = [results[i] for i in range(len(loans))]
+        for field, counts in self.counts.items():
+            counts.update(value[field] for value in values)
+        if self.step == "step1":
+            self.accepted_proba += sum(value["accepted_proba"] for value in values)
+        if self.step == "step4":
+            rates = np.asarray(values, dtype=np.float64)
+            weighted = ~np.isnan(amounts)
+            self.rates += len(rates)
+            self.rate_sum += float(rates.sum())
+            self.rate_min = min(self.rate_min, float(rates.min()))
+            self.rate_max = max(self.rate_max, float(rates.max()))
+            self.weighted_rate_sum += float(rates[weighted] @ amounts[weighted])
+            self.rate_loan_amount += float(amounts[weighted].sum())
+
+    def to_dict(self):
+        summary = {
+            "step": self.step,
+            "rows": self.rows,
+            "invalid_rows": self.invalid_rows,
+            "invalid_fields": dict(self.invalid_fields.most_common()),
+            "loan_amount": self.loan_amount,
+        }
+        for field, counts in self.counts.items():
+            summary[field] = {
+                "counts": dict(sorted(counts.items())),
+                "shares": {
+                    value: count / self.rows for value, count in sorted(counts.items())
+                },
+            }
+        if self.step == "step1":
+            accepted = self.counts["Loan_Acceptance"].get("Accepted", 0)
+            summary["acceptance_rate"] = accepted / self.rows if self.rows else None
+            summary["mean_accepted_proba"] = (
+                self.accepted_proba / self.rows if self.rows else None
+            )
+        if self.step == "step3":
+            # The grade is the letter of the subgrade
+            grades = Counter()
+            for subgrade, count in self.counts["predicted_subgrade"].items():
+                grades[subgrade[0]] += count
+            summary["predicted_grade"] = {
+                "counts": dict(sorted(grades.items())),
+                "shares": {
+                    grade: count / self.rows for grade, count in sorted(grades.items())
+                },
+            }
+        if self.step == "step4":
+            summary["int_rate"] = {
+                "mean": self.rate_sum / self.rates if self.rates else None,
+                "loan_amount_weighted_mean": (
+                    self.weighted_rate_sum / self.rate_loan_amount
+                    if self.rate_loan_amount
+                    else None
+                ),
+                "min": self.rate_min if self.rates else None,
+                "max": self.rate_max if self.rates else None,
+            }
+        return summary
+
+
+async def _csv_chunks(body_chunks, chunk_rows):
+    """
+    Yields the header and the rows of a streamed CSV body as lists of
+    `chunk_rows` lines, holding at most one chunk of lines in memory. Rows are
+    split on newlines, so quoted values must not span lines.
+    """
+    header = None
+    lines = []
+    pending = b""
+    async for data in body_chunks:
+        *complete, pending = (pending + data).split(b"\n")
+        for line in complete:
+            if header is None:
+                header = line
+            elif line.strip():
+                lines.append(line)
+            if len(lines) >= chunk_rows:
+                yield header, lines
+                lines = []
+    if header is not None and pending.strip():
+        lines.append(pending)
+    if lines:
+        yield header, lines
+
+
+def _score_chunk(step, model, summary, loans, errors):
+    summary.add_errors(errors)
+    if len(loans):
+        summary.update(loans, STEPS[step]["predict"](model, loans))
+
+
+def _score_csv_chunk(step, model, summary, header, lines):
+    chunk = pd.read_csv(io.BytesIO(b"\n".join([header] + lines)))
+    loans, _, errors = LoanBatch.from_columns(
+        STEPS[step]["loan_class"],
+        {name: chunk[name].tolist() for name in chunk.columns},
+        len(chunk),
+    )
+    _score_chunk(step, model, summary, loans, errors)
+
+
+def _validate_body(loan_class, content_type, body):
+    records = decode_body(content_type, body)
+    if isinstance(records, dict) and is_msgpack(content_type):
+        loans, _, errors = _columns_batch(loan_class, records)
+    elif isinstance(records, list):
+        loans, _, errors = LoanBatch.from_records(loan_class, records)
+    else:
+        raise RequestValidationError([ErrorWrapper(ListError(), ("body",))])
+    return loans, errors
+
+
+async def summarize_portfolio(step, model, content_type, body_chunks):
+    """
+    Score a portfolio through the predict function of its step, one chunk of
+    PORTFOLIO_CHUNK_ROWS loans at a time, keeping only the running summary.
+
+    Args:
+    step: The name of the prediction step (e.g. "step3").
+    model: The model of the step.
+    content_type: "text/csv" for CSV uploads, which are read as they stream in.
+    Other bodies are decoded as a JSON or MessagePack list of loans, or a
+    MessagePack map of columns.
+    body_chunks: An async iterator over the bytes of the request body.
+
+    Returns:
+    The summary of the portfolio, as a dictionary.
+    """
+    loan_class = STEPS[step]["loan_class"]
+    summary = PortfolioSummary(step)
+
+    if content_type.startswith("text/csv"):
+        async for header, lines in _csv_chunks(body_chunks, PORTFOLIO_CHUNK_ROWS):
+            # Parsing and scoring run in a worker thread so the event loop keeps serving
+            await run_in_threadpool(
+                _score_csv_chunk, step, model, summary, header, lines
+            )
+        return summary.to_dict()
+
+    # JSON and MessagePack bodies are only read whole, so the admission budget
+    # bounds their size; they are validated at once and scored a chunk at a time
+    body = b"".join([data async for data in body_chunks])
+    loans, errors = await run_in_threadpool(
+        _validate_body, loan_class, content_type, body
+    )
+    del body
+
+    summary.add_errors(errors)
+    for start in range(0, len(loans), PORTFOLIO_CHUNK_ROWS):
+        chunk = loans.take(
+            np.arange(start, min(start + PORTFOLIO_CHUNK_ROWS, len(loans)))
+        )
+        await run_in_threadpool(_score_chunk, step, model, summary, chunk, {})
+    return summary.to_dict()
@@ -1,86 +1,186 @@
+import time
+
+import numpy as np
 import pandas as pd
 from prediction.mappings import (
     ACCEPTED_REJECTED_MAPPING,
     GRADES_MAPPING,
     SUB_GRADE_MAPPING,
 )
+from prediction.audit import record_audit
+from prediction.drift import record_drift
+from prediction.loan_batch import LoanBatch
+from prediction.metrics import record_batch
+from prediction.threads import limit_threads
+from prediction.memory import MemoryStages
+from prediction.tracing import StageSpans
 
 
-def predict_accepted_rejected(model, loans):
+def build_batch_frame(loans):
     """
-    Predict loan acceptance or rejection based on a model and loan data.
+    Stack the entry dicts of a list of loans into a single model-ready DataFrame.
 
     Args:
-    model: A trained machine learning model.
-    loans: A list of Loan objects.
+    loans: A list of Loan objects, or a LoanBatch.
 
     Returns:
-    A dictionary containing predicted acceptance/rejection for each loan.
+    A DataFrame with one row per loan, in the order of the input list.
     """
-    results = {}
-    i = 0
+    if isinstance(loans, LoanBatch):
+        return loans.to_frame()
 
+    columns = {}
     for loan in loans:
-        new_entry = pd.DataFrame.from_dict(loan.get_entry_dict())
+        for col, values in loan.get_entry_dict().items():
+            columns.setdefault(col, []).extend(values)
+    return pd.DataFrame(columns)
+
 
-        prediction = model.predict(new_entry)
-        predicted_proba = model.predict_proba(new_entry)
+def hash_rows(frame):
+    """
+    Hash every row of a batch from its feature values only.
 
-        results[i] = {
-            "Loan_Acceptance": ACCEPTED_REJECTED_MAPPING[prediction[0]],
-            "accepted_proba": predicted_proba[:, 1][0],
-            "rejected_proba": predicted_proba[:, 0][0],
-        }
-        i += 1
+    Args:
+    frame: A DataFrame with one row per loan.
 
-    return results
+    Returns:
+    A NumPy array of 64-bit row hashes.
+    """
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy()
 
 
-def predict_grade(model, loans):
+def deduplicate_batch(frame):
     """
-    Predict loan grades based on a model and loan data.
+    Collapse rows of a batch that share the same feature vector.
+
+    Args:
+    frame: A DataFrame with one row per loan.
+
+    Returns:
+    A tuple of the DataFrame of unique rows and an array mapping every original
+    row to its position in the unique DataFrame.
+    """
+    row_hashes = hash_rows(frame)
+    _, first_index, inverse = np.unique(
+        row_hashes, return_index=True, return_inverse=True
+    )
+    return frame.iloc[first_index].reset_index(drop=True), inverse.reshape(-1)
+
+
+def prepare_batch(step, loans):
+    """
+    Build the unique feature rows to score for a batch, and record its dedup ratio
+    and its feature summaries.
+
+    Args:
+    step: The name of the prediction step, used for the metrics.
+    loans: A list of Loan objects.
+
+    Returns:
+    A tuple of the DataFrame of unique rows and the inverse index used to scatter
+    the scores back to the original loans.
+    """
+    entries = build_batch_frame(loans)
+    record_drift(step, entries)
+    unique_entries, inverse = deduplicate_batch(entries)
+    record_batch(step, len(loans), len(unique_entries))
+    return unique_entries, inverse
+
+
+def _batch_stages(step, rows):
+    # The stages of a batch are traced, and their allocations accounted when
+    # the memory profiling mode traces them
+    return StageSpans(step, rows, memory=MemoryStages(step, rows))
+
+
+def predict_accepted_rejected(model, loans):
+    """
+    Predict loan acceptance or rejection based on a model and loan data.
 
     Args:
     model: A trained machine learning model.
     loans: A list of Loan objects.
 
     Returns:
-    A dictionary containing predicted grade for each loan.
+    A dictionary containing predicted acceptance/rejection for each loan.
     """
-    results = {}
-    i = 0
+    if not loans:
+        return {}
 
-    for loan in loans:
-        new_entry = pd.DataFrame.from_dict(loan.get_entry_dict())
+    started = time.perf_counter()
+    with _batch_stages("step1", len(loans)) as stages:
+        unique_entries, inverse = prepare_batch("step1", loans)
+        stages.mark("features")
 
-        main_prediction = model.predict(new_entry)
-        predicted_proba = model.predict_proba(new_entry)
+        with limit_threads(model, len(unique_entries)):
+            predictions = model.predict(unique_entries)[inverse].tolist()
+            predicted_proba = model.predict_proba(unique_entries)[inverse]
+        stages.mark("inference")
 
-        grades = list(GRADES_MAPPING.values())
-        probs = predicted_proba.tolist()[0]
+        accepted_proba = predicted_proba[:, 1].tolist()
+        rejected_proba = predicted_proba[:, 0].tolist()
 
-        grades_res = {grades[i]: probs[i] for i in range(len(grades))}
-        if max(probs) < 0.7:
-            sorted_items = sorted(grades_res.items(), key=lambda x: x[1], reverse=True)
-            res_grades = [sorted_items[0][0], sorted_items[1][0]]
-        else:
-            res_grades = max(grades_res, key=grades_res.get)
+        results = {}
+        for i, prediction in enumerate(predictions):
+            results[i] = {
+                "Loan_Acceptance": ACCEPTED_REJECTED_MAPPING[prediction],
+                "accepted_proba": accepted_proba[i],
+                "rejected_proba": rejected_proba[i],
+            }
 
-        res_grades = sorted(res_grades, reverse=False)
+        record_audit("step1", unique_entries, inverse, results, started)
+        stages.mark("results")
+        return results
 
-        if len(res_grades) == 1:
-            res_str = f"{res_grades[0]}"
-        else:
-            res_str = f"{res_grades[0]}-{res_grades[1]}"
 
-        results[i] = {
-            "grade_category": res_str,
-            "predicted_grade": GRADES_MAPPING[main_prediction[0]],
-        }
+def predict_grade(model, loans):
+    """
+    Predict loan grades based on a model and loan data.
 
-        i += 1
+    Args:
+    model: A trained machine learning model.
+    loans: A list of Loan objects.
 
-    return results
+    Returns:
+    A dictionary containing predicted grade for each loan.
+    """
+    if not loans:
+        return {}
+
+    started = time.perf_counter()
+    with _batch_stages("step2", len(loans)) as stages:
+        unique_entries, inverse = prepare_batch("step2", loans)
+        stages.mark("features")
+
+        with limit_threads(model, len(unique_entries)):
+            main_prediction = model.predict(unique_entries)
+            predicted_proba = model.predict_proba(unique_entries)
+        stages.mark("inference")
+
+        # Rank the grades of every unique row by probability, keeping the mapping
+        # order for ties, and report the two best grades when the model is unsure
+        grades = np.array(list(GRADES_MAPPING.values()))
+        ranked = grades[np.argsort(-predicted_proba, axis=1, kind="stable")]
+        uncertain = predicted_proba.max(axis=1) < 0.7
+
+        grade_categories = []
+        for row_ranked, row_uncertain in zip(ranked, uncertain):
+            if row_uncertain:
+                res_grades = sorted(row_ranked[:2])
+                grade_categories.append(f"{res_grades[0]}-{res_grades[1]}")
+            else:
+                grade_categories.append(f"{row_ranked[0]}")
+
+        results = {}
+        for i, unique_i in enumerate(inverse.tolist()):
+            results[i] = {
+                "grade_category": grade_categories[unique_i],
+                "predicted_grade": GRADES_MAPPING[main_prediction[unique_i]],
+            }
+
+        record_audit("step2", unique_entries, inverse, results, started)
+        stages.mark("results")
+        return results
 
 
 def predict_subgrade(model, loans):
@@ -94,32 +194,33 @@ def predict_subgrade(model, loans):
     Returns:
     A dictionary containing predicted subgrade for each loan.
     """
-    results = {}
-    i = 0
+    if not loans:
+        return {}
 
-    for loan in loans:
-        new_entry = pd.DataFrame.from_dict(loan.get_entry_dict())
+    with _batch_stages("step3", len(loans)) as stages:
+        unique_entries, inverse = prepare_batch("step3", loans)
+        stages.mark("features")
 
-        main_prediction = model.predict(new_entry)
-        predicted_proba = model.predict_proba(new_entry)
+        # The predicted subgrade is the most probable one, so the pipeline runs once
+        with limit_threads(model, len(unique_entries)):
+            predicted_proba = model.predict_proba(unique_entries)
+        main_prediction = np.asarray(model.classes_)[predicted_proba.argmax(axis=1)]
+        stages.mark("inference")
 
-        subgrades = list(SUB_GRADE_MAPPING.values())
-        probs = predicted_proba.tolist()[0]
+        # The subgrade category spans the five most probable subgrades of each row
+        subgrades = np.array(list(SUB_GRADE_MAPPING.values()))
+        ranked = subgrades[np.argsort(-predicted_proba, axis=1, kind="stable")[:, :5]]
+        subgrade_categories = [f"{row[0]}-{row[-1]}" for row in ranked]
 
-        subgrades_res = {subgrades[i]: probs[i] for i in range(len(subgrades))}
+        results = {}
+        for i, unique_i in enumerate(inverse.tolist()):
+            results[i] = {
+                "subgrade_category": subgrade_categories[unique_i],
+                "predicted_subgrade": SUB_GRADE_MAPPING[main_prediction[unique_i]],
+            }
 
-        sorted_items = sorted(subgrades_res.items(), key=lambda x: x[1], reverse=True)
-        res_subrades = [sorted_items[i][0] for i in range(5)]
-
-        res_str = f"{res_subrades[0]}-{res_subrades[len(res_subrades)-1]}"
-
-        results[i] = {
-            "subgrade_category": res_str,
-            "predicted_subgrade": SUB_GRADE_MAPPING[main_prediction[0]],
-        }
-        i += 1
-
-    return results
+        stages.mark("results")
+        return results
 
 
 def predict_int_rate(model, loans):
@@ -134,9 +235,17 @@ def predict_int_rate(model, loans):
         A dictionary where the keys are the indices of the loans in the `loans` list
         and the values are the predicted interest rates for each loan.
     """
-    results = {}
-    for i, loan in enumerate(loans):
-        new_entry = pd.DataFrame.from_dict(loan.get_entry_dict())
-        main_prediction = model.predict(new_entry)
-        results[i] = main_prediction[0]
-    return results
+    if not loans:
+        return {}
+
+    with _batch_stages("step4", len(loans)) as stages:
+        unique_entries, inverse = prepare_batch("step4", loans)
+        stages.mark("features")
+
+        with limit_threads(model, len(unique_entries)):
+            main_prediction = model.predict(unique_entries)[inverse].tolist()
+        stages.mark("inference")
+
+        results = dict(enumerate(main_prediction))
+        stages.mark("results")
+        return results
@@ -0,0 +1,262 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from prediction.features import loan_size_category, loan_to_income
+from prediction.loan_classes import LoanStep4
+from prediction.mappings import SUB_GRADE_MAPPING
+from prediction.predictions import build_batch_frame, hash_rows
+from prediction.steps import STEPS, file_sha256
+from prediction.threads import limit_threads
+
+# Default location of the precomputed interest rate surface
+RATE_SURFACE_PATH = "prediction/models/step4-int_rate_surface.npz"
+
+# Largest interpolation error, in interest rate points, served from the surface
+RATE_SURFACE_TOLERANCE = float(os.environ.get("LOAN_RATE_SURFACE_TOLERANCE", 0.25))
+
+# Columns that vary across the surface; every other column identifies a profile
+SURFACE_COLUMNS = [
+    "loan_amnt",
+    "term",
+    "grade",
+    "sub_grade",
+    "LTI",
+    "loan_size_category",
+]
+
+SUB_GRADES = list(SUB_GRADE_MAPPING.values())
+
+
+def profile_keys(frame):
+    """
+    Hash the columns of a batch that do not vary across the surface.
+
+    Args:
+    frame: A DataFrame of model-ready LoanStep4 rows.
+
+    Returns:
+    A NumPy array with one 64-bit profile key per row.
+    """
+    profile = frame.drop(columns=SURFACE_COLUMNS, errors="ignore")
+    profile = profile.astype(object).where(profile.notna(), None)
+    return hash_rows(profile)
+
+
+def expand_profiles(profiles, amounts, terms):
+    """
+    Repeat every profile for each combination of term, subgrade and loan amount.
+
+    Args:
+    profiles: A DataFrame of model-ready LoanStep4 rows.
+    amounts: The loan amounts of the surface.
+    terms: The terms of the surface.
+
+    Returns:
+    A DataFrame in (profile, term, subgrade, amount) order with the derived
+    features recomputed for every row.
+    """
+    grid = pd.MultiIndex.from_product(
+        [range(len(profiles)), terms, SUB_GRADES, amounts],
+        names=["profile", "term", "sub_grade", "loan_amnt"],
+    ).to_frame(index=False)
+
+    frame = profiles.iloc[grid["profile"]].reset_index(drop=True)
+    frame["loan_amnt"] = grid["loan_amnt"]
+    frame["term"] = grid["term"]
+    frame["sub_grade"] = grid["sub_grade"]
+    frame["grade"] = grid["sub_grade"].str[0]
+    frame["LTI"] = loan_to_income(frame["loan_amnt"], frame["annual_inc_joint"])
+    frame["loan_size_category"] = loan_size_category(frame["loan_amnt"])
+    return frame
+
+
+def build_rate_surface(model, model_path, profiles, amounts, terms=(36, 60)):
+    """
+    Precompute the interest rate surface of representative profiles and measure
+    its interpolation error against the live model.
+
+    The error bound of a profile is the largest difference between the model and
+    the interpolated surface at the midpoints between the surface loan amounts.
+
+    Args:
+    model: The trained interest rate model.
+    model_path: The path of the model file, recorded to detect stale surfaces.
+    profiles: A list of LoanStep4 objects.
+    amounts: The increasing loan amounts of the surface.
+    terms: The terms of the surface.
+
+    Returns:
+    A dictionary of arrays to save with `np.savez_compressed`.
+    """
+    profile_frame = build_batch_frame(profiles)
+    amounts = np.asarray(sorted(amounts), dtype=float)
+    terms = np.asarray(terms)
+    shape = (len(profiles), len(terms), len(SUB_GRADES))
+
+    rates = model.predict(expand_profiles(profile_frame, amounts, terms))
+    rates = rates.reshape(*shape, len(amounts))
+
+    midpoints = (amounts[:-1] + amounts[1:]) / 2
+    live = model.predict(expand_profiles(profile_frame, midpoints, terms))
+    interpolated = (rates[..., :-1] + rates[..., 1:]) / 2
+    errors = np.abs(live.reshape(*shape, len(midpoints)) - interpolated)
+
+    return {
+        "profile_keys": profile_keys(profile_frame),
+        "amounts": amounts,
+        "terms": terms,
+        "rates": rates.astype(np.float32),
+        "error_bound": errors.reshape(len(profiles), -1).max(axis=1),
+        "model_sha256": np.array(file_sha256(model_path)),
+    }
+
+
+class RateSurface:
+    """
+    Serves interest rates from a precomputed surface with linear interpolation
+    over the loan amount, for the profiles whose error bound is within tolerance.
+    """
+
+    def __init__(self, arrays, tolerance=RATE_SURFACE_TOLERANCE):
+        self.amounts = arrays["amounts"]
+        self.terms = arrays["terms"]
+        self.rates = arrays["rates"]
+        self.error_bound = arrays["error_bound"]
+        self.tolerance = tolerance
+        self.profiles = {
+            key: i for i, key in enumerate(arrays["profile_keys"].tolist())
+        }
+
+    @classmethod
+    def load(cls, model_path, path=RATE_SURFACE_PATH):
+        """
+        Returns the surface stored at `path`, or None when there is none or when it
+        was built from another version of the model.
+        """
+        if not os.path.exists(path):
+            return None
+        arrays = dict(np.load(path))
+        if str(arrays["model_sha256"]) != file_sha256(model_path):
+            return None
+        return cls(arrays)
+
+    def lookup(self, frame):
+        """
+        Look up the interest rates of a batch on the surface.
+
+        Args:
+        frame: A DataFrame of model-ready LoanStep4 rows.
+
+        Returns:
+        A tuple of the interpolated rates, NaN for the rows that must be scored by
+        the model, and the error bound of every row, NaN for the same rows.
+        """
+        profile = np.array(
+            [self.profiles.get(key, -1) for key in profile_keys(frame).tolist()]
+        )
+        term = np.searchsorted(self.terms, frame["term"].to_numpy())
+        sub_grade = frame["sub_grade"].map(SUB_GRADES.index).to_numpy()
+        amount = frame["loan_amnt"].to_numpy(dtype=float)
+
+        term = np.minimum(term, len(self.terms) - 1)
+        upper = np.clip(np.searchsorted(self.amounts, amount), 1, len(self.amounts) - 1)
+        lower = upper - 1
+
+        # A row is served from the surface when its profile, term and amount are
+        # covered, and its grade matches its subgrade as in every row of the surface
+        served = (
+            (profile >= 0)
+            & (self.terms[term] == frame["term"].to_numpy())
+            & (amount >= self.amounts[0])
+            & (amount <= self.amounts[-1])
+            & (frame["grade"] == frame["sub_grade"].str[0]).to_numpy()
+        )
+        served[served] &= self.error_bound[profile[served]] <= self.tolerance
+
+        rates = np.full(len(frame), np.nan)
+        bounds = np.full(len(frame), np.nan)
+        p, t, s = profile[served], term[served], sub_grade[served]
+        low, high = lower[served], upper[served]
+        weight = (amount[served] - self.amounts[low]) / (
+            self.amounts[high] - self.amounts[low]
+        )
+        rates[served] = (1 - weight) * self.rates[p, t, s, low] + weight * self.rates[
+            p, t, s, high
+        ]
+        bounds[served] = self.error_bound[p]
+        return rates, bounds
+
+
+def quote_int_rate(model, rate_surface, loans):
+    """
+    Quote the interest rate of a batch of loans from the rate surface, scoring the
+    loans it does not cover with the model in a single call.
+
+    Args:
+    model: The trained interest rate model.
+    rate_surface: A RateSurface, or None to always use the model.
+    loans: A list of LoanStep4 objects.
+
+    Returns:
+    A dictionary containing, for each loan, the interest rate, whether it came
+    from the surface or the model, and the error bound of the surface.
+    """
+    if not loans:
+        return {}
+
+    frame = build_batch_frame(loans)
+    if rate_surface is not None:
+        rates, bounds = rate_surface.lookup(frame)
+    else:
+        rates, bounds = np.full(len(frame), np.nan), np.full(len(frame), np.nan)
+
+    from_model = np.isnan(rates)
+    if from_model.any():
+        with limit_threads(model, int(from_model.sum())):
+            rates[from_model] = model.predict(frame[from_model])
+
+    results = {}
+    for i, (rate, bound, modelled) in enumerate(
+        zip(rates.tolist(), bounds.tolist(), from_model.tolist())
+    ):
+        results[i] = {
+            "int_rate": rate,
+            "source": "model" if modelled else "surface",
+            "error_bound": None if modelled else bound,
+        }
+    return results
+
+
+if __name__ == "__main__":
+    import joblib
+
+    parser = argparse.ArgumentParser(
+        description="Build the precomputed interest rate surface of the step 4 model."
+    )
+    parser.add_argument(
+        "profiles", help="CSV file of representative LoanStep4 applicants"
+    )
+    parser.add_argument("--output", default=RATE_SURFACE_PATH)
+    parser.add_argument("--min-amount", type=float, default=1000.0)
+    parser.add_argument("--max-amount", type=float, default=40000.0)
+    parser.add_argument("--amount-step", type=float, default=500.0)
+    args = parser.parse_args()
+
+    model_path = STEPS["step4"]["model_path"]
+    records = pd.read_csv(args.profiles).to_dict(orient="records")
+    surface = build_rate_surface(
+        joblib.load(model_path),
+        model_path,
+        [LoanStep4(**record) for record in records],
+        np.arange(
+            args.min_amount, args.max_amount + args.amount_step, args.amount_step
+        ),
+    )
+    np.savez_compressed(args.output, **surface)
+    print(
+        f"Saved a surface of {len(records)} profiles to {args.output}. "
+        f"Error bounds: max {surface['error_bound'].max():.4f}, "
+        f"median {np.median(surface['error_bound']):.4f} interest rate points."
+    )
@@ -0,0 +1,308 @@
+import argparse
+import contextlib
+import gzip
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from prediction.cascade import ModelCascade
+from prediction.loan_batch import LoanBatch
+from prediction.predictions import hash_rows
+from prediction.steps import STEPS, file_sha256, load_model
+
+# Directory holding the fingerprint store of every step
+RESCORE_DIR = os.environ.get("LOAN_RESCORE_DIR", "rescore")
+
+# Rows of a portfolio file read, validated and scored at a time
+RESCORE_CHUNK_SIZE = int(os.environ.get("LOAN_RESCORE_CHUNK_SIZE", 50000))
+
+
+def _connect(path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    # The output of every scored feature row, for every model version
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS scores (
+            row_hash INTEGER NOT NULL,
+            model_version TEXT NOT NULL,
+            output TEXT NOT NULL,
+            PRIMARY KEY (row_hash, model_version)
+        ) WITHOUT ROWID
+        """
+    )
+    # The rows of the last run, and of the run in progress, by key
+    for table in ("rows", "next_rows"):
+        connection.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                row_hash INTEGER NOT NULL,
+                output TEXT NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+    connection.execute(
+        "CREATE TEMP TABLE chunk (position INTEGER PRIMARY KEY, key TEXT, row_hash INTEGER)"
+    )
+    # The keys of the rows of the run in progress that failed validation
+    connection.execute("CREATE TEMP TABLE invalid_keys (key TEXT PRIMARY KEY)")
+    connection.commit()
+    return connection
+
+
+def model_version(step, model):
+    """
+    Returns the version of the outputs of a step model: the SHA-256 of its file,
+    with the threshold of the cascade it is served with, if any.
+    """
+    version = file_sha256(STEPS[step]["model_path"])
+    if isinstance(model, ModelCascade):
+        version += f"+cascade{model.threshold}"
+    return version
+
+
+def _diff_line(key, status, previous, output):
+    return (
+        f'{{"key": {json.dumps(key)}, "status": "{status}", '
+        f'"previous": {previous or "null"}, "prediction": {output or "null"}}}\n'
+    )
+
+
+def rescore_file(
+    step,
+    input_path,
+    output_path,
+    diff_path=None,
+    key=None,
+    model=None,
+    store_path=None,
+    chunk_size=RESCORE_CHUNK_SIZE,
+):
+    """
+    Score a portfolio CSV file, copying the outputs of the rows whose features were
+    already scored by the same model version and scoring only the others.
+
+    Every row is fingerprinted by the hash of its model features. The store keeps
+    the output of every fingerprint for the current model version, and the
+    fingerprint and output of every row of the last run, by key. Rows are matched
+    with the last run by their key to report what changed.
+
+    Args:
+    step: The name of the prediction step (e.g. "step3").
+    input_path: The portfolio CSV file.
+    output_path: The gzipped JSON lines file to write the outputs to, one line
+    per row with its key and either its prediction or its validation errors.
+    diff_path: An optional gzipped JSON lines file to write the rows that are new,
+    removed, changed, invalid, or whose output changed with the model since the
+    last run.
+    key: The column identifying the rows across runs. Rows are identified by
+    their position in the file when it is not given.
+    model: The model of the step, loaded with load_model when not given.
+    store_path: The fingerprint store, RESCORE_DIR/<step>.sqlite3 by default.
+    chunk_size: The number of rows read and scored at a time.
+
+    Returns:
+    A dictionary summarising the run.
+    """
+    started = time.perf_counter()
+    config = STEPS[step]
+    if model is None:
+        model = load_model(step)
+    version = model_version(step, model)
+    connection = _connect(store_path or os.path.join(RESCORE_DIR, f"{step}.sqlite3"))
+    with connection:
+        connection.execute("DELETE FROM next_rows")
+
+    summary = dict.fromkeys(
+        [
+            "rows",
+            "invalid",
+            "scored",
+            "copied",
+            "new",
+            "changed",
+            "model_changed",
+            "unchanged",
+            "removed",
+        ],
+        0,
+    )
+    offset = 0
+    with contextlib.ExitStack() as stack:
+        output_file = stack.enter_context(gzip.open(output_path, "wt"))
+        diff_file = None
+        if diff_path is not None:
+            diff_file = stack.enter_context(gzip.open(diff_path, "wt"))
+
+        for chunk in pd.read_csv(input_path, chunksize=chunk_size):
+            if key is None:
+                keys = [str(i) for i in range(offset, offset + len(chunk))]
+            else:
+                keys = chunk[key].astype(str).tolist()
+            offset += len(chunk)
+            summary["rows"] += len(chunk)
+
+            # The columns of the file are validated as they are, without records
+            loans, valid, errors = LoanBatch.from_columns(
+                config["loan_class"],
+                {name: chunk[name].tolist() for name in chunk.columns},
+                len(chunk),
+            )
+            for i, error in errors.items():
+                output_file.write(
+                    json.dumps({"key": keys[i], "error": error.errors()}, default=str)
+                    + "\n"
+                )
+            summary["invalid"] += len(errors)
+            if errors:
+                invalid_keys = [keys[i] for i in errors]
+                try:
+                    with connection:
+                        connection.executemany(
+                            "INSERT INTO invalid_keys VALUES (?)",
+                            [(row_key,) for row_key in invalid_keys],
+                        )
+                except sqlite3.IntegrityError:
+                    raise ValueError(
+                        f"the {key} column holds duplicate keys."
+                    ) from None
+            if not len(loans):
+                continue
+
+            keys = [keys[i] for i in valid.tolist()]
+            hashes = hash_rows(loans.to_frame()).view(np.int64).tolist()
+
+            connection.execute("DELETE FROM chunk")
+            connection.executemany(
+                "INSERT INTO chunk VALUES (?, ?, ?)",
+                zip(range(len(keys)), keys, hashes),
+            )
+            outputs = [None] * len(keys)
+            for position, output in connection.execute(
+                "SELECT chunk.position, scores.output FROM chunk JOIN scores "
+                "ON scores.row_hash = chunk.row_hash AND scores.model_version = ?",
+                (version,),
+            ):
+                outputs[position] = output
+            previous = {
+                position: (row_hash, output)
+                for position, row_hash, output in connection.execute(
+                    "SELECT chunk.position, rows.row_hash, rows.output "
+                    "FROM chunk JOIN rows ON rows.key = chunk.key"
+                )
+            }
+
+            # Only the rows whose features were never scored by this model run it
+            missing = [i for i, output in enumerate(outputs) if output is None]
+            if missing:
+                predictions = config["predict"](model, loans.take(missing))
+                for j, i in enumerate(missing):
+                    outputs[i] = json.dumps(predictions[j])
+            summary["scored"] += len(missing)
+            summary["copied"] += len(keys) - len(missing)
+
+            for i, (row_key, output) in enumerate(zip(keys, outputs)):
+                output_file.write(
+                    f'{{"key": {json.dumps(row_key)}, "prediction": {output}}}\n'
+                )
+                row_hash, previous_output = previous.get(i, (None, None))
+                if row_hash is None:
+                    status = "new"
+                elif row_hash != hashes[i]:
+                    status = "changed"
+                elif previous_output != output:
+                    status = "model_changed"
+                else:
+                    status = "unchanged"
+                summary[status] += 1
+                if diff_file is not None and status != "unchanged":
+                    diff_file.write(
+                        _diff_line(row_key, status, previous_output, output)
+                    )
+
+            try:
+                with connection:
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO scores VALUES (?, ?, ?)",
+                        [(hashes[i], version, outputs[i]) for i in missing],
+                    )
+                    connection.executemany(
+                        "INSERT INTO next_rows VALUES (?, ?, ?)",
+                        zip(keys, hashes, outputs),
+                    )
+            except sqlite3.IntegrityError:
+                raise ValueError(f"the {key} column holds duplicate keys.") from None
+
+        # Invalid rows are still in the file, so they are reported as invalid
+        # rather than removed
+        if diff_file is not None:
+            for row_key, previous_output in connection.execute(
+                "SELECT invalid_keys.key, rows.output FROM invalid_keys "
+                "LEFT JOIN rows ON rows.key = invalid_keys.key"
+            ):
+                diff_file.write(_diff_line(row_key, "invalid", previous_output, None))
+
+        for row_key, previous_output in connection.execute(
+            "SELECT key, output FROM rows WHERE key NOT IN (SELECT key FROM next_rows) "
+            "AND key NOT IN (SELECT key FROM invalid_keys)"
+        ):
+            summary["removed"] += 1
+            if diff_file is not None:
+                diff_file.write(_diff_line(row_key, "removed", previous_output, None))
+
+    # The rows of this run become the last run, and only the outputs they use are
+    # kept. Invalid rows keep their last valid features and output
+    with connection:
+        connection.execute(
+            "INSERT OR IGNORE INTO next_rows SELECT * FROM rows "
+            "WHERE key IN (SELECT key FROM invalid_keys)"
+        )
+        connection.execute("DROP TABLE rows")
+        connection.execute("ALTER TABLE next_rows RENAME TO rows")
+        connection.execute(
+            "CREATE TABLE next_rows (key TEXT PRIMARY KEY, row_hash INTEGER NOT NULL, "
+            "output TEXT NOT NULL) WITHOUT ROWID"
+        )
+        connection.execute(
+            "DELETE FROM scores WHERE model_version != ? "
+            "OR row_hash NOT IN (SELECT row_hash FROM rows)",
+            (version,),
+        )
+    connection.close()
+
+    summary["model_version"] = version
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score a portfolio CSV file, re-scoring only the rows that changed "
+        "since the last run."
+    )
+    parser.add_argument("step", choices=list(STEPS))
+    parser.add_argument("input_csv")
+    parser.add_argument("output", help="gzipped JSON lines file of the outputs")
+    parser.add_argument("--diff", help="gzipped JSON lines file of the changed rows")
+    parser.add_argument("--key", help="column identifying the rows across runs")
+    parser.add_argument("--store", help="fingerprint store of the step")
+    parser.add_argument("--chunk-size", type=int, default=RESCORE_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    summary = rescore_file(
+        args.step,
+        args.input_csv,
+        args.output,
+        diff_path=args.diff,
+        key=args.key,
+        store_path=args.store,
+        chunk_size=args.chunk_size,
+    )
+    print(json.dumps(summary, indent=2))
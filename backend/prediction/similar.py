@@ -0,0 +1,290 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import MiniBatchKMeans
+
+from prediction.loan_batch import LoanBatch
+from prediction.steps import STEPS
+from prediction.tracing import span
+
+# Default location of the similar loans index of a step: the quantized loans in
+# a .npy file, memory-mapped when loaded, and the rest of the index in a .npz file
+SIMILAR_INDEX_PATH = "prediction/models/{step}-similar_loans"
+
+# Historical loan columns returned with every similar loan, when the dataset has them
+SIMILAR_LABELS = ["id", "grade", "sub_grade", "int_rate", "loan_amnt", "loan_status"]
+
+# Standardized features are clipped to this many standard deviations and stored
+# as int8, so the index takes a quarter of the memory of float32 features
+QUANTIZATION_RANGE = 4.0
+
+# Lists of the index searched for every loan; more lists find the exact nearest
+# loans more often, at a proportional cost. See benchmarks/similar_loans.py
+SIMILAR_PROBES = int(os.environ.get("LOAN_SIMILAR_PROBES", 8))
+
+
+def numeric_columns(loan_class):
+    """
+    Returns the names of the numeric fields of a Loan class.
+    """
+    return [
+        name
+        for name, field in loan_class.__fields__.items()
+        if issubclass(field.type_, (int, float))
+    ]
+
+
+def feature_matrix(loans, columns):
+    """
+    Returns the numeric features of a LoanBatch as a float64 array, with NaN for
+    missing values.
+    """
+    return np.column_stack(
+        [np.asarray(loans.columns[name], dtype=np.float64) for name in columns]
+    )
+
+
+def quantize(standardized, step_size):
+    """
+    Returns the int8 codes of standardized features, with 0 (the mean) for
+    missing values.
+    """
+    standardized = np.nan_to_num(standardized, nan=0.0)
+    return np.clip(np.rint(standardized / step_size), -127, 127).astype(np.int8)
+
+
+def build_similar_index(step, records, labels, lists=None):
+    """
+    Build the similar loans index of a step from historical loans.
+
+    Every numeric feature is standardized with the mean and standard deviation
+    of the historical loans, missing values take the mean, and the standardized
+    values are quantized to int8. The loans are then clustered with k-means into
+    lists, and stored list by list.
+
+    Args:
+    step: The name of the prediction step (e.g. "step2").
+    records: A DataFrame of historical loans with the fields of the Loan class
+    of the step, and the label columns.
+    labels: The columns of `records` returned with every similar loan.
+    lists: The number of lists, 4 * sqrt(loans) by default.
+
+    Returns:
+    A tuple of the int8 codes of the valid loans in list order, and a dictionary
+    of the other arrays of the index to save with `np.savez`.
+    """
+    loan_class = STEPS[step]["loan_class"]
+    columns = numeric_columns(loan_class)
+    loans, valid, _ = LoanBatch.from_columns(
+        loan_class,
+        {name: records[name].tolist() for name in records.columns},
+        len(records),
+    )
+    features = feature_matrix(loans, columns)
+    mean = np.nanmean(features, axis=0)
+    scale = np.nanstd(features, axis=0)
+    scale[~(scale > 0)] = 1.0
+    mean[np.isnan(mean)] = 0.0
+
+    step_size = QUANTIZATION_RANGE / 127
+    codes = quantize((features - mean) / scale, step_size)
+    dequantized = codes.astype(np.float32) * step_size
+
+    lists = min(lists or int(4 * np.sqrt(len(codes))), len(codes))
+    kmeans = MiniBatchKMeans(n_clusters=lists, n_init=1, random_state=0)
+    assignments = kmeans.fit_predict(dequantized)
+    order = np.argsort(assignments, kind="stable")
+    offsets = np.searchsorted(assignments[order], np.arange(lists + 1))
+
+    arrays = {
+        "columns": np.array(columns),
+        "mean": mean,
+        "scale": scale,
+        "step_size": np.array(step_size),
+        "centroids": kmeans.cluster_centers_.astype(np.float32),
+        "offsets": offsets,
+        "norms": (dequantized[order] ** 2).sum(axis=1),
+        "rows": valid[order],
+    }
+    for name in labels:
+        values = records[name].to_numpy()[valid[order]]
+        if values.dtype == object:
+            # String labels are stored as a fixed-width array, which loads without pickle
+            values = pd.Series(values).fillna("").astype(str).to_numpy(dtype=str)
+        arrays[f"label_{name}"] = values
+    return codes[order], arrays
+
+
+class SimilarLoanIndex:
+    """
+    Inverted file index of historical loans in the standardized feature space.
+
+    The loans are stored as int8 codes in a memory-mapped .npy file, grouped by
+    the k-means list they belong to, so workers share the pages of one index and
+    a search only reads the lists it probes. Every loan is compared with the
+    loans of the SIMILAR_PROBES lists whose centroids are nearest to it, and the
+    loans probing the same list are compared with it in one matrix product.
+    """
+
+    def __init__(self, codes, arrays, probes=SIMILAR_PROBES):
+        self.codes = codes
+        self.columns = arrays["columns"].tolist()
+        self.mean = arrays["mean"]
+        self.scale = arrays["scale"]
+        self.step_size = float(arrays["step_size"])
+        self.centroids = arrays["centroids"]
+        self.offsets = arrays["offsets"]
+        self.norms = arrays["norms"]
+        self.rows = arrays["rows"]
+        self.labels = {
+            name[len("label_") :]: arrays[name]
+            for name in arrays
+            if name.startswith("label_")
+        }
+        self.probes = min(probes, len(self.centroids))
+
+    @classmethod
+    def load(cls, step, path=None):
+        """
+        Returns the index of a step stored at `path`, or None when there is none.
+        """
+        path = path or SIMILAR_INDEX_PATH.format(step=step)
+        if not os.path.exists(f"{path}.npy"):
+            return None
+        codes = np.load(f"{path}.npy", mmap_mode="r")
+        return cls(codes, dict(np.load(f"{path}.npz")))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def search(self, loans, k):
+        """
+        Find the k historical loans nearest to every loan of a batch.
+
+        Args:
+        loans: A LoanBatch of the Loan class the index was built for.
+        k: The number of similar loans to return for every loan.
+
+        Returns:
+        A tuple of the positions of the similar loans in the index and their
+        Euclidean distances in the standardized feature space, two arrays of
+        shape (len(loans), k) nearest first. Positions are -1 and distances
+        infinite when the probed lists hold fewer than k loans.
+        """
+        features = (feature_matrix(loans, self.columns) - self.mean) / self.scale
+        # Queries are quantized like the index so that missing values and
+        # outliers are treated the same on both sides
+        queries = quantize(features, self.step_size).astype(np.float32)
+        queries *= self.step_size
+        query_norms = (queries * queries).sum(axis=1)
+
+        # The squared norm of a query does not change its ranking, and is only
+        # added back at the end
+        centroid_distances = (self.centroids * self.centroids).sum(axis=1) - 2 * (
+            queries @ self.centroids.T
+        )
+        probed = np.argpartition(centroid_distances, self.probes - 1, axis=1)
+        probed = probed[:, : self.probes].reshape(-1)
+
+        # The k nearest loans of every (query, probed list) pair
+        distances = np.full((len(probed), k), np.inf, dtype=np.float32)
+        positions = np.full((len(probed), k), -1, dtype=np.int64)
+        order = np.argsort(probed, kind="stable")
+        bounds = np.searchsorted(probed[order], np.arange(len(self.centroids) + 1))
+        for list_id in np.flatnonzero(np.diff(bounds)).tolist():
+            start, stop = self.offsets[list_id], self.offsets[list_id + 1]
+            if start == stop:
+                continue
+            pairs = order[bounds[list_id] : bounds[list_id + 1]]
+            block = self.codes[start:stop].astype(np.float32)
+            block *= self.step_size
+            list_distances = self.norms[start:stop] - 2 * (
+                queries[pairs // self.probes] @ block.T
+            )
+            nearest = min(k, stop - start)
+            if nearest < stop - start:
+                kept = np.argpartition(list_distances, nearest - 1, axis=1)
+                kept = kept[:, :nearest]
+            else:
+                kept = np.broadcast_to(np.arange(nearest), (len(pairs), nearest))
+            distances[pairs, :nearest] = np.take_along_axis(
+                list_distances, kept, axis=1
+            )
+            positions[pairs, :nearest] = kept + start
+
+        distances = distances.reshape(len(queries), -1)
+        positions = positions.reshape(len(queries), -1)
+        nearest = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        distances = np.take_along_axis(distances, nearest, axis=1)
+        positions = np.take_along_axis(positions, nearest, axis=1)
+        distances += query_norms[:, None]
+        return positions, np.sqrt(np.maximum(distances, 0))
+
+
+def find_similar_loans(index, loans, k=5):
+    """
+    Look up the historical loans most similar to every loan of a batch.
+
+    Args:
+    index: The SimilarLoanIndex of the step.
+    loans: A LoanBatch.
+    k: The number of similar loans to return for every loan.
+
+    Returns:
+    A dictionary mapping the position of every loan to the list of its similar
+    loans, nearest first, each with its row in the historical dataset, its
+    distance and the label columns of the index.
+    """
+    if not len(loans) or not len(index):
+        return {i: [] for i in range(len(loans))}
+
+    with span("similar_loans.search", rows=len(loans), k=k, probes=index.probes):
+        positions, distances = index.search(loans, k)
+    found = positions >= 0
+    positions = np.where(found, positions, 0)
+    rows = index.rows[positions].tolist()
+    labels = {name: values[positions].tolist() for name, values in index.labels.items()}
+    results = {}
+    for i, row_distances in enumerate(distances.tolist()):
+        similar = []
+        for j, distance in enumerate(row_distances):
+            if not found[i, j]:
+                break
+            loan = {"row": rows[i][j], "distance": round(distance, 4)}
+            for name, values in labels.items():
+                value = values[i][j]
+                loan[name] = None if value == "" or value != value else value
+            similar.append(loan)
+        results[i] = similar
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the similar loans index of a step from historical loans."
+    )
+    parser.add_argument("step", choices=["step2", "step3"])
+    parser.add_argument("loans", help="CSV file of historical loans")
+    parser.add_argument("--output", help="index path, without extension")
+    parser.add_argument(
+        "--labels",
+        nargs="*",
+        default=SIMILAR_LABELS,
+        help="columns returned with every similar loan, when the file has them",
+    )
+    parser.add_argument("--lists", type=int, help="number of k-means lists")
+    args = parser.parse_args()
+
+    records = pd.read_csv(args.loans, low_memory=False)
+    labels = [name for name in args.labels if name in records.columns]
+    codes, arrays = build_similar_index(args.step, records, labels, args.lists)
+    output = args.output or SIMILAR_INDEX_PATH.format(step=args.step)
+    np.save(f"{output}.npy", codes)
+    np.savez(f"{output}.npz", **arrays)
+    print(
+        f"Saved an index of {len(codes)} of {len(records)} loans, "
+        f"{codes.shape[1]} features and {len(arrays['centroids'])} lists to "
+        f"{output}.npy, with the labels {labels}."
+    )
@@ -0,0 +1,85 @@
+import hashlib
+
+import joblib
+from prediction.cascade import SUBGRADE_CASCADE, build_cascade
+from prediction.inference import INFERENCE_SOCKETS, RemoteModel
+from prediction.loan_classes import LoanStep1, LoanStep2, LoanStep3, LoanStep4
+from prediction.onnx_backend import load_onnx_model, onnx_enabled
+from prediction.predictions import (
+    predict_accepted_rejected,
+    predict_grade,
+    predict_subgrade,
+    predict_int_rate,
+)
+from prediction.threads import configure_model
+
+# The input class, prediction function and pre-trained model of every step
+STEPS = {
+    "step1": {
+        "loan_class": LoanStep1,
+        "predict": predict_accepted_rejected,
+        "model_path": "prediction/models/step1-status_classifier.joblib",
+    },
+    "step2": {
+        "loan_class": LoanStep2,
+        "predict": predict_grade,
+        "model_path": "prediction/models/step2-grade_classifier.joblib",
+    },
+    "step3": {
+        "loan_class": LoanStep3,
+        "predict": predict_subgrade,
+        "model_path": "prediction/models/step3-subgrade_classifier.joblib",
+    },
+    "step4": {
+        "loan_class": LoanStep4,
+        "predict": predict_int_rate,
+        "model_path": "prediction/models/step4-int_rate_pred.joblib",
+    },
+}
+
+
+def file_sha256(path):
+    """
+    Returns the SHA-256 hash of a model file, used to detect stale derived artifacts.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as model_file:
+        for block in iter(lambda: model_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_model(step):
+    """
+    Load the pre-trained model of a step. Its estimator runs in the shared inference
+    process when one is configured, and it is served with ONNX Runtime when the
+    step is configured to and a verified export of the model exists. Otherwise the
+    subgrade model is served as a cascade when LOAN_SUBGRADE_CASCADE=1.
+
+    Args:
+    step: The name of the prediction step (e.g. "step3").
+
+    Returns:
+    The joblib model, a RemoteModel, an OnnxModel or a ModelCascade.
+    """
+    model_path = STEPS[step]["model_path"]
+    model = configure_model(joblib.load(model_path))
+    if INFERENCE_SOCKETS:
+        return RemoteModel(step, model)
+    if onnx_enabled(step):
+        onnx_model = load_onnx_model(model_path, model, file_sha256(model_path))
+        if onnx_model is not None:
+            return onnx_model
+    if step == "step3" and SUBGRADE_CASCADE:
+        return build_cascade(step, model)
+    return model
+
+
+def load_models():
+    """
+    Load the pre-trained model of every step.
+
+    Returns:
+    A dictionary mapping each step name to its model.
+    """
+    return {step: load_model(step) for step in STEPS}
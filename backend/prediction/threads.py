@@ -0,0 +1,131 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from threadpoolctl import ThreadpoolController
+
+
+def available_cores():
+    """
+    Returns the number of cores this process may use, honouring the CPU affinity
+    and the cgroup CPU quota of the container.
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != "max":
+            cores = min(cores, max(int(quota) // int(period), 1))
+    except (OSError, ValueError):
+        pass
+    return cores
+
+
+# Number of web workers sharing the cores, as passed to gunicorn in the Procfile
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", 4))
+
+# Native threads each worker may use when scoring a large batch
+THREADS_PER_WORKER = int(
+    os.environ.get(
+        "LOAN_THREADS_PER_WORKER", max(available_cores() // max(WORKERS, 1), 1)
+    )
+)
+
+# Batches with fewer unique rows than this are scored single-threaded, where the
+# cost of starting threads outweighs the work; see benchmarks/thread_crossover.py
+SMALL_BATCH_ROWS = int(os.environ.get("LOAN_SMALL_BATCH_ROWS", 512))
+
+# Controls the OpenMP and BLAS thread pools of the loaded native libraries
+_controller = None
+
+# The (model, threads) of every batch being scored by this worker. Handlers run
+# on a thread pool, so batches overlap, while the OpenMP and BLAS limits are
+# process-wide and the estimators are shared; both are only changed under the
+# lock, to the largest thread count of the batches in progress
+_active_batches = []
+_active_lock = threading.Lock()
+_applied_threads = None
+
+
+def batch_threads(rows):
+    """
+    Returns the number of native threads to score a batch of `rows` rows with.
+    """
+    return 1 if rows < SMALL_BATCH_ROWS else THREADS_PER_WORKER
+
+
+def _estimators(model):
+    # Models served with ONNX Runtime or a shared inference process wrap a pipeline
+    model = getattr(model, "pipeline", model)
+    if hasattr(model, "steps"):
+        return [step for _, step in model.steps]
+    return [model]
+
+
+def set_model_threads(model, threads):
+    """
+    Set the number of threads the LightGBM and XGBoost estimators of a model use.
+    """
+    for estimator in _estimators(model):
+        if hasattr(estimator, "booster_") or hasattr(estimator, "get_booster"):
+            if estimator.get_params().get("n_jobs") == threads:
+                continue
+            estimator.set_params(n_jobs=threads)
+
+            # XGBoost reads the thread count from its booster once fitted
+            if hasattr(estimator, "get_booster"):
+                estimator.get_booster().set_param({"nthread": threads})
+
+
+def configure_model(model):
+    """
+    Apply the per-worker thread budget to a freshly loaded model.
+    """
+    set_model_threads(model, THREADS_PER_WORKER)
+    return model
+
+
+def _apply_limits():
+    # Called with _active_lock held
+    global _controller, _applied_threads
+    if _controller is None:
+        _controller = ThreadpoolController()
+
+    threads = max((t for _, t in _active_batches), default=THREADS_PER_WORKER)
+    if threads != _applied_threads:
+        _controller.limit(limits=threads)
+        _applied_threads = threads
+
+    models = {}
+    for model, model_threads in _active_batches:
+        models[id(model)] = (
+            model,
+            max(model_threads, models.get(id(model), (0, 0))[1]),
+        )
+    for model, model_threads in models.values():
+        set_model_threads(model, model_threads)
+
+
+@contextmanager
+def limit_threads(model, rows):
+    """
+    Score a batch of `rows` rows with the thread count the policy picks for it,
+    limiting the estimators and the OpenMP and BLAS pools of the process.
+
+    When batches overlap, they all run with the largest thread count among them,
+    and the limits go back to the worker budget once the last one ends.
+    """
+    batch = (model, batch_threads(rows))
+    with _active_lock:
+        _active_batches.append(batch)
+        _apply_limits()
+    try:
+        yield
+    finally:
+        with _active_lock:
+            _active_batches.remove(batch)
+            _apply_limits()
@@ -0,0 +1,379 @@
+import atexit
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import urllib.request
+from collections import deque
+
+# JSON lines file the spans of this worker are appended to
+TRACE_FILE = os.environ.get("LOAN_TRACE_FILE", "")
+
+# OTLP/HTTP traces endpoint of a local collector the spans are sent to, e.g.
+# http://localhost:4318/v1/traces
+TRACE_OTLP_ENDPOINT = os.environ.get("LOAN_TRACE_OTLP_ENDPOINT", "")
+
+# Spans are only recorded when they are exported somewhere
+TRACING = bool(TRACE_FILE or TRACE_OTLP_ENDPOINT)
+
+# Service name of the spans of this process
+TRACE_SERVICE = os.environ.get("LOAN_TRACE_SERVICE", "loan-prediction-backend")
+
+# Spans a worker may hold in memory waiting to be exported; newer spans are dropped
+TRACE_MAX_PENDING_SPANS = 10000
+
+# The exporter writes once this many spans are waiting, or every TRACE_FLUSH_SECONDS
+TRACE_BATCH_SPANS = 512
+TRACE_FLUSH_SECONDS = 1.0
+
+# The span the code running in this context belongs to
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+# OTLP span kinds
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+
+class Span:
+    """
+    A timed operation of a trace, identified like a W3C trace context.
+    """
+
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "kind",
+        "start_ns",
+        "end_ns",
+        "attributes",
+    )
+
+    def __init__(self, name, trace_id, parent_id, kind, attributes):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "service": TRACE_SERVICE,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+        }
+
+
+def parse_traceparent(header):
+    """
+    Returns the (trace id, parent span id) of a W3C traceparent header, or None
+    when it is missing or invalid.
+    """
+    parts = (header or "").strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2]
+
+
+def current_traceparent():
+    """
+    Returns the traceparent header of the current span, or None outside of a trace.
+    """
+    span = _current_span.get()
+    return span.traceparent if span is not None else None
+
+
+@contextlib.contextmanager
+def span(name, parent=None, kind="internal", **attributes):
+    """
+    Record a span around a block of code, as a child of the current span or of
+    `parent`, a (trace id, span id) tuple of a remote caller. Starts a new trace
+    when there is neither. Does nothing unless tracing is enabled.
+
+    Yields:
+    The Span, or None when tracing is disabled.
+    """
+    if not TRACING:
+        yield None
+        return
+
+    current = _current_span.get()
+    if parent is None and current is not None:
+        parent = (current.trace_id, current.span_id)
+    trace_id, parent_id = parent if parent is not None else (os.urandom(16).hex(), None)
+    new_span = Span(name, trace_id, parent_id, kind, attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as error:
+        attributes["error"] = type(error).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.end_ns = time.time_ns()
+        get_exporter().submit(new_span)
+
+
+class StageSpans:
+    """
+    Records the consecutive stages of a batch as spans of the current trace.
+    Every call to `mark` closes the stage that started at the previous mark.
+
+    The allocations of the stages are also accounted by `memory`, an optional
+    MemoryStages, which the `with` block enters and exits.
+    """
+
+    def __init__(self, step, rows, memory=None):
+        self.step = step
+        self.rows = rows
+        self.memory = memory
+
+    def __enter__(self):
+        if self.memory is not None:
+            self.memory.__enter__()
+        self.stage_start_ns = time.time_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.memory is not None:
+            self.memory.__exit__(*exc_info)
+
+    def mark(self, stage):
+        if self.memory is not None:
+            self.memory.mark(stage)
+        if not TRACING or _current_span.get() is None:
+            return
+        current = _current_span.get()
+        stage_span = Span(
+            f"{self.step}.{stage}",
+            current.trace_id,
+            current.span_id,
+            "internal",
+            {"rows": self.rows},
+        )
+        stage_span.start_ns = self.stage_start_ns
+        stage_span.end_ns = self.stage_start_ns = time.time_ns()
+        get_exporter().submit(stage_span)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_request(spans, service=TRACE_SERVICE):
+    """
+    Returns the OTLP/JSON export request of a list of spans.
+    """
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": service}}
+                    ]
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": "prediction"},
+                        "spans": [
+                            {
+                                "traceId": span.trace_id,
+                                "spanId": span.span_id,
+                                "parentSpanId": span.parent_id or "",
+                                "name": span.name,
+                                "kind": SPAN_KINDS[span.kind],
+                                "startTimeUnixNano": str(span.start_ns),
+                                "endTimeUnixNano": str(span.end_ns),
+                                "attributes": [
+                                    {"key": key, "value": _otlp_value(value)}
+                                    for key, value in span.attributes.items()
+                                ],
+                            }
+                            for span in spans
+                        ],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+class SpanExporter:
+    """
+    Bounded in-memory queue of finished spans, exported in batches by a
+    background thread to a JSON lines file and/or an OTLP/HTTP collector.
+
+    Requests only append their spans; serialising and writing them happen in the
+    exporter thread. Spans that do not fit in the queue, or that the collector
+    does not accept, are dropped and counted, so tracing never slows requests
+    down or fails them.
+    """
+
+    def __init__(
+        self,
+        path=TRACE_FILE,
+        endpoint=TRACE_OTLP_ENDPOINT,
+        max_spans=TRACE_MAX_PENDING_SPANS,
+        batch_spans=TRACE_BATCH_SPANS,
+        flush_seconds=TRACE_FLUSH_SECONDS,
+    ):
+        self.path = path
+        self.endpoint = endpoint
+        self.max_spans = max_spans
+        self.batch_spans = batch_spans
+        self.flush_seconds = flush_seconds
+        self.condition = threading.Condition()
+        self.pending = deque()
+        self.exported_spans = 0
+        self.dropped_spans = 0
+        self.writer = None
+        self.writer_pid = None
+        self.closing = False
+
+    def submit(self, span):
+        with self.condition:
+            self._ensure_writer()
+            if len(self.pending) >= self.max_spans:
+                self.dropped_spans += 1
+                return
+            self.pending.append(span)
+            if len(self.pending) >= self.batch_spans:
+                self.condition.notify_all()
+
+    def _ensure_writer(self):
+        # Worker processes forked after the first request need their own thread
+        if self.writer_pid == os.getpid() and self.writer.is_alive():
+            return
+        self.writer = threading.Thread(target=self._run, daemon=True)
+        self.writer_pid = os.getpid()
+        self.writer.start()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.closing or len(self.pending) >= self.batch_spans,
+                    timeout=self.flush_seconds,
+                )
+                spans = list(self.pending)
+                self.pending.clear()
+                closing = self.closing
+
+            try:
+                if spans:
+                    self._export(spans)
+            except Exception:
+                failed = True
+            else:
+                failed = False
+
+            with self.condition:
+                if failed:
+                    self.dropped_spans += len(spans)
+                else:
+                    self.exported_spans += len(spans)
+            if closing:
+                return
+
+    def _export(self, spans):
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as trace_file:
+                trace_file.writelines(
+                    json.dumps(span.to_dict()) + "\n" for span in spans
+                )
+        if self.endpoint:
+            request = urllib.request.Request(
+                self.endpoint,
+                data=json.dumps(otlp_request(spans)).encode(),
+                headers={"Content-Type": "application/json"},
+            )
+            urllib.request.urlopen(request, timeout=5).close()
+
+    def close(self, timeout=10):
+        """
+        Export the queued spans and stop the exporter thread.
+        """
+        with self.condition:
+            if self.writer is None or self.writer_pid != os.getpid():
+                return
+            self.closing = True
+            self.condition.notify_all()
+        self.writer.join(timeout)
+
+
+# Span exporter of this worker process, created with the first span
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter():
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = SpanExporter()
+            atexit.register(_exporter.close)
+        return _exporter
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware that records a server span around every HTTP request, as a
+    child of the span of the caller when the request carries a W3C traceparent
+    header. The spans of the handler stages nest under it, and the response
+    carries the trace id in an X-Trace-Id header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not TRACING or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {name.lower(): value for name, value in scope["headers"]}
+        parent = parse_traceparent(headers.get(b"traceparent", b"").decode())
+        content_length = headers.get(b"content-length")
+        with span(
+            f"{scope['method']} {scope['path']}",
+            parent=parent,
+            kind="server",
+            content_length=int(content_length) if content_length else -1,
+        ) as server_span:
+
+            async def send_with_trace_id(message):
+                if message["type"] == "http.response.start":
+                    server_span.attributes["status_code"] = message["status"]
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-trace-id", server_span.trace_id.encode())
+                    ]
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace_id)
@@ -0,0 +1,83 @@
+import pandas as pd
+from prediction.features import loan_size_category, loan_to_income
+from prediction.mappings import ACCEPTED_REJECTED_MAPPING
+from prediction.threads import limit_threads
+
+
+def expand_grid(loan, loan_amnts, terms):
+    """
+    Repeat the features of one loan for every combination of loan amount and term.
+
+    The features derived from the loan amount (`LTI`, `loan_size_category`) are
+    recomputed on the whole grid at once.
+
+    Args:
+    loan: A Loan object.
+    loan_amnts: A list of loan amounts.
+    terms: A list of loan terms in months.
+
+    Returns:
+    A DataFrame with one model-ready row per grid point, loan amount major.
+    """
+    grid = pd.MultiIndex.from_product(
+        [loan_amnts, terms], names=["loan_amnt", "term"]
+    ).to_frame(index=False)
+
+    base = pd.DataFrame.from_dict(loan.get_entry_dict())
+    frame = base.loc[base.index.repeat(len(grid))].reset_index(drop=True)
+
+    frame["loan_amnt"] = grid["loan_amnt"]
+    if "term" in frame.columns:
+        frame["term"] = grid["term"]
+    if "LTI" in frame.columns:
+        frame["LTI"] = loan_to_income(frame["loan_amnt"], frame["annual_inc_joint"])
+    if "loan_size_category" in frame.columns:
+        frame["loan_size_category"] = loan_size_category(frame["loan_amnt"])
+
+    return frame
+
+
+def predict_what_if(model_step1, model_step4, query):
+    """
+    Predict the acceptance probability and the interest rate over a grid of loan
+    amounts and terms, with a single model call per step.
+
+    Args:
+    model_step1: The trained acceptance model.
+    model_step4: The trained interest rate model.
+    query: A WhatIfGrid object.
+
+    Returns:
+    A dictionary of columns with one value per grid point, loan amount major.
+    """
+    surface = (
+        pd.MultiIndex.from_product(
+            [query.loan_amnt, query.term], names=["loan_amnt", "term"]
+        )
+        .to_frame(index=False)
+        .to_dict(orient="list")
+    )
+
+    if query.step1 is not None:
+        # The acceptance model does not use the term, so each amount is scored once
+        entries = expand_grid(query.step1, query.loan_amnt, [query.term[0]])
+        with limit_threads(model_step1, len(entries)):
+            predicted_proba = model_step1.predict_proba(entries)
+        accepted = list(model_step1.classes_).index(1)
+        predicted = model_step1.classes_[predicted_proba.argmax(axis=1)]
+
+        repeats = len(query.term)
+        surface["accepted_proba"] = (
+            predicted_proba[:, accepted].repeat(repeats).tolist()
+        )
+        surface["Loan_Acceptance"] = [
+            ACCEPTED_REJECTED_MAPPING[prediction]
+            for prediction in predicted.repeat(repeats).tolist()
+        ]
+
+    if query.step4 is not None:
+        entries = expand_grid(query.step4, query.loan_amnt, query.term)
+        with limit_threads(model_step4, len(entries)):
+            surface["int_rate"] = model_step4.predict(entries).tolist()
+
+    return surface
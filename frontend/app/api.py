@@ -0,0 +1,221 @@
+# Import the necessary packages
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pandas as pd
+import requests
+import streamlit as st
+from tracing import current_context, span
+
+# Number of CSV rows sent to the backend in a single request
+CHUNK_SIZE = 2000
+
+# Number of chunk requests kept in flight at the same time
+MAX_IN_FLIGHT = 4
+
+# Seconds to wait for the backend to answer a single chunk
+REQUEST_TIMEOUT = 120
+
+# Number of times a chunk is retried when the backend asks to retry later
+MAX_RETRIES = 5
+
+# Ask the backend to score the valid rows of every chunk and report the invalid
+# ones, instead of rejecting the whole chunk
+PARTIAL_PARAMS = {"partial": "true"}
+
+
+# Define a function to count the data rows of an uploaded CSV file without parsing it
+def count_csv_rows(uploaded_file):
+    uploaded_file.seek(0)
+    rows = sum(1 for _ in uploaded_file) - 1
+    uploaded_file.seek(0)
+    return max(rows, 0)
+
+
+# Define a generator that reads an uploaded CSV file in chunks of rows
+def read_csv_chunks(uploaded_file, chunk_size=CHUNK_SIZE):
+    uploaded_file.seek(0)
+    offset = 0
+    reader = iter(pd.read_csv(uploaded_file, chunksize=chunk_size))
+    while True:
+        # Time the parsing of every chunk on its own, not the work done between chunks
+        with span("parse_csv") as parse_span:
+            chunk = next(reader, None)
+            if parse_span is not None and chunk is not None:
+                parse_span.attributes["rows"] = len(chunk)
+        if chunk is None:
+            return
+        # Keep the row positions of the whole file so the chunks can be merged back
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        yield chunk
+        offset += len(chunk)
+
+
+# Define a function to send a single chunk to the backend API, as a span of the
+# trace of the upload when tracing is enabled
+def post_chunk(session, api_url, chunk, trace_context=None):
+    with span(
+        "post_chunk", parent=trace_context, kind="client", url=api_url, rows=len(chunk)
+    ) as chunk_span:
+        payload = chunk.to_dict(orient="records")
+
+        # Pass the trace on to the backend so its spans nest under this one
+        headers = {"traceparent": chunk_span.traceparent} if chunk_span else {}
+        response = session.post(
+            api_url,
+            params=PARTIAL_PARAMS,
+            json=payload,
+            headers=headers,
+            timeout=REQUEST_TIMEOUT,
+        )
+
+        # Wait and retry while the backend's bulk lane is full
+        retries = 0
+        while response.status_code == 429 and retries < MAX_RETRIES:
+            retries += 1
+            time.sleep(float(response.headers.get("Retry-After", 1)))
+            response = session.post(
+                api_url,
+                params=PARTIAL_PARAMS,
+                json=payload,
+                headers=headers,
+                timeout=REQUEST_TIMEOUT,
+            )
+
+        if chunk_span is not None:
+            chunk_span.attributes.update(
+                status_code=response.status_code,
+                retries=retries,
+                bytes=len(response.content),
+            )
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, response.text
+
+
+# Define a generator that posts chunks concurrently and yields them as they come back
+def stream_predictions(api_url, chunks, max_in_flight=MAX_IN_FLIGHT):
+    """
+    Yields (chunk, status, predictions) for every chunk as soon as its request completes.
+
+    At most `max_in_flight` chunks are read and sent at the same time, so memory
+    stays bounded by the chunk size rather than by the size of the file.
+    """
+    chunks = iter(chunks)
+    # The requests run in worker threads, which are given the trace of the upload
+    trace_context = current_context()
+    with requests.Session() as session, ThreadPoolExecutor(max_in_flight) as executor:
+        in_flight = {}
+
+        # Fill the pool of in-flight requests
+        for chunk in chunks:
+            in_flight[
+                executor.submit(post_chunk, session, api_url, chunk, trace_context)
+            ] = chunk
+            if len(in_flight) >= max_in_flight:
+                break
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = in_flight.pop(future)
+                try:
+                    status, predictions = future.result()
+                except requests.RequestException as error:
+                    status, predictions = None, str(error)
+                yield chunk, status, predictions
+
+                # Replace the finished request with the next chunk of the file
+                next_chunk = next(chunks, None)
+                if next_chunk is not None:
+                    in_flight[
+                        executor.submit(
+                            post_chunk, session, api_url, next_chunk, trace_context
+                        )
+                    ] = next_chunk
+
+
+# Define a function to shift the chunk-relative prediction indices to file row positions
+def offset_predictions(chunk, predictions):
+    offset = chunk.index[0] if len(chunk) else 0
+
+    # Columnar responses carry the row positions in an optional "index" column
+    values = list(predictions.values())
+    if values and all(isinstance(value, list) for value in values):
+        shifted = dict(predictions)
+        positions = shifted.get("index", range(len(values[0])))
+        shifted["index"] = [offset + int(index) for index in positions]
+        return shifted
+
+    return {offset + int(index): value for index, value in predictions.items()}
+
+
+# Define a function to list the invalid rows of a partial response at their file row positions
+def offset_row_errors(chunk, errors):
+    offset = chunk.index[0] if len(chunk) else 0
+    return [
+        {
+            "row": offset + int(index),
+            "field": ".".join(str(part) for part in error["loc"]),
+            "message": error["msg"],
+        }
+        for index, row_errors in errors.items()
+        for error in row_errors
+    ]
+
+
+# Define a function to score chunks with a progress bar and a table that grows as they arrive
+def predict_in_chunks(api_url, chunks, total_rows, merge_predictions):
+    """
+    Streams the chunks to the backend and merges every answered chunk with
+    `merge_predictions(chunk, predictions)`, showing the rows scored so far.
+
+    Returns the merged DataFrame of all chunks, the list of error messages of the
+    chunks that failed, and a DataFrame of the rows the backend rejected, with
+    their file row position, field and error message.
+    """
+    # Record the upload as one trace: the parsing and the request of every chunk,
+    # with the backend stages under each request, and the rendering of the results
+    with span("predict_in_chunks", url=api_url, rows=total_rows):
+        return _predict_in_chunks(api_url, chunks, total_rows, merge_predictions)
+
+
+# Define the body of predict_in_chunks, which runs inside the span of the upload
+def _predict_in_chunks(api_url, chunks, total_rows, merge_predictions):
+    progress = st.progress(0.0)
+    placeholder = st.empty()
+    table = None
+    scored_chunks = []
+    errors = []
+    row_errors = []
+    scored_rows = 0
+
+    for chunk, status, predictions in stream_predictions(api_url, chunks):
+        with span("render", rows=len(chunk)):
+            if status == 200:
+                # Partial responses carry the predictions of the valid rows and the
+                # errors of the others, both keyed by row position in the chunk
+                if "predictions" in predictions and "errors" in predictions:
+                    row_errors.extend(offset_row_errors(chunk, predictions["errors"]))
+                    predictions = predictions["predictions"]
+                chunk = merge_predictions(chunk, offset_predictions(chunk, predictions))
+            else:
+                chunk = merge_predictions(chunk, {})
+                errors.append(predictions)
+            scored_chunks.append(chunk)
+
+            # Append the new rows to the table instead of re-rendering everything
+            if table is None:
+                table = placeholder.dataframe(chunk)
+            else:
+                table.add_rows(chunk)
+
+            scored_rows += len(chunk)
+            progress.progress(min(scored_rows / total_rows, 1.0) if total_rows else 1.0)
+
+    placeholder.empty()
+    row_errors = pd.DataFrame(row_errors, columns=["row", "field", "message"])
+    if not scored_chunks:
+        return pd.DataFrame(), errors, row_errors
+    return pd.concat(scored_chunks).sort_index(), errors, row_errors
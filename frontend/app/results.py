@@ -0,0 +1,65 @@
+# Import the necessary packages
+import pandas as pd
+
+# Value shown for rows the backend returned no prediction for
+UNKNOWN = "Unknown"
+
+# Name of the column used for responses that map each row to a single value
+VALUE_COLUMN = "prediction"
+
+
+# Define a function to build the prediction columns from an API response in one step
+def predictions_to_frame(predictions):
+    """
+    Converts an indexed response ({"0": {...}} or {"0": value}) or a columnar
+    response ({"index": [...], "column": [...]}) into a DataFrame indexed by row position.
+    """
+    if not predictions:
+        return pd.DataFrame(index=pd.Index([], dtype="int64"))
+
+    values = list(predictions.values())
+
+    # Columnar responses carry one list per column
+    if all(isinstance(value, list) for value in values):
+        frame = pd.DataFrame(predictions)
+        if "index" in frame.columns:
+            frame = frame.set_index("index")
+    # Indexed responses carry either a dict of fields or a single value per row
+    elif all(isinstance(value, dict) or value is None for value in values):
+        frame = pd.DataFrame.from_dict(
+            {index: value for index, value in predictions.items() if value is not None},
+            orient="index",
+        )
+    else:
+        frame = pd.Series(predictions, name=VALUE_COLUMN).to_frame()
+
+    frame.index = frame.index.astype("int64")
+    return frame
+
+
+# Define a function to join the prediction columns onto the input rows
+def join_predictions(df, predictions, columns, front=True):
+    """
+    Joins the response fields onto `df` by row position.
+
+    `columns` maps response fields to the names of the DataFrame columns, in display
+    order. Rows without a prediction are filled with "Unknown". The prediction
+    columns are placed before the input columns when `front` is True.
+    """
+    frame = predictions_to_frame(predictions).reindex(columns=list(columns))
+    frame = frame.rename(columns=columns)
+
+    # Drop input columns that would clash with the prediction columns
+    inputs = df.drop(columns=list(columns.values()), errors="ignore")
+    joined = inputs.join(frame, how="left")
+
+    prediction_columns = list(columns.values())
+    joined[prediction_columns] = (
+        joined[prediction_columns]
+        .astype(object)
+        .where(joined[prediction_columns].notna(), UNKNOWN)
+    )
+
+    if front:
+        return joined[prediction_columns + list(inputs.columns)]
+    return joined
@@ -1,7 +1,9 @@
 # Import the necessary packages
-import requests
 import streamlit as st
 import pandas as pd
+from api import count_csv_rows, predict_in_chunks, read_csv_chunks
+from results import join_predictions
+from viewer import cache_results, has_results, show_results, show_row_errors
 
 # Define the API endpoint URL
 API_URL = "https://eb-loan-prediction-backend.herokuapp.com/step1_accepted_rejected_prediction/"
@@ -78,39 +80,49 @@ def acc_pred():
     else:
         # Define input fields for CSV upload
         uploaded_file = st.file_uploader("Upload CSV file")
-        if uploaded_file is not None:
-            df = pd.read_csv(uploaded_file)
-            loan_info = df.to_dict(orient="records")
-        else:
-            loan_info = []
 
-    # Define a function to get the prediction from the backend API
-    def get_prediction(payload):
-        response = requests.post(API_URL, json=payload)
-        return response.status_code, response.json()
+    # Define a function to populate the acceptance prediction of a chunk of loans
+    def merge_predictions(df, predictions):
+        df = join_predictions(
+            df, predictions, {"Loan_Acceptance": "acceptance"}, front=False
+        )
+        df["acceptance"] = df["acceptance"].replace(
+            {"Accepted": "ACCEPTED", "Rejected": "REJECTED"}
+        )
+        return df
 
     # Define the Predict button and its functionality
     if st.button("Predict"):
-        # Make the API call and get the response
-        status, predictions = get_prediction(loan_info)
+        # Send the manual input as a single chunk and stream uploaded files in chunks
+        if input_type == "Manual Input":
+            chunks, total_rows = [pd.DataFrame(loan_info)], len(loan_info)
+        elif uploaded_file is not None:
+            total_rows = count_csv_rows(uploaded_file)
+            chunks = read_csv_chunks(uploaded_file)
+        else:
+            chunks, total_rows = [], 0
 
-        # Convert the loan_info into a pandas dataframe and add a column for acceptance prediction
-        df = pd.DataFrame(loan_info)
-        df["acceptance"] = "Unknown"
+        # Make the API calls and populate the acceptance prediction as the chunks come back
+        df, errors, row_errors = predict_in_chunks(
+            API_URL, chunks, total_rows, merge_predictions
+        )
 
-        # If the status code from API is 200, populate the acceptance prediction in the dataframe
-        if status == 200:
-            for index, prediction in predictions.items():
-                new_index = int(index)
-                if prediction is not None:
-                    if prediction["Loan_Acceptance"] == "Accepted":
-                        df.at[new_index, "acceptance"] = "ACCEPTED"
-                    elif prediction["Loan_Acceptance"] == "Rejected":
-                        df.at[new_index, "acceptance"] = "REJECTED"
+        # Keep the full results on the server so that paging does not re-run the prediction
+        cache_results("step1", df)
+        st.session_state["step1_errors"] = errors
+        st.session_state["step1_row_errors"] = row_errors
 
-            # Display the dataframe with colored background for acceptance prediction
-            st.dataframe(df.style.applymap(acceptance_val, subset=["acceptance"]))
-        else:
-            st.write(
-                f"Sorry, there was an error making the prediction. Please try again later. Error message - {predictions}"
-            )
+    # Display the visible page with colored background for acceptance prediction
+    if has_results("step1"):
+        show_results(
+            "step1",
+            filter_columns=["acceptance"],
+            style=lambda page: page.style.applymap(
+                acceptance_val, subset=["acceptance"]
+            ),
+        )
+    show_row_errors("step1")
+    for error in st.session_state.get("step1_errors", []):
+        st.write(
+            f"Sorry, there was an error making the prediction. Please try again later. Error message - {error}"
+        )
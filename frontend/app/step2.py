@@ -1,7 +1,8 @@
 # Import the necessary packages
-import pandas as pd
-import requests
 import streamlit as st
+from api import count_csv_rows, predict_in_chunks, read_csv_chunks
+from results import join_predictions
+from viewer import cache_results, has_results, show_results, show_row_errors
 
 API_URL = "https://eb-loan-prediction-backend.herokuapp.com/step2_grade_prediction/"
 
@@ -16,48 +17,36 @@ def grade_pred():
     st.selectbox("Input Type", ["CSV Upload"])
     uploaded_file = st.file_uploader("Upload CSV file")
 
-    # Read CSV file and convert to dictionary if file uploaded
-    if uploaded_file is not None:
-        df = pd.read_csv(uploaded_file)
-        loan_info = df.to_dict(orient="records")
-    else:
-        loan_info = []
+    # Function to populate the predicted grades of a chunk of loans
+    def merge_predictions(df, predictions):
+        return join_predictions(
+            df,
+            predictions,
+            {"predicted_grade": "predicted_grade", "grade_category": "grade_category"},
+        )
 
-    # Function to send loan information to API and get predicted grades
-    def get_prediction(payload):
-        response = requests.post(API_URL, json=payload)
-        return response.status_code, response.json()
-
-    # If "Predict" button clicked, get predicted grades and display in DataFrame
+    # If "Predict" button clicked, stream the file to the API and display predicted grades in DataFrame
     if st.button("Predict"):
-        status, predictions = get_prediction(loan_info)
-
-        df = pd.DataFrame(loan_info)
-
-        df.insert(0, "grade_category", "")
-        df["grade_category"] = "Unknown"
-
-        df.insert(0, "predicted_grade", "")
-        df["predicted_grade"] = "Unknown"
-
-        if status == 200:
-            for index, prediction in predictions.items():
-                new_index = int(index)
-
-                if prediction is not None:
-                    if prediction["grade_category"] is not None:
-                        df.at[new_index, "grade_category"] = prediction[
-                            "grade_category"
-                        ]
-
-                    if prediction["predicted_grade"] is not None:
-                        df.at[new_index, "predicted_grade"] = prediction[
-                            "predicted_grade"
-                        ]
-
-            df = df.sort_values(by="predicted_grade", ascending=True)
-            st.dataframe(df)
+        if uploaded_file is not None:
+            total_rows = count_csv_rows(uploaded_file)
+            chunks = read_csv_chunks(uploaded_file)
         else:
-            st.write(
-                f"Sorry, there was an error making the prediction. Please try again later. Error message - {predictions}"
-            )
+            chunks, total_rows = [], 0
+
+        df, errors, row_errors = predict_in_chunks(
+            API_URL, chunks, total_rows, merge_predictions
+        )
+
+        cache_results("step2", df)
+        st.session_state["step2_errors"] = errors
+        st.session_state["step2_row_errors"] = row_errors
+
+    if has_results("step2"):
+        show_results(
+            "step2", filter_columns=["predicted_grade"], sort_column="predicted_grade"
+        )
+    show_row_errors("step2")
+    for error in st.session_state.get("step2_errors", []):
+        st.write(
+            f"Sorry, there was an error making the prediction. Please try again later. Error message - {error}"
+        )
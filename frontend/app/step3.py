@@ -1,7 +1,8 @@
 # Import the necessary packages
-import requests
 import streamlit as st
-import pandas as pd
+from api import count_csv_rows, predict_in_chunks, read_csv_chunks
+from results import join_predictions
+from viewer import cache_results, has_results, show_results, show_row_errors
 
 API_URL = "https://eb-loan-prediction-backend.herokuapp.com/step3_subgrade_prediction/"
 
@@ -15,48 +16,41 @@ def subgrade_pred():
     st.selectbox("Input Type", ["CSV Upload"])
     uploaded_file = st.file_uploader("Upload CSV file")
 
-    # If a file is uploaded, reads the CSV file and converts it to a dictionary
-    if uploaded_file is not None:
-        df = pd.read_csv(uploaded_file)
-        loan_info = df.to_dict(orient="records")
-    else:
-        loan_info = []
-
-    # Sends the loan_info dictionary as JSON payload to the Heroku app's subgrade prediction endpoint
-    def get_prediction(payload):
-        response = requests.post(API_URL, json=payload)
-        return response.status_code, response.json()
-
-    # Displays the predicted subgrades in a table format
+    # Populates the predicted subgrades of a chunk of loans
+    def merge_predictions(df, predictions):
+        return join_predictions(
+            df,
+            predictions,
+            {
+                "predicted_subgrade": "predicted_subgrade",
+                "subgrade_category": "subgrade_category",
+            },
+        )
+
+    # Streams the uploaded file to the subgrade prediction endpoint and displays the predicted subgrades in a table format
     if st.button("Predict"):
-        status, predictions = get_prediction(loan_info)
-        df = pd.DataFrame(loan_info)
-
-        df.insert(0, "subgrade_category", "")
-        df["subgrade_category"] = "Unknown"
-
-        df.insert(0, "predicted_subgrade", "")
-        df["predicted_subgrade"] = "Unknown"
-
-        if status == 200:
-            for index, prediction in predictions.items():
-                new_index = int(index)
-
-                if prediction is not None:
-                    if prediction["subgrade_category"] is not None:
-                        df.at[new_index, "subgrade_category"] = prediction[
-                            "subgrade_category"
-                        ]
-
-                    if prediction["predicted_subgrade"] is not None:
-                        df.at[new_index, "predicted_subgrade"] = prediction[
-                            "predicted_subgrade"
-                        ]
-
-            df = df.sort_values(by="predicted_subgrade", ascending=True)
-            st.dataframe(df)
-
+        if uploaded_file is not None:
+            total_rows = count_csv_rows(uploaded_file)
+            chunks = read_csv_chunks(uploaded_file)
         else:
-            st.write(
-                f"Sorry, there was an error making the prediction. Please try again later. Error message - {predictions}"
-            )
+            chunks, total_rows = [], 0
+
+        df, errors, row_errors = predict_in_chunks(
+            API_URL, chunks, total_rows, merge_predictions
+        )
+
+        cache_results("step3", df)
+        st.session_state["step3_errors"] = errors
+        st.session_state["step3_row_errors"] = row_errors
+
+    if has_results("step3"):
+        show_results(
+            "step3",
+            filter_columns=["predicted_subgrade"],
+            sort_column="predicted_subgrade",
+        )
+    show_row_errors("step3")
+    for error in st.session_state.get("step3_errors", []):
+        st.write(
+            f"Sorry, there was an error making the prediction. Please try again later. Error message - {error}"
+        )
@@ -1,7 +1,8 @@
 # Import the necessary packages
-import requests
 import streamlit as st
-import pandas as pd
+from api import count_csv_rows, predict_in_chunks, read_csv_chunks
+from results import VALUE_COLUMN, join_predictions
+from viewer import cache_results, has_results, show_results, show_row_errors
 
 # API endpoint URL
 API_URL = "https://eb-loan-prediction-backend.herokuapp.com/step4_int_rate_prediction/"
@@ -19,39 +20,33 @@ def int_rate_pred():
     # Upload CSV file
     uploaded_file = st.file_uploader("Upload CSV file")
 
-    # Read the uploaded file and convert to dictionary
-    if uploaded_file is not None:
-        df = pd.read_csv(uploaded_file)
-        loan_info = df.to_dict(orient="records")
-    else:
-        loan_info = []
-
-    # Define function to get prediction from API
-    def get_prediction(payload):
-        response = requests.post(API_URL, json=payload)
-        return response.status_code, response.json()
+    # Define function to populate the predicted interest rates of a chunk of loans
+    def merge_predictions(df, predictions):
+        return join_predictions(df, predictions, {VALUE_COLUMN: "int_rate"})
 
     # Run prediction on button click
     if st.button("Predict"):
-        # If file uploaded, get predictions and display in dataframe
+        # If file uploaded, stream it to the API in chunks and display predictions in dataframe
         if uploaded_file is not None:
-            status, predictions = get_prediction(loan_info)
-            df = pd.DataFrame(loan_info)
-            df.insert(0, "int_rate", "")
-            df["int_rate"] = "Unknown"
-
-            # If successful prediction, add predictions to dataframe
-            if status == 200:
-                for index, prediction in predictions.items():
-                    new_index = int(index)
-                    if prediction is not None:
-                        df.at[new_index, "int_rate"] = prediction
-
-                df = df.sort_values(by="int_rate", ascending=True)
-                st.dataframe(df)
-
-            # If unsuccessful prediction, display error message
-            else:
-                st.write(
-                    f"Sorry, there was an error making the prediction. Please try again later. Error message - {predictions}"
-                )
+            total_rows = count_csv_rows(uploaded_file)
+            chunks = read_csv_chunks(uploaded_file)
+            df, errors, row_errors = predict_in_chunks(
+                API_URL, chunks, total_rows, merge_predictions
+            )
+
+            cache_results("step4", df)
+            st.session_state["step4_errors"] = errors
+            st.session_state["step4_row_errors"] = row_errors
+
+    # Display the current page of predictions
+    if has_results("step4"):
+        show_results("step4", sort_column="int_rate")
+
+    # Display the rows that failed validation
+    show_row_errors("step4")
+
+    # If unsuccessful prediction, display error message
+    for error in st.session_state.get("step4_errors", []):
+        st.write(
+            f"Sorry, there was an error making the prediction. Please try again later. Error message - {error}"
+        )
@@ -0,0 +1,210 @@
+# Import the necessary packages
+import atexit
+import contextlib
+import contextvars
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+
+# JSON lines file the spans of the frontend are appended to
+TRACE_FILE = os.environ.get("LOAN_TRACE_FILE", "")
+
+# OTLP/HTTP traces endpoint of a local collector the spans are sent to, e.g.
+# http://localhost:4318/v1/traces
+TRACE_OTLP_ENDPOINT = os.environ.get("LOAN_TRACE_OTLP_ENDPOINT", "")
+
+# Spans are only recorded when they are exported somewhere
+TRACING = bool(TRACE_FILE or TRACE_OTLP_ENDPOINT)
+
+# Service name of the spans of the frontend
+TRACE_SERVICE = os.environ.get("LOAN_TRACE_SERVICE", "loan-prediction-frontend")
+
+# OTLP span kinds
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+# The span the code running in this context belongs to
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+# Finished spans waiting to be exported by the background thread
+_spans = queue.Queue(maxsize=10000)
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+# Define a class for a timed operation of a trace, identified like a W3C trace context
+class Span:
+    def __init__(self, name, trace_id, parent_id, kind, attributes):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+
+    @property
+    def context(self):
+        return self.trace_id, self.span_id
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+
+# Define a function to get the (trace id, span id) of the current span, to pass to other threads
+def current_context():
+    current = _current_span.get()
+    return current.context if current is not None else None
+
+
+# Define a context manager that records a span around a block of code
+@contextlib.contextmanager
+def span(name, parent=None, kind="internal", **attributes):
+    """
+    Records a span as a child of the current span, or of `parent`, a (trace id,
+    span id) tuple from another thread. Starts a new trace when there is neither.
+    Yields the Span, or None when tracing is disabled.
+    """
+    if not TRACING:
+        yield None
+        return
+
+    if parent is None:
+        parent = current_context()
+    trace_id, parent_id = parent if parent is not None else (os.urandom(16).hex(), None)
+    new_span = Span(name, trace_id, parent_id, kind, attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as error:
+        attributes["error"] = type(error).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.end_ns = time.time_ns()
+        _submit(new_span)
+
+
+# Define a function to queue a finished span, dropping it if the exporter is behind
+def _submit(finished_span):
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = threading.Thread(target=_export_spans, daemon=True)
+            _exporter.start()
+            atexit.register(_flush)
+    try:
+        _spans.put_nowait(finished_span)
+    except queue.Full:
+        pass
+
+
+# Define a function to take the spans waiting in the queue, waiting up to `timeout` for the first one
+def _take_spans(timeout):
+    try:
+        spans = [_spans.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while True:
+        try:
+            spans.append(_spans.get_nowait())
+        except queue.Empty:
+            return spans
+
+
+# Define the loop of the exporter thread, which writes the queued spans every second
+def _export_spans():
+    while True:
+        spans = _take_spans(timeout=1.0)
+        if spans:
+            try:
+                _export(spans)
+            except Exception:
+                pass
+
+
+# Define a function to export the spans still queued when the frontend exits
+def _flush():
+    spans = _take_spans(timeout=0)
+    if spans:
+        _export(spans)
+
+
+# Define a function to convert an attribute value to an OTLP value
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+# Define a function to write spans to the trace file and/or send them to the collector
+def _export(spans):
+    if TRACE_FILE:
+        os.makedirs(os.path.dirname(TRACE_FILE) or ".", exist_ok=True)
+        with open(TRACE_FILE, "a") as trace_file:
+            for finished_span in spans:
+                record = {
+                    "trace_id": finished_span.trace_id,
+                    "span_id": finished_span.span_id,
+                    "parent_id": finished_span.parent_id,
+                    "name": finished_span.name,
+                    "kind": finished_span.kind,
+                    "service": TRACE_SERVICE,
+                    "start_ns": finished_span.start_ns,
+                    "end_ns": finished_span.end_ns,
+                    "duration_ms": (finished_span.end_ns - finished_span.start_ns)
+                    / 1e6,
+                    "attributes": finished_span.attributes,
+                }
+                trace_file.write(json.dumps(record) + "\n")
+
+    if TRACE_OTLP_ENDPOINT:
+        body = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": TRACE_SERVICE},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "frontend"},
+                            "spans": [
+                                {
+                                    "traceId": s.trace_id,
+                                    "spanId": s.span_id,
+                                    "parentSpanId": s.parent_id or "",
+                                    "name": s.name,
+                                    "kind": SPAN_KINDS[s.kind],
+                                    "startTimeUnixNano": str(s.start_ns),
+                                    "endTimeUnixNano": str(s.end_ns),
+                                    "attributes": [
+                                        {"key": key, "value": _otlp_value(value)}
+                                        for key, value in s.attributes.items()
+                                    ],
+                                }
+                                for s in spans
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+        request = urllib.request.Request(
+            TRACE_OTLP_ENDPOINT,
+            data=json.dumps(body).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        urllib.request.urlopen(request, timeout=5).close()
@@ -0,0 +1,188 @@
+# Import the necessary packages
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import streamlit as st
+from results import UNKNOWN
+
+# Directory holding the cached prediction results of every session
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "loan_prediction_results")
+
+# Session caches untouched for longer than this many seconds are removed
+CACHE_TTL = 24 * 60 * 60
+
+# Number of rows sent to the browser per page of results
+PAGE_SIZE = 100
+
+
+# Define a function to get the cache directory of the current browser session
+def session_cache_dir():
+    session_id = st.session_state.setdefault("results_cache_id", uuid.uuid4().hex)
+    path = os.path.join(CACHE_DIR, session_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+# Define a function to remove the caches of sessions that are gone
+def remove_stale_caches():
+    if not os.path.isdir(CACHE_DIR):
+        return
+    now = time.time()
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if now - os.path.getmtime(path) > CACHE_TTL:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+# Define a function to give every column of the results a single Arrow type
+def to_arrow_table(df):
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype != object:
+            continue
+
+        # Numeric predictions with "Unknown" placeholders are stored as nullable numbers
+        values = df[column].where(df[column] != UNKNOWN)
+        numeric = pd.to_numeric(values, errors="coerce")
+        if numeric.notna().sum() == values.notna().sum() and values.notna().any():
+            df[column] = numeric
+        elif pd.api.types.infer_dtype(df[column], skipna=True) != "string":
+            df[column] = df[column].astype(str)
+
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+# Define a function to store the full results on the server instead of in the browser
+def cache_results(key, df):
+    """
+    Writes the results to a session-scoped Parquet file and a gzip-compressed CSV
+    file for download, and remembers where they are in the session state.
+    """
+    remove_stale_caches()
+    if df.empty:
+        st.session_state.pop(f"{key}_results_path", None)
+        return
+
+    table = to_arrow_table(df)
+
+    path = os.path.join(session_cache_dir(), f"{key}.parquet")
+    pq.write_table(table, path, compression="zstd")
+
+    csv_path = os.path.join(session_cache_dir(), f"{key}.csv.gz")
+    with pa.CompressedOutputStream(csv_path, "gzip") as stream:
+        pa_csv.write_csv(table, stream)
+
+    st.session_state[f"{key}_results_path"] = path
+    st.session_state[f"{key}_page"] = 1
+
+
+# Define a function to check whether there are cached results to display
+def has_results(key):
+    path = st.session_state.get(f"{key}_results_path")
+    return path is not None and os.path.exists(path)
+
+
+# Define a function to display the cached results one page at a time
+def show_results(
+    key, filter_columns=(), sort_column=None, style=None, page_size=PAGE_SIZE
+):
+    """
+    Displays a sortable, filterable page of the cached results of `key`, sorted by
+    `sort_column` until the user picks another column.
+
+    Filtering and sorting run on the cached Arrow data, and only the visible page
+    is converted to pandas, styled with the optional `style` function and sent to
+    the browser.
+    """
+    path = st.session_state[f"{key}_results_path"]
+    table = pq.read_table(path)
+
+    # Filter on the selected values of the prediction columns
+    for column in filter_columns:
+        if column not in table.column_names:
+            continue
+        options = sorted(
+            value for value in pc.unique(table[column]).to_pylist() if value is not None
+        )
+        selected = st.multiselect(
+            f"Filter by {column}", options, key=f"{key}_filter_{column}"
+        )
+        if selected:
+            table = table.filter(pc.is_in(table[column], value_set=pa.array(selected)))
+
+    # Sort on any column of the results
+    sort_column = st.selectbox(
+        "Sort by",
+        table.column_names,
+        index=table.column_names.index(sort_column)
+        if sort_column in table.column_names
+        else 0,
+        key=f"{key}_sort",
+    )
+    descending = st.checkbox("Descending", key=f"{key}_descending")
+    table = table.sort_by([(sort_column, "descending" if descending else "ascending")])
+
+    # Convert only the visible page to pandas
+    pages = max(-(-table.num_rows // page_size), 1)
+    if st.session_state.get(f"{key}_page", 1) > pages:
+        st.session_state[f"{key}_page"] = 1
+    page = st.number_input(
+        f"Page (of {pages})", min_value=1, max_value=pages, step=1, key=f"{key}_page"
+    )
+    start = (min(int(page), pages) - 1) * page_size
+    page_df = table.slice(start, page_size).to_pandas()
+    page_df.index = pd.RangeIndex(start, start + len(page_df))
+
+    st.dataframe(style(page_df) if style is not None else page_df)
+    st.caption(f"Showing rows {start + 1}-{start + len(page_df)} of {table.num_rows}")
+
+    # Offer the full results as compressed files
+    with open(path.replace(".parquet", ".csv.gz"), "rb") as csv_file:
+        st.download_button(
+            "Download all results (CSV, gzip)",
+            csv_file,
+            file_name=f"{key}_predictions.csv.gz",
+            mime="application/gzip",
+            key=f"{key}_download_csv",
+        )
+    with open(path, "rb") as parquet_file:
+        st.download_button(
+            "Download all results (Parquet)",
+            parquet_file,
+            file_name=f"{key}_predictions.parquet",
+            mime="application/octet-stream",
+            key=f"{key}_download_parquet",
+        )
+
+
+# Define a function to display the rows the backend could not score
+def show_row_errors(key):
+    """
+    Lists the rows of the uploaded file that failed validation, by their position
+    among the data rows of the file (starting at 0), so that only those rows need
+    to be fixed and sent again.
+    """
+    row_errors = st.session_state.get(f"{key}_row_errors")
+    if row_errors is None or row_errors.empty:
+        return
+
+    st.write(
+        f"{row_errors['row'].nunique()} rows could not be scored. "
+        "Fix these rows and upload only them again:"
+    )
+    st.dataframe(row_errors)
+    st.download_button(
+        "Download the row errors (CSV)",
+        row_errors.to_csv(index=False),
+        file_name=f"{key}_row_errors.csv",
+        mime="text/csv",
+        key=f"{key}_download_row_errors",
+    )